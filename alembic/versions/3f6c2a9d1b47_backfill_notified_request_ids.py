@@ -0,0 +1,42 @@
+"""backfill notified_request_ids for already matched pairs
+
+Revision ID: 3f6c2a9d1b47
+Revises: e439911c9b79
+Create Date: 2026-10-18 14:20:11.508312
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f6c2a9d1b47"
+down_revision: Union[str, None] = "e439911c9b79"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # до появления Rematcher о совпадениях уведомляли при создании заявки;
+    # отмечаем существующие пары, иначе первый проход разошлёт их повторно
+    op.execute(
+        """
+        UPDATE requests s
+        SET notified_request_ids = pairs.ids
+        FROM (
+            SELECT s.id AS sender_request_id, array_agg(c.id::bigint) AS ids
+            FROM requests s
+            JOIN requests c
+              ON c.origin_id = s.origin_id
+             AND c.destination_id = s.destination_id
+             AND s.period @> c.date
+            WHERE s.period IS NOT NULL AND c.date IS NOT NULL
+            GROUP BY s.id
+        ) pairs
+        WHERE s.id = pairs.sender_request_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("UPDATE requests SET notified_request_ids = '{}'")
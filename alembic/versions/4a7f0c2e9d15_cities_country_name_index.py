@@ -0,0 +1,41 @@
+"""cities (country_id, name) index for paginated pickers
+
+Revision ID: 4a7f0c2e9d15
+Revises: c5e93f0d7a18
+Create Date: 2026-10-18 19:42:10.518305
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "4a7f0c2e9d15"
+down_revision: Union[str, None] = "c5e93f0d7a18"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # страницы городов страны: country_id = ? AND name COLLATE "C" > ? ORDER BY
+    # name COLLATE "C" LIMIT ?; побайтовый порядок даёт и диапазон для префикса
+    op.create_index(
+        "ix_cities_country_name",
+        "cities",
+        ["country_id", sa.text('name COLLATE "C"')],
+        unique=False,
+    )
+    # то же для стран: уникальный индекс по name — в порядке сортировки базы
+    op.create_index(
+        "ix_countries_name_c",
+        "countries",
+        [sa.text('name COLLATE "C"')],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_countries_name_c", table_name="countries")
+    op.drop_index("ix_cities_country_name", table_name="cities")
@@ -0,0 +1,48 @@
+"""outbox
+
+Revision ID: 8b1d4e7a2c90
+Revises: 3f6c2a9d1b47
+Create Date: 2026-10-18 15:02:37.114520
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8b1d4e7a2c90"
+down_revision: Union[str, None] = "3f6c2a9d1b47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "outbox",
+        sa.Column("send_key", sa.String(), nullable=False),
+        sa.Column("chat_id", sa.BigInteger(), nullable=False),
+        sa.Column("text", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "available_at", sa.DateTime(), server_default=sa.func.now(), nullable=False
+        ),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("send_key"),
+    )
+    # очередь неотправленных: дренер берёт строки с available_at <= now()
+    op.create_index(
+        "ix_outbox_pending",
+        "outbox",
+        ["available_at"],
+        postgresql_where=sa.text("sent_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_pending", table_name="outbox")
+    op.drop_table("outbox")
@@ -0,0 +1,49 @@
+"""fsm_states
+
+Revision ID: c5e93f0d7a18
+Revises: 8b1d4e7a2c90
+Create Date: 2026-10-18 16:11:54.902731
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c5e93f0d7a18"
+down_revision: Union[str, None] = "8b1d4e7a2c90"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "fsm_states",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("state", sa.String(), nullable=True),
+        sa.Column(
+            "data",
+            postgresql.JSONB(astext_type=sa.Text()),
+            server_default="{}",
+            nullable=False,
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.func.now(), nullable=False
+        ),
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("key"),
+    )
+    # по нему удаляются брошенные диалоги
+    op.create_index(
+        op.f("ix_fsm_states_updated_at"), "fsm_states", ["updated_at"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_fsm_states_updated_at"), table_name="fsm_states")
+    op.drop_table("fsm_states")
@@ -0,0 +1,88 @@
+"""requests baggage_types -> baggage_mask bitmask
+
+Revision ID: d2b8e6f1a3c4
+Revises: 4a7f0c2e9d15
+Create Date: 2026-10-18 21:17:36.204519
+
+"""
+import json
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "d2b8e6f1a3c4"
+down_revision: Union[str, None] = "4a7f0c2e9d15"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# бит, ключ BaggageKind и русское название на момент миграции
+KINDS = [
+    (1, "usual", "Обычный"),
+    (2, "liquid", "Жидкость"),
+    (4, "expensive", "Ценный"),
+    (8, "document", "Документ"),
+    (16, "troublesome", "Проблемный"),
+    (32, "other", "Другое"),
+]
+
+
+def _needles():
+    # baggage_types — JSON-список текстом; кириллица в нём экранирована
+    # (\uXXXX) или нет, в зависимости от того, кто писал строку. Ищем
+    # элементы подстрокой в кавычках: без разбора JSON и без зависимости
+    # от кодировки базы
+    rows = set()
+    for bit, key, label in KINDS:
+        for name in (key, label):
+            rows.add((bit, json.dumps(name)))
+            rows.add((bit, json.dumps(name, ensure_ascii=False)))
+    return sorted(rows)
+
+
+def _values(rows):
+    return ", ".join(f"({bit}, '{needle}')" for bit, needle in rows)
+
+
+def upgrade() -> None:
+    op.add_column(
+        "requests",
+        sa.Column("baggage_mask", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.execute(
+        f"""
+        UPDATE requests r
+        SET baggage_mask = coalesce(
+            (
+                SELECT bit_or(k.bit)
+                FROM (VALUES {_values(_needles())}) AS k(bit, needle)
+                WHERE strpos(r.baggage_types, k.needle) > 0
+            ),
+            0
+        )
+        """
+    )
+    op.drop_column("requests", "baggage_types")
+
+
+def downgrade() -> None:
+    op.add_column(
+        "requests",
+        sa.Column("baggage_types", sa.String(), server_default="[]", nullable=False),
+    )
+    # обратно — русскими названиями, как их писала форма
+    labels = [(bit, json.dumps(label)) for bit, _, label in KINDS]
+    op.execute(
+        f"""
+        UPDATE requests r
+        SET baggage_types = (
+            SELECT '[' || coalesce(string_agg(k.label, ', ' ORDER BY k.bit), '') || ']'
+            FROM (VALUES {_values(labels)}) AS k(bit, label)
+            WHERE r.baggage_mask & k.bit <> 0
+        )
+        """
+    )
+    op.alter_column("requests", "baggage_types", server_default=None)
+    op.drop_column("requests", "baggage_mask")
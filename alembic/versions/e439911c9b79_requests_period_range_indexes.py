@@ -0,0 +1,62 @@
+"""requests period range and matching indexes
+
+Revision ID: e439911c9b79
+Revises: eabbe29047e9
+Create Date: 2026-10-18 12:05:41.214903
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e439911c9b79"
+down_revision: Union[str, None] = "eabbe29047e9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# daterange(NULL, NULL) — бесконечный период, поэтому у заявок курьеров period NULL
+PERIOD_EXPRESSION = (
+    "CASE WHEN date_from IS NOT NULL AND date_to IS NOT NULL "
+    "THEN daterange(date_from, date_to, '[]') END"
+)
+
+
+def upgrade() -> None:
+    # gist по origin_id/destination_id (integer) требует btree_gist
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    op.add_column(
+        "requests",
+        sa.Column(
+            "period",
+            postgresql.DATERANGE(),
+            sa.Computed(PERIOD_EXPRESSION, persisted=True),
+            nullable=True,
+        ),
+    )
+    # заявки курьеров: origin_id = ? AND destination_id = ? AND date BETWEEN ? AND ?
+    op.create_index(
+        "ix_requests_route_date",
+        "requests",
+        ["origin_id", "destination_id", "date"],
+        unique=False,
+        postgresql_where=sa.text("date IS NOT NULL"),
+    )
+    # заявки отправителей: origin_id = ? AND destination_id = ? AND period @> ?
+    op.create_index(
+        "ix_requests_route_period",
+        "requests",
+        ["origin_id", "destination_id", "period"],
+        unique=False,
+        postgresql_using="gist",
+        postgresql_where=sa.text("period IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_requests_route_period", table_name="requests")
+    op.drop_index("ix_requests_route_date", table_name="requests")
+    op.drop_column("requests", "period")
@@ -0,0 +1,33 @@
+"""outbox sent_at index for retention
+
+Revision ID: f4c1a7e3b925
+Revises: d2b8e6f1a3c4
+Create Date: 2026-10-18 23:41:08.532716
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f4c1a7e3b925"
+down_revision: Union[str, None] = "d2b8e6f1a3c4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # очистка отправленных строк (OutboxDrainer.purge); неотправленные
+    # CLAIM берёт по частичному ix_outbox_pending
+    op.create_index(
+        "ix_outbox_sent",
+        "outbox",
+        ["sent_at"],
+        postgresql_where=sa.text("sent_at IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_sent", table_name="outbox")
@@ -0,0 +1,118 @@
+"""pack/unpack callback_data: стандартный CallbackData против компактного.
+
+Текстовые классы повторяют прежние определения из my_keyboards.py. «filter
+miss» — проверка фильтром чужого callback: так роутер перебирает хендлеры,
+пока не найдёт свой.
+
+    python bench/callback_data.py [iterations]
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/bench")
+
+from aiogram.filters.callback_data import CallbackData  # noqa: E402
+from aiogram.types import CallbackQuery, User  # noqa: E402
+
+from my_keyboards import (  # noqa: E402
+    BaggageKindCallback,
+    BaggageKinds,
+    CancelReqCallback,
+    CityCallback,
+    DirectionEnum,
+    RoleCallback,
+    RoleModelEnum,
+)
+
+
+class TextRoleCallback(CallbackData, prefix="role"):
+    model: RoleModelEnum
+
+
+class TextCancelReqCallback(CallbackData, prefix="cancel_req"):
+    id: int
+    before: int = 0
+
+
+class TextCityCallback(CallbackData, prefix="city"):
+    direction: DirectionEnum
+    id: int
+
+
+class TextBaggageKindCallback(CallbackData, prefix="baggage_kind"):
+    kind: BaggageKinds
+
+
+CASES = [
+    (
+        "role",
+        TextRoleCallback(model="Courier"),
+        RoleCallback(model="Courier"),
+    ),
+    (
+        "cancel_req",
+        TextCancelReqCallback(id=1234567, before=1234570),
+        CancelReqCallback(id=1234567, before=1234570),
+    ),
+    (
+        "city",
+        TextCityCallback(direction="to", id=40123),
+        CityCallback(direction="to", id=40123),
+    ),
+    (
+        "baggage_kind",
+        TextBaggageKindCallback(kind=BaggageKinds.troublesome),
+        BaggageKindCallback(kind=BaggageKinds.troublesome),
+    ),
+]
+
+
+def rate(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return iterations / (time.perf_counter() - started)
+
+
+def query(data):
+    return CallbackQuery(
+        id="1",
+        from_user=User(id=1, is_bot=False, first_name="bench"),
+        chat_instance="bench",
+        data=data,
+    )
+
+
+async def filter_rate(callback_filter, callback_query, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await callback_filter(callback_query)
+    return iterations / (time.perf_counter() - started)
+
+
+async def main(iterations=100_000):
+    print(
+        f"{'callback':<14}{'codec':<9}{'bytes':>6}{'pack/s':>11}{'unpack/s':>11}"
+        f"{'miss/s':>11}"
+    )
+    # чужой callback для проверки фильтром — кнопка «Готово» формы
+    other = query("general:finish_button")
+    for name, text, compact in CASES:
+        for codec, callback in (("text", text), ("compact", compact)):
+            packed = callback.pack()
+            assert type(callback).unpack(packed) == callback
+            miss = await filter_rate(type(callback).filter(), other, iterations)
+            print(
+                f"{name:<14}{codec:<9}{len(packed.encode()):>6}"
+                f"{rate(callback.pack, iterations):>11.0f}"
+                f"{rate(lambda: type(callback).unpack(packed), iterations):>11.0f}"
+                f"{miss:>11.0f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,220 @@
+"""Бенчмарк полного сценария отправителя и курьера через form_router.
+
+Апдейты подаются в Dispatcher напрямую, вызовы Bot API перехватывает
+RecordingSession (в Telegram ничего не уходит), база — DATABASE_URL
+(используйте отдельную локальную базу, бенчмарк создаёт заявки).
+
+    python bench/handlers.py [flows]
+
+Печатает p50/p99 по хендлерам, число SQL-запросов и вызовов Bot API на сценарий
+и сколько вызовов сэкономил MessageOps (saved).
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from uuid import uuid4
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import SendMessage, TelegramMethod  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import bot as app  # noqa: E402
+from database import engine  # noqa: E402
+from message_ops import message_ops_stats  # noqa: E402
+from my_keyboards import (  # noqa: E402
+    BaggageKindCallback,
+    BaggageKinds,
+    GeneralCallback,
+    RoleCallback,
+)
+from notifications import TokenBucket  # noqa: E402
+
+
+class RecordingSession(BaseSession):
+    """Сессия aiogram, которая записывает вызовы вместо отправки."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self.message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, SendMessage):
+            self.message_id += 1
+            return Message(
+                message_id=self.message_id,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Updates:
+    def __init__(self, session: RecordingSession):
+        self.session = session
+        self.update_id = 0
+
+    def _ids(self):
+        self.update_id += 1
+        self.session.message_id += 1
+        return self.update_id, self.session.message_id
+
+    def message(self, chat_id, text):
+        update_id, message_id = self._ids()
+        user = User(id=chat_id, is_bot=False, first_name=f"Bench {chat_id}")
+        return Update(
+            update_id=update_id,
+            message=Message(
+                message_id=message_id,
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private", first_name=user.first_name),
+                from_user=user,
+                text=text,
+            ),
+        )
+
+    def callback(self, chat_id, data):
+        update_id, message_id = self._ids()
+        user = User(id=chat_id, is_bot=False, first_name=f"Bench {chat_id}")
+        return Update(
+            update_id=update_id,
+            callback_query=CallbackQuery(
+                id=str(update_id),
+                from_user=user,
+                chat_instance="bench",
+                message=Message(
+                    message_id=message_id,
+                    date=datetime.now(),
+                    chat=Chat(id=chat_id, type="private", first_name=user.first_name),
+                    text="bench",
+                ),
+                data=data,
+            ),
+        )
+
+    def flow(self, chat_id, role, when, route):
+        return [
+            self.message(chat_id, "/start"),
+            self.callback(chat_id, RoleCallback(model=role).pack()),
+            # у названий нет общих префиксов и триграмм: иначе форма
+            # остановится на подсказках похожих городов
+            self.message(chat_id, route[0]),
+            self.message(chat_id, route[1]),
+            self.message(chat_id, when),
+            self.callback(chat_id, BaggageKindCallback(kind=BaggageKinds.usual).pack()),
+            self.callback(
+                chat_id, BaggageKindCallback(kind=BaggageKinds.finish).pack()
+            ),
+            self.message(chat_id, "bench comment"),
+            self.callback(chat_id, GeneralCallback(text="finish_button").pack()),
+        ]
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+async def main(flows=50):
+    session = RecordingSession()
+    app.bot.session = session
+    dp = app.build_dispatcher()
+    # меряем хендлеры, а не лимиты Telegram
+    app.notifier.bucket = TokenBucket(rate=10**6)
+    app.notifier.chat_interval = 0
+
+    timings = defaultdict(list)
+
+    async def timing_middleware(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            timings[data["handler"].callback.__name__].append(
+                time.perf_counter() - started
+            )
+
+    app.form_router.message.middleware(timing_middleware)
+    app.form_router.callback_query.middleware(timing_middleware)
+
+    statements = [0]
+
+    def count_statement(*args):
+        statements[0] += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+
+    await dp.emit_startup(bot=app.bot, dispatcher=dp)
+    while not app.match_index.ready:
+        await asyncio.sleep(0.01)
+
+    updates = Updates(session)
+    day = (date.today() + timedelta(days=5)).strftime("%d.%m.%Y")
+    period = "-".join(
+        (date.today() + timedelta(days=d)).strftime("%d.%m.%Y") for d in (1, 10)
+    )
+    base_chat_id = random.randint(10**9, 2 * 10**9)
+    per_flow = defaultdict(lambda: defaultdict(list))
+    for i in range(flows):
+        route = (uuid4().hex[:12], uuid4().hex[:12])
+        for role, when in (("Sender", period), ("Courier", day)):
+            statements[0] = 0
+            calls_before = sum(session.calls.values())
+            saved_before = message_ops_stats()["saved"]
+            chat_id = base_chat_id + 2 * i + (role == "Courier")
+            # у каждой пары свой маршрут: курьер совпадает ровно с одним отправителем
+            for update in updates.flow(chat_id, role, when, route):
+                result = await dp.feed_update(app.bot, update)
+                if isinstance(result, TelegramMethod):
+                    await dp.silent_call_request(app.bot, result)
+            # уведомления уходят через outbox: дожидаемся его разбора
+            while await app.outbox_drainer.drain():
+                pass
+            await app.outbox_drainer.flush()
+            per_flow[role]["sql"].append(statements[0])
+            per_flow[role]["api"].append(sum(session.calls.values()) - calls_before)
+            per_flow[role]["saved"].append(message_ops_stats()["saved"] - saved_before)
+
+    await dp.emit_shutdown(bot=app.bot, dispatcher=dp)
+    await engine.dispose()
+
+    print(f"{'handler':<34}{'calls':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(timings.items()):
+        values_ms = [v * 1000 for v in values]
+        print(
+            f"{name:<34}{len(values):>7}{percentile(values_ms, 50):>10.2f}"
+            f"{percentile(values_ms, 99):>10.2f}"
+        )
+    print()
+    print(f"{'flow':<10}{'SQL/flow':>10}{'API/flow':>10}{'saved':>10}")
+    for role, metrics in per_flow.items():
+        print(
+            f"{role:<10}{statistics.mean(metrics['sql']):>10.1f}"
+            f"{statistics.mean(metrics['api']):>10.1f}"
+            f"{statistics.mean(metrics['saved']):>10.1f}"
+        )
+    print()
+    print("Bot API calls:", dict(session.calls))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,138 @@
+"""EXPLAIN ANALYZE предикатов матчинга до и после индексов e439911c9b79.
+
+Создаёт две UNLOGGED таблицы с одинаковыми данными: bench_requests_before
+(без индексов, старые предикаты date_from <= x <= date_to) и
+bench_requests_after (period daterange, btree + gist как в миграции).
+
+    python bench/matching_explain.py [rows] [routes] [samples]
+"""
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sqlalchemy import text  # noqa: E402
+
+from database import engine  # noqa: E402
+
+SEED = """
+CREATE UNLOGGED TABLE bench_requests_before AS
+SELECT g AS id, origin_id, destination_id,
+       CASE WHEN courier THEN day END AS date,
+       CASE WHEN NOT courier THEN day END AS date_from,
+       CASE WHEN NOT courier THEN day + span END AS date_to
+FROM (
+    SELECT g,
+           (random() * :routes)::int AS origin_id,
+           (random() * :routes)::int AS destination_id,
+           g % 2 = 0 AS courier,
+           current_date + (random() * 60)::int AS day,
+           (random() * 30)::int AS span
+    FROM generate_series(1, :rows) g
+) s
+"""
+
+COPY_AFTER = """
+CREATE UNLOGGED TABLE bench_requests_after AS
+SELECT *,
+       CASE WHEN date_from IS NOT NULL AND date_to IS NOT NULL
+            THEN daterange(date_from, date_to, '[]') END AS period
+FROM bench_requests_before
+"""
+
+INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS btree_gist",
+    "CREATE INDEX ON bench_requests_after (origin_id, destination_id, date) "
+    "WHERE date IS NOT NULL",
+    "CREATE INDEX ON bench_requests_after USING gist "
+    "(origin_id, destination_id, period) WHERE period IS NOT NULL",
+]
+
+QUERIES = {
+    ("couriers", "before"): "SELECT id FROM bench_requests_before "
+    "WHERE origin_id = :origin AND destination_id = :destination "
+    "AND date >= :date_from AND date <= :date_to",
+    ("couriers", "after"): "SELECT id FROM bench_requests_after "
+    "WHERE origin_id = :origin AND destination_id = :destination "
+    "AND date BETWEEN :date_from AND :date_to",
+    ("senders", "before"): "SELECT id FROM bench_requests_before "
+    "WHERE origin_id = :origin AND destination_id = :destination "
+    "AND date_from <= :day AND date_to >= :day",
+    ("senders", "after"): "SELECT id FROM bench_requests_after "
+    "WHERE origin_id = :origin AND destination_id = :destination "
+    "AND period @> CAST(:day AS date)",
+}
+
+
+def plan_nodes(plan):
+    yield plan["Node Type"], plan.get("Index Name")
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+async def seed(conn, rows, routes):
+    await conn.execute(text("DROP TABLE IF EXISTS bench_requests_before"))
+    await conn.execute(text("DROP TABLE IF EXISTS bench_requests_after"))
+    started = time.perf_counter()
+    await conn.execute(text(SEED), {"rows": rows, "routes": routes})
+    await conn.execute(text(COPY_AFTER))
+    for statement in INDEXES:
+        await conn.execute(text(statement))
+    await conn.execute(text("ANALYZE bench_requests_before"))
+    await conn.execute(text("ANALYZE bench_requests_after"))
+    print(f"seeded {rows} rows in {time.perf_counter() - started:.1f}s")
+
+
+async def explain(conn, query, params):
+    result = await conn.execute(
+        text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}"), params
+    )
+    raw = result.scalar()
+    report = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+    return report["Execution Time"], report["Plan"]
+
+
+async def main(rows=3_000_000, routes=50, samples=50):
+    random.seed(1)
+    async with engine.begin() as conn:
+        await seed(conn, rows, routes)
+        params = []
+        for _ in range(samples):
+            day = date.today() + timedelta(days=random.randint(0, 60))
+            params.append(
+                {
+                    "origin": random.randint(0, routes),
+                    "destination": random.randint(0, routes),
+                    "day": day,
+                    "date_from": day,
+                    "date_to": day + timedelta(days=random.randint(0, 30)),
+                }
+            )
+
+        print(f"{'query':<10}{'table':<8}{'p50 ms':>10}{'max ms':>10}  plan")
+        for (kind, table), query in QUERIES.items():
+            timings = []
+            for p in params:
+                elapsed, plan = await explain(conn, query, p)
+                timings.append(elapsed)
+            nodes = ", ".join(
+                f"{node} {index}" if index else node for node, index in plan_nodes(plan)
+            )
+            print(
+                f"{kind:<10}{table:<8}{statistics.median(timings):>10.3f}"
+                f"{max(timings):>10.3f}  {nodes}"
+            )
+
+        await conn.execute(text("DROP TABLE bench_requests_before"))
+        await conn.execute(text("DROP TABLE bench_requests_after"))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,250 @@
+"""Задержка горячих запросов под конкурентной нагрузкой.
+
+Каждый запрос выполняется в двух вариантах: «built» строит выражение
+заново на каждый вызов (как было до кеширования), «cached» — то, что
+используют хендлеры (lambda_stmt и готовые выражения upsert). Страницы и
+буквы выбора города хендлеры тоже строят на каждый вызов, у них только
+вариант built. Нагрузку дают
+concurrency корутин, каждая со своей сессией из общего пула; настройки
+пула и asyncpg берутся из окружения (DB_POOL_SIZE, DB_STATEMENT_CACHE_SIZE,
+DB_PGBOUNCER, ...). Запись идёт в транзакциях, которые откатываются.
+
+    python bench/statements.py [concurrency] [calls]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+from sqlalchemy import func, lambda_stmt, literal_column, select  # noqa: E402
+from sqlalchemy.dialects.postgresql import insert as pg_insert  # noqa: E402
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+import database  # noqa: E402
+from database import (  # noqa: E402
+    BAGGAGE_BITS,
+    City,
+    Courier,
+    Request,
+    Sender,
+    User,
+    UserCity,
+    async_session_maker,
+    engine,
+    upsert,
+)
+from matching import find_couriers, find_senders, match_index  # noqa: E402
+from my_keyboards import _letters, _page  # noqa: E402
+
+
+async def built_upsert(session, model, defaults=None, **kwargs):
+    defaults = defaults or {}
+    query = pg_insert(model).values(**kwargs, **defaults)
+    query = query.on_conflict_do_update(
+        index_elements=list(kwargs),
+        set_={key: query.excluded[key] for key in kwargs},
+    ).returning(model, literal_column("xmax = 0").label("created"))
+    return (await session.execute(query)).one()
+
+
+async def built_identity(session, user_id):
+    result = await session.execute(
+        select(Courier.id, Sender.id)
+        .select_from(User)
+        .outerjoin(Courier, Courier.user_id == User.id)
+        .outerjoin(Sender, Sender.user_id == User.id)
+        .filter(User.id == user_id)
+    )
+    return result.one()
+
+
+async def built_couriers(
+    session, origin_id, destination_id, date_from, date_to, baggage_mask
+):
+    result = await session.execute(
+        select(Request)
+        .options(
+            joinedload(Request.origin),
+            joinedload(Request.destination),
+            joinedload(Request.courier).joinedload(Courier.user),
+        )
+        .filter(
+            Request.origin_id == origin_id,
+            Request.destination_id == destination_id,
+            Request.date.between(date_from, date_to),
+            Request.baggage_mask.op("&")(baggage_mask) == baggage_mask,
+        )
+    )
+    return result.scalars().all()
+
+
+async def built_senders(session, origin_id, destination_id, day, baggage_mask):
+    result = await session.execute(
+        select(Request)
+        .options(
+            joinedload(Request.origin),
+            joinedload(Request.destination),
+            joinedload(Request.sender).joinedload(Sender.user),
+        )
+        .filter(
+            Request.origin_id == origin_id,
+            Request.destination_id == destination_id,
+            Request.period.contains(day),
+            Request.baggage_mask.op("&")(baggage_mask) == Request.baggage_mask,
+        )
+    )
+    return result.scalars().all()
+
+
+async def cached_identity(session, user_id):
+    # запрос из IdentityCache._load без upsert пользователя перед ним
+    result = await session.execute(
+        lambda_stmt(
+            lambda: select(Courier.id, Sender.id)
+            .select_from(User)
+            .outerjoin(Courier, Courier.user_id == User.id)
+            .outerjoin(Sender, Sender.user_id == User.id)
+            .filter(User.id == user_id)
+        )
+    )
+    return result.one()
+
+
+def statements(user_id, cities):
+    """name -> {variant: (session, rnd) -> awaitable}.
+
+    cities — {country_id: [id города, ...]}: якоря страниц выбора города.
+
+    Ключи upsert случайны из большого диапазона: незакоммиченные вставки
+    одного ключа в разных транзакциях ждали бы друг друга.
+    """
+
+    def day(rnd):
+        return date.today() + timedelta(days=rnd.randint(0, 60))
+
+    def route(rnd):
+        return rnd.randint(1, 50), rnd.randint(1, 50)
+
+    def mask(rnd):
+        return rnd.choice(list(BAGGAGE_BITS.values()))
+
+    def city_page(session, rnd):
+        country_id = rnd.choice(list(cities))
+        after = rnd.choice(cities[country_id])
+        return _page(session, City, country_id, "", after, 0)
+
+    def city_letters(session, rnd):
+        return _letters(session, rnd.choice(list(cities)))
+
+    return {
+        "upsert user": {
+            "built": lambda s, rnd: built_upsert(
+                s, User, defaults={"name": "bench"}, tg_id=rnd.randint(1, 10**9)
+            ),
+            "cached": lambda s, rnd: upsert(
+                s, User, defaults={"name": "bench"}, tg_id=rnd.randint(1, 10**9)
+            ),
+        },
+        "upsert user city": {
+            "built": lambda s, rnd: built_upsert(
+                s,
+                UserCity,
+                defaults={"created_by_id": user_id},
+                name=f"bench city {rnd.randint(1, 10**9)}",
+            ),
+            "cached": lambda s, rnd: upsert(
+                s,
+                UserCity,
+                defaults={"created_by_id": user_id},
+                name=f"bench city {rnd.randint(1, 10**9)}",
+            ),
+        },
+        "identity roles": {
+            "built": lambda s, rnd: built_identity(s, user_id),
+            "cached": lambda s, rnd: cached_identity(s, user_id),
+        },
+        "city page": {"built": city_page},
+        "city letters": {"built": city_letters},
+        "find couriers": {
+            "built": lambda s, rnd: built_couriers(
+                s, *route(rnd), day(rnd), day(rnd) + timedelta(days=14), mask(rnd)
+            ),
+            "cached": lambda s, rnd: find_couriers(
+                s, *route(rnd), day(rnd), day(rnd) + timedelta(days=14), mask(rnd)
+            ),
+        },
+        "find senders": {
+            "built": lambda s, rnd: built_senders(s, *route(rnd), day(rnd), mask(rnd)),
+            "cached": lambda s, rnd: find_senders(s, *route(rnd), day(rnd), mask(rnd)),
+        },
+    }
+
+
+async def worker(seed, factory, calls, timings):
+    rnd = random.Random(seed)
+    async with async_session_maker() as session:
+        for _ in range(calls):
+            started = time.perf_counter()
+            await factory(session, rnd)
+            timings.append(time.perf_counter() - started)
+        await session.rollback()
+
+
+async def main(concurrency=20, calls=200):
+    # SQL-путь матчинга, а не индекс в памяти
+    match_index.ready = False
+    async with async_session_maker() as session:
+        user, _ = await upsert(session, User, defaults={"name": "bench"}, tg_id=1)
+        await session.commit()
+        # до 50 городов из 20 самых населённых стран
+        top = (
+            select(City.country_id)
+            .group_by(City.country_id)
+            .order_by(func.count().desc())
+            .limit(20)
+        )
+        cities = defaultdict(list)
+        for country_id in (await session.execute(top)).scalars():
+            ids = await session.execute(
+                select(City.id).filter(City.country_id == country_id).limit(50)
+            )
+            cities[country_id] = ids.scalars().all()
+
+    cache = 0 if database.DB_PGBOUNCER else database.DB_STATEMENT_CACHE_SIZE
+    print(
+        f"pool_size={database.DB_POOL_SIZE} max_overflow={database.DB_MAX_OVERFLOW}"
+        f" statement_cache={cache} pgbouncer={database.DB_PGBOUNCER}"
+        f" concurrency={concurrency} calls={calls}"
+    )
+    print(f"{'statement':<18}{'variant':<8}{'p50 ms':>9}{'p99 ms':>9}{'rps':>9}")
+    for name, variants in statements(user.id, cities).items():
+        for variant, factory in variants.items():
+            # прогрев: компиляция и подготовка выражений на всех соединениях
+            await asyncio.gather(
+                *(worker(i, factory, 5, []) for i in range(concurrency))
+            )
+            timings = []
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(worker(i, factory, calls, timings) for i in range(concurrency))
+            )
+            elapsed = time.perf_counter() - started
+            p50 = statistics.median(timings) * 1000
+            p99 = statistics.quantiles(timings, n=100)[98] * 1000
+            print(
+                f"{name:<18}{variant:<8}{p50:>9.3f}{p99:>9.3f}"
+                f"{len(timings) / elapsed:>9.0f}"
+            )
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -1,53 +1,117 @@
 import asyncio
-import json
 import logging
+import os
 import sys
 from datetime import datetime, timedelta
+from html import escape
 from os import getenv
 
 from aiogram import Bot, Dispatcher, F, Router, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, Message
 from aiogram.utils.markdown import hbold
 from dotenv import load_dotenv
-from sqlalchemy import insert, select
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 # Ваш код здесь
 import database
+from cities import city_hierarchy, city_index
 from database import (
-    RU_LABELS,
+    City,
     Country,
-    Courier,
     Request,
-    Sender,
-    User,
-    UserCity,
+    after_commit,
+    after_rollback,
     async_session_maker,
-    get_or_create,
+    baggage_labels,
+    baggage_mask,
+    upsert,
+)
+from db_session import DbSessionMiddleware
+from fsm_storage import FSMUnitOfWorkMiddleware, PostgresStorage
+from gazetteer import GazetteerListener
+from identity import ROLE_FIELDS, identities
+from matching import MatchEntry, find_couriers, find_senders, match_index
+from message_ops import MessageOps, MessageOpsMiddleware, message_ops_stats
+from metrics import (
+    collectors,
+    instrument_bot,
+    instrument_dispatcher,
+    instrument_engine,
+    instrument_router,
+    start_metrics_server,
 )
 from my_keyboards import (
+    CITY_PROMPTS,
     BaggageKindCallback,
     BaggageKinds,
     CancelReqCallback,
+    CityCallback,
+    CitySuggestionCallback,
+    CountryCallback,
+    DirectionEnum,
     GeneralCallback,
+    PickerCallback,
+    ReqsPageCallback,
     RoleCallback,
     RoleModelEnum,
-    baggage_type_keyboard,
-    cancel_req_inline_kb,
+    baggage_type_markup,
+    city_keyboard,
+    city_prompt_markup,
+    city_suggestions_markup,
     country_keyboard,
-    final_keyboard,
+    final_markup,
+    invalidate_cities,
+    invalidate_countries,
+    keyboard_cache_stats,
+    reqs_page_markup,
     role_markup,
 )
+from notifications import NotificationDispatcher
+from outbox import OutboxDrainer, add_messages
+from rematch import Rematcher, claim_pairs, match_messages
+from scheduler import Scheduler
+from webhook import run_webhook
 
 load_dotenv()
 TOKEN = getenv("BOT_TOKEN")
+REQS_PAGE_SIZE = int(getenv("REQS_PAGE_SIZE", "5"))
+# через сколько секунд удаляются подсказки вроде «Сделайте свайп»
+HINT_TTL = float(getenv("HINT_TTL", "10"))
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 form_router = Router()
+fsm_storage = PostgresStorage()
+notifier = NotificationDispatcher(bot)
+scheduler = Scheduler(bot)
+outbox_drainer = OutboxDrainer(notifier)
+rematcher = Rematcher(outbox_drainer, route_keys=city_hierarchy.route_keys)
+# импорт справочника шлёт NOTIFY; каждый процесс слушает сам, поэтому без рассылки
+gazetteer_listener = GazetteerListener(
+    lambda: invalidate_countries(publish=False),
+    lambda country_id: invalidate_cities(country_id, publish=False),
+)
+
+instrument_engine(database.engine)
+instrument_bot(bot)
+instrument_router(form_router)
+collectors.append(("bot_notifier", notifier.stats))
+collectors.append(("bot_identity_cache", identities.stats))
+collectors.append(("bot_keyboard_cache", keyboard_cache_stats))
+collectors.append(("bot_rematch", rematcher.stats))
+collectors.append(("bot_outbox", outbox_drainer.stats))
+collectors.append(("bot_fsm_storage", fsm_storage.stats))
+collectors.append(("bot_message_ops", message_ops_stats))
+collectors.append(("bot_scheduler", scheduler.stats))
+collectors.append(("bot_city_index", city_index.stats))
+collectors.append(("bot_city_hierarchy", city_hierarchy.stats))
+collectors.append(("bot_match_index", match_index.stats))
+collectors.append(("bot_gazetteer_listener", gazetteer_listener.stats))
 
 
 class Form(StatesGroup):
@@ -66,124 +130,142 @@ class Form(StatesGroup):
 
 
 @form_router.message(CommandStart())
-async def command_start_handler(message: Message, state: FSMContext) -> None:
+async def command_start_handler(
+    message: Message, state: FSMContext, session: AsyncSession
+):
     await state.set_data({"name": message.from_user.full_name})
-    async with async_session_maker() as session:
-        await get_or_create(
-            session,
-            User,
-            defaults={"name": message.chat.full_name},
-            tg_id=message.chat.id,
-        )
-    await message.answer(
+    await identities.resolve(session, message.chat.id, message.chat.full_name)
+    # последний вызов API возвращаем: в режиме вебхука он уходит ответом на запрос
+    return message.answer(
         f"Привет, {hbold(message.from_user.full_name)}!\nВыбери свою роль.",
         reply_markup=role_markup,
     )
 
 
+def _owner_filter(identity):
+    clauses = []
+    if identity.sender_id is not None:
+        clauses.append(Request.sender_id == identity.sender_id)
+    if identity.courier_id is not None:
+        clauses.append(Request.courier_id == identity.courier_id)
+    return or_(*clauses) if clauses else None
+
+
+async def load_requests_page(session, identity, before=0, after=0):
+    """Страница заявок пользователя (обе роли) по убыванию id одним запросом.
+
+    Возвращает (заявки, есть_предыдущая, есть_следующая).
+    """
+    owner = _owner_filter(identity)
+    if owner is None:
+        return [], False, False
+    query = (
+        select(Request)
+        .options(joinedload(Request.origin), joinedload(Request.destination))
+        .filter(owner)
+        .limit(REQS_PAGE_SIZE + 1)
+    )
+    if after:
+        query = query.filter(Request.id > after).order_by(Request.id.asc())
+    else:
+        if before:
+            query = query.filter(Request.id < before)
+        query = query.order_by(Request.id.desc())
+    reqs = (await session.execute(query)).scalars().all()
+    has_more = len(reqs) > REQS_PAGE_SIZE
+    reqs = reqs[:REQS_PAGE_SIZE]
+    if after:
+        reqs.reverse()
+        return reqs, has_more, True
+    return reqs, bool(before), has_more
+
+
+def render_requests_page(reqs, has_prev, has_next):
+    if not reqs:
+        return "У вас нет заявок.", None
+    lines = ["Ваши заявки:"]
+    for n, req in enumerate(reqs, 1):
+        if req.date is not None:
+            when = req.date.strftime("%d.%m.%Y")
+        else:
+            when = f"{req.date_from:%d.%m.%Y}-{req.date_to:%d.%m.%Y}"
+        role = "Отправитель" if req.sender_id is not None else "Курьер"
+        lines.append(
+            f"\n{n}. {role}: {escape(req.origin.name)} → "
+            f"{escape(req.destination.name)}, {when}\n"
+            f"багаж: {', '.join(baggage_labels(req.baggage_mask))}"
+        )
+        if req.comment:
+            lines.append(f"комментарий: {escape(req.comment)}")
+    # отмена перерисовывает ту же страницу; первая страница якоря не имеет,
+    # чтобы на ней появлялись новые заявки
+    before = reqs[0].id + 1 if has_prev else 0
+    ids = [req.id for req in reqs]
+    return "\n".join(lines), reqs_page_markup(ids, before, has_prev, has_next)
+
+
+async def requests_page(session, identity, before=0, after=0):
+    page = await load_requests_page(session, identity, before, after)
+    if not page[0] and (before or after):
+        # страница опустела (заявки отменены) — показываем первую
+        page = await load_requests_page(session, identity)
+    return render_requests_page(*page)
+
+
 @form_router.message(Command("reqs"))
-async def command_reqs_handler(message: Message, state: FSMContext) -> None:
-    async with async_session_maker() as session:
-        # Выполняем запрос, чтобы найти все заявки для отправителя
+async def command_reqs_handler(
+    message: Message, state: FSMContext, session: AsyncSession
+):
+    user = await identities.resolve(
+        session, message.from_user.id, message.from_user.full_name
+    )
+    text, markup = await requests_page(session, user)
+    return message.answer(text, reply_markup=markup)
 
-        user = await session.execute(
-            select(User).filter(User.tg_id == message.from_user.id)
-        )
-        user = user.scalars().one_or_none()
-
-        sender_reqs = await session.execute(
-            select(Request)
-            .options(joinedload(Request.origin))
-            .options(joinedload(Request.destination))
-            .join(Sender, Sender.id == Request.sender_id)
-            .filter(Sender.user_id == user.id)
-        )
-        sender_reqs = sender_reqs.scalars().all()
-
-        # Get requests where the user is the courier
-
-        if sender_reqs:
-            "\n".join(
-                [
-                    f"From: {req.origin.name}, to: {req.destination.name}, "
-                    #    f"period: {req.date.strftime('%Y-%m-%d')} - {req.date.strftime('%Y-%m-%d')}, "
-                    f"baggage_types: {req.baggage_types}, "
-                    for req in sender_reqs
-                ]
-            )
-            req_dict = {
-                req.id: f"From: {req.origin.name}, to: {req.destination.name}, "
-                # f"Date: {req.date.strftime('%Y-%m-%d')}, "  исправить на date from и date to
-                f"baggage_types: {req.baggage_types}, "
-                for req in sender_reqs
-            }
-            for id in req_dict:
-                await message.answer(
-                    req_dict[id], reply_markup=cancel_req_inline_kb(id)
-                )
-        #
-
-        courier_reqs = await session.execute(
-            select(Request)
-            .options(joinedload(Request.origin))
-            .options(joinedload(Request.destination))
-            .join(Courier, Courier.id == Request.courier_id)
-            .filter(Courier.user_id == user.id)
-        )
-        courier_reqs = courier_reqs.scalars().all()
-
-        if courier_reqs:
-            # Если заявки найдены, отправляем их в виде сообщения
-            "\n".join(
-                [
-                    f"From: {req.origin.name}, to: {req.destination.name}, "
-                    f"Date: {req.date.strftime('%Y-%m-%d')}, "
-                    f"baggage_types: {req.baggage_types}, "
-                    for req in courier_reqs
-                ]
-            )
-            req_dict = {
-                req.id: f"From: {req.origin.name}, to: {req.destination.name}, "
-                f"Date: {req.date.strftime('%Y-%m-%d')}, "
-                f"baggage_types: {req.baggage_types}, "
-                for req in courier_reqs
-            }
-            for id in req_dict:
-                await message.answer(
-                    req_dict[id], reply_markup=cancel_req_inline_kb(id)
-                )
+
+@form_router.callback_query(ReqsPageCallback.filter())
+async def reqs_page_handler(
+    callback_query: CallbackQuery,
+    callback_data: ReqsPageCallback,
+    session: AsyncSession,
+):
+    user = await identities.resolve(
+        session, callback_query.from_user.id, callback_query.from_user.full_name
+    )
+    text, markup = await requests_page(
+        session, user, callback_data.before, callback_data.after
+    )
+    return callback_query.message.edit_text(text, reply_markup=markup)
 
 
 @form_router.callback_query(CancelReqCallback.filter())
 async def cancel_request_button_handler(
     callback_query: CallbackQuery,
     callback_data: CancelReqCallback,
-) -> None:
-    async with async_session_maker() as session:
-        # Выполняем запрос для получения объекта Request
-        result = await session.execute(
-            select(Request).filter(Request.id == callback_data.id)
+    session: AsyncSession,
+):
+    user = await identities.resolve(
+        session, callback_query.from_user.id, callback_query.from_user.full_name
+    )
+    owner = _owner_filter(user)
+    if owner is not None:
+        # удаляем только свою заявку
+        await session.execute(
+            delete(Request).filter(Request.id == callback_data.id, owner)
         )
-
-        # Получаем объект Request из результата
-        request = (
-            result.scalars().first()
-        )  # Используем scalars() для получения первого объекта
-
-        if request:  # Проверяем, существует ли объект
-            await session.delete(request)  # Удаляем объект
-            await session.commit()  # Подтверждаем изменения в базе данных
-    await callback_query.message.delete()
+        after_commit(session, lambda: match_index.discard(callback_data.id))
+    text, markup = await requests_page(session, user, callback_data.before)
+    return callback_query.message.edit_text(text, reply_markup=markup)
 
 
 @form_router.callback_query(GeneralCallback.filter(F.text == "start_button"))
 async def start_button_handler(
     callback_query: CallbackQuery, callback_data: GeneralCallback, state: FSMContext
-) -> None:
+):
     print("ghcghh")
     await state.set_data({"name": callback_query.from_user.full_name})
 
-    await callback_query.message.answer(
+    return callback_query.message.answer(
         text=f"Привет, {hbold(callback_query.from_user.full_name)}!\nВыбери свою роль.",
         reply_markup=role_markup,
     )
@@ -191,173 +273,237 @@ async def start_button_handler(
 
 @form_router.callback_query(RoleCallback.filter())
 async def role_button_handler(
-    callback_query: CallbackQuery, callback_data: RoleCallback, state: FSMContext
+    callback_query: CallbackQuery,
+    callback_data: RoleCallback,
+    state: FSMContext,
+    session: AsyncSession,
+    ops: MessageOps,
 ):
     await state.set_state(Form.city_from_name)
     answer = await callback_query.message.answer(
-        "Отправить из:\n(введите название города)"
+        CITY_PROMPTS[DirectionEnum.from_],
+        reply_markup=city_prompt_markup(DirectionEnum.from_),
     )
     await state.set_data({"role": callback_data.model, "message_id": answer.message_id})
-    await callback_query.message.delete()
+    ops.delete(callback_query.message.chat.id, callback_query.message.message_id)
     model = getattr(database, callback_data.model)
-    async with async_session_maker() as session:
-        user, _ = await get_or_create(
-            session,
-            User,
-            defaults={"name": callback_query.message.chat.full_name},
-            tg_id=callback_query.message.chat.id,
-        )
-        await get_or_create(session, model, user_id=user.id)
+    await identities.role_id(
+        session,
+        callback_query.message.chat.id,
+        callback_query.message.chat.full_name,
+        model,
+    )
 
 
-@form_router.message(Form.city_from_name)
-async def process_city_from(message: Message, state: FSMContext) -> None:
-    async with async_session_maker() as session:
-        user, _ = await get_or_create(
-            session,
-            User,
-            defaults={"name": message.chat.full_name},
-            tg_id=message.chat.id,
-        )
-        user_city, created = await get_or_create(
-            session, UserCity, defaults={"created_by_id": user.id}, name=message.text
-        )
-    if created:
-        # TODO: send msg to the team
-        ...
-    await state.update_data(city_from_id=user_city.id)
-    await state.update_data(city_from_name=message.text)
-    text = f"Отправить\nИз: {message.text}"
-    data = await state.get_data()
-    await bot.edit_message_text(
-        text=text, chat_id=message.chat.id, message_id=data["message_id"]
-    )
-    await message.delete()
-    await state.set_state(Form.city_to_name)
-    await message.answer("Отправить в:\n(введите название города)")
+async def _city_entered(message: Message, state: FSMContext, session, ops, direction):
+    ops.delete(message.chat.id, message.message_id)
+    if city_index.lookup(message.text) is None:
+        suggestions = city_index.suggest(message.text)
+        if suggestions:
+            # похожие города уже есть — предлагаем выбрать, прежде чем заводить новый
+            data = await state.update_data(pending_city=message.text)
+            ops.edit_text(
+                message.chat.id,
+                data["message_id"],
+                f"«{escape(message.text)}» — возможно, вы имели в виду:",
+                reply_markup=city_suggestions_markup(message.text, suggestions),
+            )
+            return
+    user = await identities.resolve(session, message.chat.id, message.chat.full_name)
+    entry = await city_index.resolve(session, message.text, user.user_id)
+    await _city_chosen(message.chat.id, state, ops, direction, entry)
 
 
-@form_router.message(Form.city_to_name)
-async def process_city_to(message: Message, state: FSMContext) -> None:
-    # TODO нельзя что бы из и в города были одинаковы
-    async with async_session_maker() as session:
-        user, _ = await get_or_create(
-            session,
-            User,
-            defaults={"name": message.chat.full_name},
-            tg_id=message.chat.id,
+async def _prompt(chat_id, state: FSMContext, text, **kwargs):
+    """Запрос ввода; его id в данных формы, ответ на шаге его удалит."""
+    prompt = await bot.send_message(chat_id, text, **kwargs)
+    await state.update_data(prompt_id=prompt.message_id)
+
+
+async def _city_chosen(chat_id, state: FSMContext, ops, direction, entry):
+    data = await state.get_data()
+    if direction == DirectionEnum.from_:
+        await state.update_data(
+            city_from_id=entry.user_city_id, city_from_name=entry.name
         )
-        user_city, created = await get_or_create(
-            session, UserCity, defaults={"created_by_id": user.id}, name=message.text
+        ops.edit_text(chat_id, data["message_id"], f"Отправить\nИз: {entry.name}")
+        await state.set_state(Form.city_to_name)
+        await _prompt(
+            chat_id,
+            state,
+            CITY_PROMPTS[DirectionEnum.to],
+            reply_markup=city_prompt_markup(DirectionEnum.to),
         )
-    if created:
-        pass
-    await state.update_data(city_to_id=user_city.id)
-    await state.update_data(city_to_name=message.text)
-    data = await state.get_data()
-    text = f"Отправить\nИз: {data['city_from_name']}\nВ: {message.text}"
-    await bot.edit_message_text(
-        text=text, chat_id=message.chat.id, message_id=data["message_id"]
-    )
-    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-    await message.delete()
+        return
+
+    # TODO нельзя что бы из и в города были одинаковы
+    await state.update_data(city_to_id=entry.user_city_id, city_to_name=entry.name)
+    text = f"Отправить\nИз: {data['city_from_name']}\nВ: {entry.name}"
+    ops.edit_text(chat_id, data["message_id"], text)
+    ops.delete(chat_id, data["prompt_id"])
     if data["role"] == RoleModelEnum.courier:
         await state.set_state(Form.date)
-        await message.answer("Пожалуйста, введите дату в формате ДД.ММ.ГГГГ.")
+        await _prompt(chat_id, state, "Пожалуйста, введите дату в формате ДД.ММ.ГГГГ.")
     elif data["role"] == RoleModelEnum.sender:
         await state.set_state(Form.period)
-        await message.answer(
-            "Пожалуйста, введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ."
+        await _prompt(
+            chat_id,
+            state,
+            "Пожалуйста, введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.",
+        )
+
+
+@form_router.message(Form.city_from_name)
+async def process_city_from(
+    message: Message, state: FSMContext, session: AsyncSession, ops: MessageOps
+):
+    await _city_entered(message, state, session, ops, DirectionEnum.from_)
+
+
+@form_router.message(Form.city_to_name)
+async def process_city_to(
+    message: Message, state: FSMContext, session: AsyncSession, ops: MessageOps
+) -> None:
+    await _city_entered(message, state, session, ops, DirectionEnum.to)
+
+
+def _city_direction(raw_state):
+    if raw_state == Form.city_from_name.state:
+        return DirectionEnum.from_
+    return DirectionEnum.to
+
+
+@form_router.callback_query(
+    CitySuggestionCallback.filter(), StateFilter(Form.city_from_name, Form.city_to_name)
+)
+async def city_suggestion_handler(
+    callback_query: CallbackQuery,
+    callback_data: CitySuggestionCallback,
+    state: FSMContext,
+    raw_state: str,
+    session: AsyncSession,
+    ops: MessageOps,
+):
+    if callback_data.user_city_id:
+        entry = city_index.get(callback_data.user_city_id)
+    elif callback_data.city_id:
+        entry = city_index.get_city(callback_data.city_id)
+    else:
+        entry = None
+    data = await state.get_data()
+    user = await identities.resolve(
+        session, callback_query.from_user.id, callback_query.from_user.full_name
+    )
+    if entry is not None:
+        entry = await city_index.choose(session, entry, user.user_id)
+    elif data.get("pending_city"):
+        # «оставить как есть»: введённое название становится новым городом
+        entry = await city_index.create(
+            session, data["pending_city"].strip(), user.user_id
         )
+    else:
+        return callback_query.answer()
+    direction = _city_direction(raw_state)
+    await _city_chosen(callback_query.message.chat.id, state, ops, direction, entry)
+    return callback_query.answer()
 
 
 @form_router.message(Form.date)
-async def process_date(message: Message, state: FSMContext) -> None:
-    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-    await message.delete()
+async def process_date(message: Message, state: FSMContext, ops: MessageOps):
+    data = await state.get_data()
+    ops.delete(message.chat.id, data["prompt_id"])
+    ops.delete(message.chat.id, message.message_id)
     date_string = message.text
     try:
         user_datetime = datetime.strptime(date_string, "%d.%m.%Y")
     except Exception:
         await state.set_state(Form.date)
-        await message.answer(
-            f"{message.text} неккоректная дата\nПожалуйста, введите дату в формате ДД.ММ.ГГГГ."
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неккоректная дата\nПожалуйста, введите дату в формате ДД.ММ.ГГГГ.",
         )
         return
     if user_datetime < datetime.now():
         await state.set_state(Form.date)
-        await message.answer(
-            f"{message.text} неккоректная дата\nВаша дата из прошлого, введите актуальную дату"
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неккоректная дата\nВаша дата из прошлого, введите актуальную дату",
         )
         return
     if user_datetime > datetime.now() + timedelta(days=60):
         await state.set_state(Form.date)
-        await message.answer(
-            f"{message.text} неккоректная дата\nВыберите дату на ближайшие 2 месяца"
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неккоректная дата\nВыберите дату на ближайшие 2 месяца",
         )
         return
-    data = await state.get_data()
     await state.update_data(date=message.text)
     text = f"Отправить\nИз: {data['city_from_name']}\nВ: {data['city_to_name']}\nдата: {message.text}"
-    await bot.edit_message_text(
-        text=text, chat_id=message.chat.id, message_id=data["message_id"]
-    )
+    ops.edit_text(message.chat.id, data["message_id"], text)
     await state.set_state(Form.baggage_types)
 
-    await message.answer(
-        text="Выберите багаж", reply_markup=await baggage_type_keyboard()
-    )
+    return message.answer(text="Выберите багаж", reply_markup=baggage_type_markup)
 
 
 @form_router.message(Form.period)
-async def prosses_period(message: Message, state: FSMContext) -> None:
-    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-    await message.delete()
+async def prosses_period(message: Message, state: FSMContext, ops: MessageOps):
+    data = await state.get_data()
+    ops.delete(message.chat.id, data["prompt_id"])
+    ops.delete(message.chat.id, message.message_id)
     date_string = message.text.split("-")
     try:
         date_from = datetime.strptime(date_string[0], "%d.%m.%Y")
         date_to = datetime.strptime(date_string[1], "%d.%m.%Y")
     except Exception:
         await state.set_state(Form.period)
-        await message.answer(
-            f"{message.text} неккоректная дата\nПожалуйста, введите дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ."
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неккоректная дата\nПожалуйста, введите дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.",
         )
         return
 
     if date_from > date_to:
         await state.set_state(Form.period)
-        await message.answer(
-            f"{message.text} неправильно указан период \n Пожалуйста, введите дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ."
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неправильно указан период \n Пожалуйста, введите дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.",
         )
         return
     if date_from < datetime.now():
         await state.set_state(Form.period)
-        await message.answer(
-            f"{message.text} неправильно указан период \n Ваша дата из прошлого, введите актуальную дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ."
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неправильно указан период \n Ваша дата из прошлого, введите актуальную дату в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.",
         )
         return
     if date_to > datetime.now() + timedelta(days=60):
         await state.set_state(Form.period)
-        await message.answer(
-            f"{message.text} неправильно указан период \n Выберите дату на ближайшие 2 месяца в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ."
+        await _prompt(
+            message.chat.id,
+            state,
+            f"{message.text} неправильно указан период \n Выберите дату на ближайшие 2 месяца в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ.",
         )
         return
-    data = await state.get_data()
     await state.update_data(date_from=date_string[0], date_to=date_string[1])
     text = f"Отправить\nИз: {data['city_from_name']}\nВ: {data['city_to_name']}\nпериод: {message.text}"
-    await bot.edit_message_text(
-        text=text, chat_id=message.chat.id, message_id=data["message_id"]
-    )
+    ops.edit_text(message.chat.id, data["message_id"], text)
     await state.set_state(Form.baggage_types)
 
-    await message.answer(
-        text="Выберите багаж", reply_markup=await baggage_type_keyboard()
-    )
+    return message.answer(text="Выберите багаж", reply_markup=baggage_type_markup)
 
 
 @form_router.callback_query(BaggageKindCallback.filter())
 async def baggage_kind_button_handler(
-    callback_query: CallbackQuery, callback_data: BaggageKindCallback, state: FSMContext
+    callback_query: CallbackQuery,
+    callback_data: BaggageKindCallback,
+    state: FSMContext,
+    ops: MessageOps,
 ):
     data = await state.get_data()
     baggage_types = data.get("baggage_types", [])
@@ -366,7 +512,7 @@ async def baggage_kind_button_handler(
         return
 
     if callback_data.kind == BaggageKinds.finish:
-        chosen_types = " ".join([i.value for i in baggage_types])
+        chosen_types = " ".join(baggage_types)
         text = (
             f"Отправить\nИз: {data['city_from_name']}\n"
             f"В: {data['city_to_name']}\n"
@@ -377,49 +523,44 @@ async def baggage_kind_button_handler(
             )
             + f"тип: {chosen_types}"
         )
-        await bot.delete_message(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-        )
-        await bot.edit_message_text(
-            text=text,
-            chat_id=callback_query.message.chat.id,
-            message_id=data["message_id"],
-        )
-        await callback_query.message.answer(text="Добавьте описания багажа")
+        chat_id = callback_query.message.chat.id
+        ops.delete(chat_id, callback_query.message.message_id)
+        ops.edit_text(chat_id, data["message_id"], text)
+        await _prompt(chat_id, state, "Добавьте описания багажа")
         await state.set_state(Form.comment)
 
         return
 
-    if callback_data.kind in baggage_types:
+    # в данных FSM хранятся значения, а не члены enum: они сериализуются в JSON
+    if callback_data.kind.value in baggage_types:
         await callback_query.answer(
             text=f"{callback_data.kind.value} уже выбран", show_alert=True
         )
         return
 
-    await callback_query.message.delete()
+    ops.delete(callback_query.message.chat.id, callback_query.message.message_id)
 
-    baggage_types.append(callback_data.kind)
+    baggage_types.append(callback_data.kind.value)
     await state.update_data(baggage_types=baggage_types)
-    chosen_types = " ".join([i.value for i in baggage_types])
+    chosen_types = " ".join(baggage_types)
     await callback_query.message.answer(
         text=f"{chosen_types}\nВыберите багаж, выберите необходимое и после нажмите готово",
-        reply_markup=await baggage_type_keyboard(),
+        reply_markup=baggage_type_markup,
     )
     await state.set_state(Form.extra)
 
 
 @form_router.message(Form.baggage_types)
-async def process_baggage_type(message: Message, state: FSMContext) -> None:
-    await message.answer("Пожалуйста, добавьте описания багажа:")
+async def process_baggage_type(message: Message, state: FSMContext):
     await state.set_state(Form.comment)
+    await _prompt(message.chat.id, state, "Пожалуйста, добавьте описания багажа:")
 
 
 @form_router.message(Form.comment)
-async def process_comment(message: Message, state: FSMContext) -> None:
+async def process_comment(message: Message, state: FSMContext, ops: MessageOps):
     await state.update_data(comment=message.text)
     data = await state.get_data()
-    chosen_types = " ".join([i.value for i in data["baggage_types"]])
+    chosen_types = " ".join(data["baggage_types"])
     text = (
         f"Отправить\nИз: {data['city_from_name']}\n"
         f"В: {data['city_to_name']}\n"
@@ -431,115 +572,176 @@ async def process_comment(message: Message, state: FSMContext) -> None:
         + f"тип: {chosen_types}"
         f"\nкомментарий: {message.text}"
     )
-    await bot.edit_message_text(
-        text=text, chat_id=message.chat.id, message_id=data["message_id"]
-    )
-    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id - 1)
-    await message.delete()
+    ops.edit_text(message.chat.id, data["message_id"], text)
+    ops.delete(message.chat.id, data["prompt_id"])
+    ops.delete(message.chat.id, message.message_id)
 
-    await message.answer("Проверьте данные", reply_markup=await final_keyboard())
+    return message.answer("Проверьте данные", reply_markup=final_markup)
 
 
-@form_router.callback_query(RoleCallback.filter(F.text == "courier"))
-async def courier_button_handler(
-    callback_query: CallbackQuery, callback_data: RoleCallback
+@form_router.callback_query(PickerCallback.filter())
+async def picker_page_handler(
+    callback_query: CallbackQuery,
+    callback_data: PickerCallback,
+    session: AsyncSession,
 ):
-    await callback_query.message.answer(
-        "Отправить из:", reply_markup=await country_keyboard(direction="from")
-    )
-    await callback_query.message.delete()
-    async with async_session_maker() as session:
-        user, _ = await get_or_create(
-            session,
-            User,
-            defaults={"name": callback_query.message.chat.full_name},
-            tg_id=callback_query.message.chat.id,
+    args = (callback_data.prefix, callback_data.after, callback_data.before)
+    if callback_data.country_id:
+        markup = await city_keyboard(
+            session, callback_data.direction, callback_data.country_id, *args
         )
-        courier, created = await get_or_create(session, Courier, user_id=user.id)
+    else:
+        markup = await country_keyboard(session, callback_data.direction, *args)
+    return callback_query.message.edit_reply_markup(reply_markup=markup)
 
-        if created:
-            await callback_query.message.answer("Вы успешно стали курьером!")
+
+@form_router.callback_query(CountryCallback.filter())
+async def country_button_handler(
+    callback_query: CallbackQuery,
+    callback_data: CountryCallback,
+    session: AsyncSession,
+):
+    markup = await city_keyboard(session, callback_data.direction, callback_data.id)
+    return callback_query.message.edit_reply_markup(reply_markup=markup)
+
+
+@form_router.callback_query(
+    CityCallback.filter(), StateFilter(Form.city_from_name, Form.city_to_name)
+)
+async def city_button_handler(
+    callback_query: CallbackQuery,
+    callback_data: CityCallback,
+    raw_state: str,
+    state: FSMContext,
+    session: AsyncSession,
+    ops: MessageOps,
+):
+    direction = _city_direction(raw_state)
+    if callback_data.direction != direction:
+        # кнопка со старой клавиатуры другого шага формы
+        return callback_query.answer()
+    if not callback_data.id:
+        return _city_prompt(callback_query, direction)
+    user = await identities.resolve(
+        session, callback_query.from_user.id, callback_query.from_user.full_name
+    )
+    entry = city_index.get_city(callback_data.id)
+    if entry is None:
+        # город импортирован после последнего обновления индекса
+        city = await session.get(City, callback_data.id)
+        if city is None:
+            return callback_query.answer()
+        entry = await city_index.create(session, city.name, user.user_id, city.id)
+    else:
+        entry = await city_index.choose(session, entry, user.user_id)
+    await _city_chosen(callback_query.message.chat.id, state, ops, direction, entry)
+    return callback_query.answer()
+
+
+@form_router.callback_query(
+    GeneralCallback.filter(F.text.startswith("absent_country_")),
+    StateFilter(Form.city_from_name, Form.city_to_name),
+)
+async def absent_country_city_handler(
+    callback_query: CallbackQuery, callback_data: GeneralCallback, raw_state: str
+):
+    # «Нет в списке» в выборе города формы — назад к вводу названия
+    return _city_prompt(callback_query, _city_direction(raw_state))
+
+
+def _city_prompt(callback_query: CallbackQuery, direction):
+    return callback_query.message.edit_text(
+        CITY_PROMPTS[direction], reply_markup=city_prompt_markup(direction)
+    )
 
 
 @form_router.callback_query(GeneralCallback.filter(F.text == "absent_country_from"))
 async def absent_country_from_button_handler(
-    callback_query: CallbackQuery, callback_data: GeneralCallback
+    callback_query: CallbackQuery, callback_data: GeneralCallback, ops: MessageOps
 ):
     await callback_query.message.answer(
         "Свайп на лево и введите название страны отправления"
     )
-    await callback_query.message.delete()
-    await callback_query.answer()
+    ops.delete(callback_query.message.chat.id, callback_query.message.message_id)
+    return callback_query.answer()
 
 
 @form_router.callback_query(GeneralCallback.filter(F.text == "absent_country_to"))
 async def absent_country_to_button_handler(
-    callback_query: CallbackQuery, callback_data: GeneralCallback
+    callback_query: CallbackQuery, callback_data: GeneralCallback, ops: MessageOps
 ):
     await callback_query.message.answer(
         "Свайп на лево и введите название страны прибытия"
     )
-    await callback_query.message.delete()
-    await callback_query.answer()
+    ops.delete(callback_query.message.chat.id, callback_query.message.message_id)
+    return callback_query.answer()
+
+
+def _country_created(session) -> None:
+    # локальный кеш — сразу, чтобы клавиатура в этом же апдейте уже содержала
+    # страну; другим процессам — после коммита, когда они её увидят
+    invalidate_countries(publish=False)
+    after_commit(session, invalidate_countries)
+    after_rollback(session, lambda: invalidate_countries(publish=False))
 
 
 @form_router.message()
-async def text_input_handler(message: Message, state: FSMContext) -> None:
+async def text_input_handler(
+    message: Message, state: FSMContext, session: AsyncSession, ops: MessageOps
+) -> None:
     if not message.reply_to_message:
         answer = await message.answer("Сделайте свайп по сообщению выше ^^^")
-        await message.delete()
-        await asyncio.sleep(10)
-        await answer.delete()
+        ops.delete(message.chat.id, message.message_id)
+        scheduler.delete_later(answer.chat.id, answer.message_id, HINT_TTL)
         return
 
     if (
         message.reply_to_message.text
         == "Свайп на лево и введите название страны отправления"
     ):
-        async with async_session_maker() as session:
-            user, _ = await get_or_create(
-                session,
-                User,
-                defaults={"name": message.chat.full_name},
-                tg_id=message.chat.id,
-            )
-            await get_or_create(
-                session, Country, defaults={"created_by_id": user.id}, name=message.text
-            )
+        await identities.resolve(session, message.chat.id, message.chat.full_name)
+        _, created = await upsert(session, Country, name=message.text)
+        if created:
+            _country_created(session)
 
-        await message.reply_to_message.edit_text(f"Отправить из: {message.text}")
+        ops.edit_text(
+            message.chat.id,
+            message.reply_to_message.message_id,
+            f"Отправить из: {message.text}",
+        )
         await message.answer(
-            "Отправить в:", reply_markup=await country_keyboard(direction="to")
+            "Отправить в:", reply_markup=await country_keyboard(session, direction="to")
         )
 
     if (
         message.reply_to_message.text
         == "Свайп на лево и введите название страны прибытия"
     ):
-        async with async_session_maker() as session:
-            user, _ = await get_or_create(
-                session,
-                User,
-                defaults={"name": message.chat.full_name},
-                tg_id=message.chat.id,
-            )
-            await get_or_create(
-                session, Country, defaults={"created_by_id": user.id}, name=message.text
-            )
+        await identities.resolve(session, message.chat.id, message.chat.full_name)
+        _, created = await upsert(session, Country, name=message.text)
+        if created:
+            _country_created(session)
 
-        await message.reply_to_message.edit_text(f"Отправить в: {message.text}")
+        ops.edit_text(
+            message.chat.id,
+            message.reply_to_message.message_id,
+            f"Отправить в: {message.text}",
+        )
         await state.set_state(Form.city_to_name)
         await message.answer(" Пожалуйста, введите дату в формате ДД.ММ.ГГГГ.")
 
-    await message.delete()
+    ops.delete(message.chat.id, message.message_id)
 
 
 @form_router.callback_query(GeneralCallback.filter(F.text == "finish_button"))
 async def command_finish_handler(
-    callback_query: CallbackQuery, callback_data: GeneralCallback, state: FSMContext
-) -> None:
+    callback_query: CallbackQuery,
+    callback_data: GeneralCallback,
+    state: FSMContext,
+    session: AsyncSession,
+):
     data = await state.get_data()
-    baggage_types = [bt.value for bt in data["baggage_types"]]
+    mask = baggage_mask(data["baggage_types"])
     date_obj = None
     date_to_obj = None
     date_from_obj = None
@@ -554,139 +756,68 @@ async def command_finish_handler(
         "date": date_obj,
         "date_from": date_from_obj,
         "date_to": date_to_obj,
-        "baggage_types": baggage_types,
+        "baggage_mask": mask,
         "status": database.Status.new,
         "comment": data["comment"],
     }
     role = data.get("role")
     # заполняем таблицы реквест (done)
-    async with async_session_maker() as session:
-        if role == RoleModelEnum.courier:
-            query = (
-                select(Courier)
-                .options(joinedload(Courier.user))
-                .filter(Courier.user.has(tg_id=callback_query.from_user.id))
-            )
-            result = await session.execute(query)
-            courier = result.scalars().one_or_none()
-            params["courier_id"] = courier.id
-        elif role == RoleModelEnum.sender:
-            query = (
-                select(Sender)
-                .options(joinedload(Sender.user))
-                .filter(Sender.user.has(tg_id=callback_query.from_user.id))
-            )
-            result = await session.execute(query)
-            sender = result.scalars().one_or_none()
-            params["sender_id"] = sender.id
-        query = insert(Request).values(**params).returning(Request.id)
-        result = await session.execute(query)
-        request_id = result.scalar()
-        await session.commit()
-        await state.update_data(request_id=request_id)
-
-    async with async_session_maker() as session:
-        if role == RoleModelEnum.sender:
-            query = (
-                select(Request)
-                .options(
-                    joinedload(Request.origin),
-                    joinedload(Request.destination),
-                    joinedload(Request.courier).joinedload(Courier.user),
-                )
-                .filter(
-                    Request.origin_id == params["origin_id"],
-                    Request.destination_id == params["destination_id"],
-                    Request.date >= params["date_from"],
-                    Request.date <= params["date_to"],
-                )
-            )
-        elif role == RoleModelEnum.courier:
-            query = (
-                select(Request)
-                .options(
-                    joinedload(Request.origin),
-                    joinedload(Request.destination),
-                    joinedload(Request.sender).joinedload(Sender.user),
-                )
-                .filter(
-                    Request.origin_id == params["origin_id"],
-                    Request.destination_id == params["destination_id"],
-                    Request.date_from <= params["date"],
-                    Request.date_to >= params["date"],
-                )
-            )
-
-        result = await session.execute(query)
-        requests = result.scalars().all()
-
-    logging.info(str(requests))
+    user = await identities.resolve(
+        session, callback_query.from_user.id, callback_query.from_user.full_name
+    )
+    model = getattr(database, role)
+    params[ROLE_FIELDS[model]] = await identities.role_id(
+        session, callback_query.from_user.id, user.name, model
+    )
+    query = insert(Request).values(**params).returning(Request.id)
+    result = await session.execute(query)
+    request_id = result.scalar()
+
+    entry = MatchEntry(
+        request_id=request_id,
+        origin_id=params["origin_id"],
+        destination_id=params["destination_id"],
+        tg_id=callback_query.from_user.id,
+        user_name=user.name,
+        origin_name=data["city_from_name"],
+        destination_name=data["city_to_name"],
+        baggage_mask=mask,
+        comment=data["comment"],
+        date=date_obj,
+        date_from=date_from_obj,
+        date_to=date_to_obj,
+    )
     if role == RoleModelEnum.sender:
-        for r in requests:
-            courier_name = r.courier.user.name
-            date_str = r.date.strftime("%d.%m.%Y")
-            origin_city = r.origin.name
-            destination_city = r.destination.name
-            r_baggage_types = [
-                RU_LABELS.get(kind, kind) for kind in json.loads(r.baggage_types)
-            ]
-
-            msg_to_sender = (
-                f"Курьер: {courier_name}\n"
-                f"Дата: {date_str}\n"
-                f"Город отправления: {origin_city}\n"
-                f"Город прибытия: {destination_city}\n"
-                f"Типы багажа: {r_baggage_types}\n"
-                f"Комментарий: {r.comment}"
-            )
-
-            msg_to_courier = (
-                f"Отправитель: {sender.user.name}\n"
-                f"Даты: с {data['date_from']} по {data['date_to']}\n"
-                f"Город отправления: {origin_city}\n"
-                f"Город прибытия: {destination_city}\n"
-                f"Типы багажа: {baggage_types}\n"
-                f"Комментарий: {data['comment']}"
-            )
-
-            await callback_query.message.answer(msg_to_sender)
-            await bot.send_message(r.courier.user.tg_id, msg_to_courier)
-
+        matches = await find_couriers(
+            session,
+            entry.origin_id,
+            entry.destination_id,
+            date_from_obj,
+            date_to_obj,
+            mask,
+        )
+        pairs = {(request_id, r.request_id): r for r in matches}
     elif role == RoleModelEnum.courier:
-        for r in requests:
-            sender_name = r.sender.user.name
-            date_from_str = r.date_from.strftime("%d.%m.%Y")
-            date_to_str = r.date_to.strftime("%d.%m.%Y")
-            origin_city = r.origin.name
-            destination_city = r.destination.name
-            r_baggage_types = [
-                RU_LABELS.get(kind, kind) for kind in json.loads(r.baggage_types)
-            ]
-
-            msg_to_courier = (
-                f"Отправитель: {sender_name}\n"
-                f"Даты: с {date_from_str} по {date_to_str}\n"
-                f"Город отправления: {origin_city}\n"
-                f"Город прибытия: {destination_city}\n"
-                f"Типы багажа: {r_baggage_types}\n"
-                f"Комментарий: {r.comment}"
-            )
-            baggage_types = [bt.value for bt in data["baggage_types"]]
-            msg_to_sender = (
-                f"Курьер: {courier.user.name}\n"
-                f"Дата: {data['date']}\n"
-                f"Город отправления: {origin_city}\n"
-                f"Город прибытия: {destination_city}\n"
-                f"Типы багажа: {baggage_types}\n"
-                f"Комментарий: {data['comment']}"
-            )
+        matches = await find_senders(
+            session, entry.origin_id, entry.destination_id, date_obj, mask
+        )
+        pairs = {(r.request_id, request_id): r for r in matches}
+    # пары отмечаются, а уведомления пишутся в outbox в той же транзакции,
+    # что и заявка: Rematcher не повторит их, а падение не потеряет
+    claimed = await claim_pairs(session, pairs)
+    entries = {entry.request_id: entry}
+    entries.update((r.request_id, r) for r in matches)
+    await add_messages(session, match_messages(claimed, entries))
+    await state.update_data(request_id=request_id)
 
-            await callback_query.message.answer(msg_to_courier)
-            await bot.send_message(r.sender.user.tg_id, msg_to_sender)
+    def committed():
+        match_index.add(entry)
+        outbox_drainer.wake()
 
-    await bot.delete_message(
-        callback_query.message.chat.id, callback_query.message.message_id
-    )
+    after_commit(session, committed)
+
+    logging.info(str(matches))
+    return callback_query.message.delete()
 
 
 # тип багажа на русски
@@ -703,23 +834,101 @@ async def cancel_request_handler(callback: CallbackQuery, state: FSMContext):
 
 
 @form_router.callback_query(lambda c: c.data.startswith("delete_request:"))
-async def delete_request_handler(callback_query: types.CallbackQuery):
+async def delete_request_handler(
+    callback_query: types.CallbackQuery, session: AsyncSession
+):
     req_id = int(callback_query.data.split(":")[1])  # Получаем ID из callback_data
-    async with async_session_maker() as session:
-        # Удаляем запрос из базы данных
-        await session.execute(select(Request).filter(Request.id == req_id).delete())
-        await session.commit()
+    # Удаляем запрос из базы данных
+    await session.execute(delete(Request).filter(Request.id == req_id))
+    after_commit(session, lambda: match_index.discard(req_id))
 
     await callback_query.answer("Запрос успешно удален.")
     await callback_query.message.edit_text("Запрос удален.")
 
 
-async def main() -> None:
-    dp = Dispatcher()
+metrics_runner = None
+# рассылка (notifier, outbox, rematch) держит общий лимит Telegram на бота,
+# поэтому в режиме шардирования она работает только в воркере 0
+run_background = True
+
+
+async def warm_identities() -> None:
+    # пользователи с незаконченными формами напишут после рестарта первыми
+    try:
+        chats = await fsm_storage.active_chats(identities.maxsize)
+        async with async_session_maker() as session:
+            loaded = await identities.warm(session, chats)
+            await session.commit()
+    except Exception:
+        logging.exception("identity warm-up failed")
+        return
+    if loaded:
+        logging.info("identity cache warmed with %s users", loaded)
+
+
+async def on_startup() -> None:
+    # привязки алиасов нужны матчингу с первой заявки
+    await city_hierarchy.start()
+    # индекс прогревается в фоне, до готовности поиск идёт через SQL
+    await match_index.start()
+    await fsm_storage.start()
+    await warm_identities()
+    await city_index.start()
+    await gazetteer_listener.start()
+    await scheduler.start()
+    if run_background:
+        await notifier.start()
+        await outbox_drainer.start()
+        await rematcher.start()
+    global metrics_runner
+    metrics_runner = await start_metrics_server()
+
+
+async def on_shutdown() -> None:
+    await rematcher.stop()
+    await match_index.stop()
+    await city_index.stop()
+    await gazetteer_listener.stop()
+    await city_hierarchy.stop()
+    await outbox_drainer.stop()
+    await notifier.stop()
+    await scheduler.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=fsm_storage)
+    # первым: в учёт апдейта попадает работа всех middleware ниже
+    instrument_dispatcher(dp)
+    # порядок после хендлера: запись состояния формы в транзакцию апдейта,
+    # один коммит данных и формы, правки и удаления сообщений
+    dp.update.outer_middleware(MessageOpsMiddleware())
+    dp.update.outer_middleware(DbSessionMiddleware())
+    # после FSMContextMiddleware: изменения FSM пишутся один раз за апдейт
+    dp.update.outer_middleware(FSMUnitOfWorkMiddleware())
     dp.include_router(form_router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def main() -> None:
+    dp = build_dispatcher()
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    asyncio.run(main())
+    mode = getenv("BOT_MODE", "polling")
+    if mode == "webhook":
+        run_webhook(build_dispatcher(), bot)
+    elif mode == "sharded":
+        # главным модулем воркеров (spawn) должен быть sharding, а не bot,
+        # иначе синглтоны этого модуля строятся в каждом воркере дважды
+        sharding = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "sharding.py"
+        )
+        os.execv(sys.executable, [sys.executable, sharding])
+    else:
+        asyncio.run(main())
@@ -0,0 +1,179 @@
+"""Компактный callback_data: поля в бинарном виде, base64url.
+
+Стандартный CallbackData пишет значения текстом через ":" (enum — своим
+значением, строку — целиком) и разбирает их через валидацию pydantic;
+фильтр вызывает unpack на каждый callback и ловит исключение при чужом
+префиксе. CompactCallbackData кодирует int как zigzag-varint, enum — номером
+члена, str — длиной и UTF-8, склеивает в байты и пишет base64url после
+короткого префикса: «x:9gGQBw» вместо «cancel_req:123:456». Значения уже
+нужных типов, так что валидация pydantic не разбирает строки, а фильтр
+отсеивает чужие callback сравнением префикса, без unpack и исключений.
+
+legacy — префикс прежнего текстового формата: кнопки, отправленные до
+перехода, продолжают работать.
+"""
+import base64
+import binascii
+from enum import Enum
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type, TypeVar, Union
+
+from aiogram.filters.callback_data import (
+    MAX_CALLBACK_LENGTH,
+    CallbackData,
+    CallbackQueryFilter,
+)
+from aiogram.types import CallbackQuery
+from magic_filter import MagicFilter
+
+T = TypeVar("T", bound="CompactCallbackData")
+
+_FROM_URLSAFE = str.maketrans("-_", "+/")
+
+
+def _write_int(out: bytearray, value: int) -> None:
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_int(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1 if not value & 1 else -(value >> 1) - 1), pos
+
+
+class _EnumCodec:
+    def __init__(self, enum: Type[Enum]):
+        self.members = list(enum)
+        self.index = {member: i for i, member in enumerate(self.members)}
+
+    def write(self, out: bytearray, value) -> None:
+        _write_int(out, self.index[value])
+
+    def read(self, data: bytes, pos: int):
+        i, pos = _read_int(data, pos)
+        # отрицательный индекс Python принял бы молча
+        if not 0 <= i < len(self.members):
+            raise ValueError(f"enum index out of range: {i}")
+        return self.members[i], pos
+
+
+class _IntCodec:
+    @staticmethod
+    def write(out: bytearray, value: int) -> None:
+        _write_int(out, value)
+
+    @staticmethod
+    def read(data: bytes, pos: int):
+        return _read_int(data, pos)
+
+
+class _StrCodec:
+    @staticmethod
+    def write(out: bytearray, value: str) -> None:
+        raw = value.encode()
+        _write_int(out, len(raw))
+        out += raw
+
+    @staticmethod
+    def read(data: bytes, pos: int):
+        size, pos = _read_int(data, pos)
+        return data[pos : pos + size].decode(), pos + size
+
+
+def _codec(annotation):
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return _EnumCodec(annotation)
+    if annotation is int:
+        return _IntCodec
+    if annotation is str:
+        return _StrCodec
+    raise TypeError(f"{annotation!r} can not be packed compactly")
+
+
+class CompactCallbackData(CallbackData, prefix="compact"):
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        cls.__legacy_prefix__ = kwargs.pop("legacy", None)
+        super().__init_subclass__(**kwargs)
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs: Any) -> None:
+        super().__pydantic_init_subclass__(**kwargs)
+        cls.__codecs__: List[Tuple[str, Any]] = [
+            (name, _codec(field.annotation)) for name, field in cls.model_fields.items()
+        ]
+        cls.__head__ = cls.__prefix__ + cls.__separator__
+        # в legacy-формате могут отсутствовать хвостовые поля со значением
+        # по умолчанию: кнопки отправлены до того, как поля добавили
+        required = [
+            i
+            for i, field in enumerate(cls.model_fields.values())
+            if field.is_required()
+        ]
+        cls.__min_legacy_parts__ = required[-1] + 1 if required else 0
+
+    def pack(self) -> str:
+        out = bytearray()
+        for name, codec in self.__codecs__:
+            codec.write(out, getattr(self, name))
+        callback_data = self.__head__ + base64.urlsafe_b64encode(out).decode().rstrip(
+            "="
+        )
+        if len(callback_data.encode()) > MAX_CALLBACK_LENGTH:
+            raise ValueError(f"Resulted callback data is too long: {callback_data!r}")
+        return callback_data
+
+    @classmethod
+    def unpack(cls: Type[T], value: str) -> T:
+        if not value.startswith(cls.__head__):
+            legacy = cls.__legacy_prefix__
+            if legacy and value.startswith(legacy + ":"):
+                parts = value.split(":")[1:]
+                if cls.__min_legacy_parts__ <= len(parts) <= len(cls.__codecs__):
+                    # старый текстовый формат разбирает pydantic
+                    return cls(**dict(zip(cls.model_fields, parts)))
+            raise ValueError(f"Bad prefix for {cls.__name__}: {value!r}")
+        payload = value[len(cls.__head__) :]
+        try:
+            # быстрее base64.urlsafe_b64decode, который перекодирует через bytes
+            data = binascii.a2b_base64(
+                payload.translate(_FROM_URLSAFE) + "=" * (-len(payload) % 4)
+            )
+            values: Dict[str, Any] = {}
+            pos = 0
+            for name, codec in cls.__codecs__:
+                values[name], pos = codec.read(data, pos)
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"Malformed {cls.__name__}: {value!r}") from e
+        if pos != len(data):
+            raise ValueError(f"Malformed {cls.__name__}: {value!r}")
+        # значения уже нужных типов: валидация pydantic не нужна
+        return cls.model_construct(**values)
+
+    @classmethod
+    def filter(cls, rule: Optional[MagicFilter] = None) -> CallbackQueryFilter:
+        return CompactCallbackFilter(callback_data=cls, rule=rule)
+
+
+class CompactCallbackFilter(CallbackQueryFilter):
+    """CallbackQueryFilter, который отсеивает чужие callback без unpack."""
+
+    async def __call__(
+        self, query: CallbackQuery
+    ) -> Union[Literal[False], Dict[str, Any]]:
+        if not isinstance(query, CallbackQuery) or not query.data:
+            return False
+        callback_data = self.callback_data
+        if not query.data.startswith(callback_data.__head__):
+            legacy = callback_data.__legacy_prefix__
+            if not (legacy and query.data.startswith(legacy + ":")):
+                return False
+        return await super().__call__(query)
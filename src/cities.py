@@ -0,0 +1,406 @@
+"""Распознавание введённых пользователем городов.
+
+Раньше каждый вариант написания («Москва», «москва », «Moskva») становился
+отдельной строкой user_cities, а матчинг сравнивает id. CityIndex держит в
+памяти нормализованные названия City и известных UserCity: точное совпадение
+ключа возвращает уже существующую строку, иначе по триграммам и префиксу
+подбираются top-K похожих вариантов для inline-подсказок.
+
+Ключ нормализации: нижний регистр, ё -> е, транслитерация кириллицы в
+латиницу, всё кроме букв и цифр — пробел, пробелы схлопнуты. Индекс
+догружает новые строки раз в CITY_INDEX_REFRESH секунд (строки из других
+процессов), свои добавления видны сразу.
+
+CityHierarchy сводит алиасы к справочнику для матчинга: алиас -> City ->
+Country. Таблица целиком в памяти и перечитывается с тем же интервалом,
+так что поиск совпадений по городу или стране не добавляет JOIN в запросы.
+"""
+import asyncio
+import logging
+import math
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import dataclass
+from os import getenv
+from typing import Dict, FrozenSet, List, Optional, Set
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+from database import City, UserCity, after_rollback, async_session_maker, upsert
+
+load_dotenv()
+CITY_INDEX_REFRESH = float(getenv("CITY_INDEX_REFRESH", "60"))
+CITY_SUGGESTIONS = int(getenv("CITY_SUGGESTIONS", "5"))
+# ниже этой похожести (коэффициент Дайса по триграммам) вариант не предлагается
+CITY_MIN_SIMILARITY = float(getenv("CITY_MIN_SIMILARITY", "0.4"))
+# сколько названий подсказка проверяет не больше (плюс одна триграмма)
+CITY_SUGGEST_CANDIDATES = int(getenv("CITY_SUGGEST_CANDIDATES", "5000"))
+# с какой точностью совпадают направления — одна настройка для всех заявок,
+# без отката на более грубую, если точных совпадений нет: alias — одна строка
+# user_cities, city — один город справочника, country — одна страна; алиас
+# без города справочника всегда сравнивается сам по себе
+MATCH_GRANULARITY = getenv("MATCH_GRANULARITY", "alias")
+MATCH_GRANULARITIES = ("alias", "city", "country")
+
+_TRANSLIT = str.maketrans(
+    {
+        "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+        "ж": "zh", "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m",
+        "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+        "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+        "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "iu", "я": "ia",
+    }
+)  # fmt: skip
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(name: str) -> str:
+    return _SEPARATORS.sub(" ", name.lower().translate(_TRANSLIT)).strip()
+
+
+def trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass(frozen=True)
+class CityEntry:
+    key: str
+    name: str
+    # строка user_cities, на которую ссылаются заявки; None — город из
+    # справочника, для которого её ещё никто не создавал
+    user_city_id: Optional[int]
+    city_id: Optional[int]
+
+
+class CityIndex:
+    def __init__(
+        self,
+        refresh_interval: float = CITY_INDEX_REFRESH,
+        limit: int = CITY_SUGGESTIONS,
+        min_similarity: float = CITY_MIN_SIMILARITY,
+        max_candidates: int = CITY_SUGGEST_CANDIDATES,
+    ):
+        self.refresh_interval = refresh_interval
+        self.limit = limit
+        self.min_similarity = min_similarity
+        self.max_candidates = max_candidates
+        self._entries: List[CityEntry] = []
+        self._gram_counts: List[int] = []
+        self._by_key: Dict[str, int] = {}
+        self._by_user_city: Dict[int, int] = {}
+        self._by_city: Dict[int, int] = {}
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+        # сортируется лениво, перед поиском по префиксу: при загрузке
+        # справочника на сотни тысяч строк вставка по одной стоит O(n^2)
+        self._sorted_keys: List[str] = []
+        self._sorted = True
+        self._last_city_id = 0
+        self._last_user_city_id = 0
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def stats(self) -> dict:
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+    def add(self, entry: CityEntry) -> None:
+        existing = self._by_key.get(entry.key)
+        if existing is not None:
+            if entry.user_city_id is None:
+                return
+            # алиас пользователя важнее справочной записи: на него ссылаются
+            # заявки; из нескольких строк с одним ключом остаётся первая
+            if self._entries[existing].user_city_id is None:
+                self._entries[existing] = entry
+            self._by_user_city[entry.user_city_id] = existing
+            return
+        i = len(self._entries)
+        self._entries.append(entry)
+        grams = trigrams(entry.key)
+        self._gram_counts.append(len(grams))
+        for gram in grams:
+            self._postings[gram].append(i)
+        self._by_key[entry.key] = i
+        if entry.user_city_id is not None:
+            self._by_user_city[entry.user_city_id] = i
+        if entry.city_id is not None:
+            self._by_city.setdefault(entry.city_id, i)
+        self._sorted_keys.append(entry.key)
+        self._sorted = False
+
+    def get(self, user_city_id: int) -> Optional[CityEntry]:
+        i = self._by_user_city.get(user_city_id)
+        return None if i is None else self._entries[i]
+
+    def get_city(self, city_id: int) -> Optional[CityEntry]:
+        i = self._by_city.get(city_id)
+        return None if i is None else self._entries[i]
+
+    def lookup(self, text: str) -> Optional[CityEntry]:
+        i = self._by_key.get(normalize(text))
+        if i is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._entries[i]
+
+    def suggest(self, text: str, limit: int = None) -> List[CityEntry]:
+        """Похожие названия: сначала продолжения введённого, затем по триграммам."""
+        key = normalize(text)
+        limit = limit or self.limit
+        if not key:
+            return []
+        scores: Dict[int, float] = {}
+        if not self._sorted:
+            self._sorted_keys.sort()
+            self._sorted = True
+        start = bisect_left(self._sorted_keys, key)
+        for candidate in self._sorted_keys[start : start + limit]:
+            if not candidate.startswith(key):
+                break
+            scores[self._by_key[candidate]] = 1.0 + len(key) / len(candidate)
+
+        grams = trigrams(key)
+        # при похожести не ниже порога общих триграмм не меньше need, значит
+        # кандидат содержит хотя бы одну из len - need + 1 самых редких:
+        # частые триграммы не перебираются, найденные проверяются точно.
+        # На большом справочнике перебор ограничен CITY_SUGGEST_CANDIDATES
+        need = math.ceil(self.min_similarity * len(grams) / (2 - self.min_similarity))
+        rare = sorted(grams, key=lambda gram: len(self._postings.get(gram, ())))
+        candidates = set()
+        for gram in rare[: len(grams) - max(1, need) + 1]:
+            if len(candidates) >= self.max_candidates:
+                break
+            candidates.update(self._postings.get(gram, ()))
+        for i in candidates:
+            if i in scores:
+                continue
+            shared = len(grams & trigrams(self._entries[i].key))
+            similarity = 2 * shared / (len(grams) + self._gram_counts[i])
+            if similarity >= self.min_similarity:
+                scores[i] = similarity
+        best = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [self._entries[i] for i in best]
+
+    async def resolve(self, session, text: str, user_id: int) -> CityEntry:
+        """UserCity для введённого названия: существующий вариант или новая строка.
+
+        Вызывающий решает, предлагать ли подсказки до вызова (см. suggest).
+        """
+        i = self._by_key.get(normalize(text))
+        if i is None:
+            return await self.create(session, text.strip(), user_id)
+        return await self.choose(session, self._entries[i], user_id)
+
+    async def choose(self, session, entry: CityEntry, user_id: int) -> CityEntry:
+        """UserCity для известного индексу варианта (в том числе из подсказок)."""
+        if entry.user_city_id is not None:
+            return entry
+        # город есть в справочнике — заводим для него алиас с тем же названием
+        return await self.create(session, entry.name, user_id, entry.city_id)
+
+    async def create(
+        self, session, name: str, user_id: int, city_id: int = None
+    ) -> CityEntry:
+        defaults = {"created_by_id": user_id}
+        if city_id is not None:
+            defaults["city_id"] = city_id
+        user_city, _ = await upsert(session, UserCity, defaults=defaults, name=name)
+        entry = CityEntry(
+            normalize(name), user_city.name, user_city.id, user_city.city_id
+        )
+        # в индекс сразу: следующий ввод того же варианта не создаст строку
+        self.add(entry)
+        if entry.city_id is not None:
+            await city_hierarchy.link(session, entry.user_city_id, entry.city_id)
+        after_rollback(session, lambda: self._forget(entry))
+        return entry
+
+    def _forget(self, entry: CityEntry) -> None:
+        # строка откатилась: название остаётся в индексе, но без user_cities
+        i = self._by_user_city.pop(entry.user_city_id, None)
+        if i is not None and self._entries[i] == entry:
+            self._entries[i] = CityEntry(entry.key, entry.name, None, entry.city_id)
+
+    async def refresh(self) -> int:
+        """Догружает строки City и UserCity, появившиеся с прошлого раза."""
+        async with async_session_maker() as session:
+            cities = await session.execute(
+                select(City.id, City.name)
+                .filter(City.id > self._last_city_id)
+                .order_by(City.id)
+            )
+            cities = cities.all()
+            user_cities = await session.execute(
+                select(UserCity.id, UserCity.name, UserCity.city_id)
+                .filter(UserCity.id > self._last_user_city_id)
+                .order_by(UserCity.id)
+            )
+            user_cities = user_cities.all()
+        for city_id, name in cities:
+            self.add(CityEntry(normalize(name), name, None, city_id))
+            self._last_city_id = city_id
+        for user_city_id, name, city_id in user_cities:
+            self.add(CityEntry(normalize(name), name, user_city_id, city_id))
+            self._last_user_city_id = user_city_id
+        return len(cities) + len(user_cities)
+
+    async def start(self) -> None:
+        await self.refresh()
+        logging.info("city index: %s names", len(self))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("city index refresh failed")
+
+
+class CityHierarchy:
+    """Ключ направления для матчинга: алиас -> City -> Country.
+
+    Заявки ссылаются на user_cities. При MATCH_GRANULARITY=city алиасы одного
+    города получают общий ключ «c<city_id>», при country алиасы городов одной
+    страны — «k<country_id>». Ключи есть только у алиасов, привязанных к
+    справочнику, остальные совпадают лишь сами с собой.
+    """
+
+    def __init__(
+        self,
+        granularity: str = MATCH_GRANULARITY,
+        refresh_interval=CITY_INDEX_REFRESH,
+    ):
+        if granularity not in MATCH_GRANULARITIES:
+            raise ValueError(
+                f"MATCH_GRANULARITY must be one of {MATCH_GRANULARITIES}: "
+                f"{granularity!r}"
+            )
+        self.granularity = granularity
+        self.refresh_interval = refresh_interval
+        self._country_of: Dict[int, int] = {}
+        self._key: Dict[int, str] = {}
+        self._members: Dict[str, Set[int]] = defaultdict(set)
+        self._task = None
+
+    def stats(self) -> dict:
+        return {"aliases": len(self._key), "keys": len(self._members)}
+
+    def _city_key(self, city_id: int) -> Optional[str]:
+        if self.granularity == "city":
+            return f"c{city_id}"
+        country_id = self._country_of.get(city_id)
+        return None if country_id is None else f"k{country_id}"
+
+    async def link(self, session, user_city_id: int, city_id: int) -> None:
+        """Привязка алиаса к городу, созданная этим процессом."""
+        if self.granularity == "alias":
+            return
+        if self.granularity == "country" and city_id not in self._country_of:
+            # страны знаем только у привязанных городов, новый спрашиваем
+            self._country_of[city_id] = await session.scalar(
+                select(City.country_id).filter(City.id == city_id)
+            )
+        key = self._city_key(city_id)
+        if key is None or self._key.get(user_city_id) == key:
+            return
+        old = self._key.get(user_city_id)
+        if old is not None:
+            self._members[old].discard(user_city_id)
+        self._key[user_city_id] = key
+        self._members[key].add(user_city_id)
+
+    def members(self, user_city_id: int) -> FrozenSet[int]:
+        """Алиасы, совпадающие с данным при MATCH_GRANULARITY, включая его самого."""
+        key = self._key.get(user_city_id)
+        if key is None:
+            return frozenset((user_city_id,))
+        return frozenset(self._members[key])
+
+    def route_keys(self) -> Dict[int, str]:
+        """Ключи привязанных алиасов: {user_city_id: ключ}."""
+        return dict(self._key)
+
+    async def refresh(self) -> None:
+        if self.granularity == "alias":
+            return
+        # только привязанные алиасы; страна нужна лишь при country и
+        # берётся соединением с их городами, а не всем справочником
+        async with async_session_maker() as session:
+            if self.granularity == "country":
+                rows = await session.execute(
+                    select(UserCity.id, UserCity.city_id, City.country_id).join(
+                        City, City.id == UserCity.city_id
+                    )
+                )
+                rows = rows.all()
+                aliases = [(user_city_id, city_id) for user_city_id, city_id, _ in rows]
+                countries = {city_id: country_id for _, city_id, country_id in rows}
+            else:
+                rows = await session.execute(
+                    select(UserCity.id, UserCity.city_id).filter(
+                        UserCity.city_id.is_not(None)
+                    )
+                )
+                aliases, countries = rows.all(), {}
+        # собираем заново и подменяем целиком: привязки могли поменяться
+        self._country_of = countries
+        keys: Dict[int, str] = {}
+        members: Dict[str, Set[int]] = defaultdict(set)
+        for user_city_id, city_id in aliases:
+            key = self._city_key(city_id)
+            if key is not None:
+                keys[user_city_id] = key
+                members[key].add(user_city_id)
+        self._key, self._members = keys, members
+
+    async def start(self) -> None:
+        if self.granularity == "alias":
+            return
+        await self.refresh()
+        logging.info(
+            "city hierarchy: %s linked aliases, match granularity %s",
+            len(self._key),
+            self.granularity,
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("city hierarchy refresh failed")
+
+
+city_index = CityIndex()
+city_hierarchy = CityHierarchy()
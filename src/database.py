@@ -1,40 +1,151 @@
 import enum
+import logging
 from datetime import date, datetime
+from functools import lru_cache
 from os import getenv
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from uuid import uuid4
 
 from dotenv import load_dotenv
 from sqlalchemy import (
     BigInteger,
+    Computed,
     Date,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     UniqueConstraint,
+    bindparam,
+    event,
     func,
-    insert,
-    select,
+    literal_column,
+    text,
 )
-from sqlalchemy.dialects.postgresql import JSON
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy.dialects.postgresql import ARRAY, DATERANGE, JSONB, Range
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
+    Session,
     mapped_column,
     relationship,
     sessionmaker,
 )
+from sqlalchemy.pool import NullPool
 
 load_dotenv()
 DATABASE_URL = getenv("DATABASE_URL")
+# DB_POOL_SIZE=0 — без пула (NullPool), соединения держит pgbouncer
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = getenv("DB_POOL_PRE_PING", "0") == "1"
+# кеш подготовленных выражений на соединение (asyncpg и диалект SQLAlchemy)
+DB_STATEMENT_CACHE_SIZE = int(getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# параметры сервера на соединение; пусто — как настроено в Postgres
+DB_JIT = getenv("DB_JIT")
+DB_STATEMENT_TIMEOUT = getenv("DB_STATEMENT_TIMEOUT")
+# pgbouncer в режиме transaction: соседние транзакции клиента попадают
+# на разные серверные соединения, подготовленные выражения там не живут
+DB_PGBOUNCER = getenv("DB_PGBOUNCER", "0") == "1"
+
+
+def _statement_name() -> str:
+    return f"__asyncpg_{uuid4().hex}__"
+
+
+def make_engine(
+    url: str = DATABASE_URL,
+    pool_size: int = DB_POOL_SIZE,
+    max_overflow: int = DB_MAX_OVERFLOW,
+    pool_timeout: float = DB_POOL_TIMEOUT,
+    pool_recycle: int = DB_POOL_RECYCLE,
+    pool_pre_ping: bool = DB_POOL_PRE_PING,
+    statement_cache_size: int = DB_STATEMENT_CACHE_SIZE,
+    jit: Optional[str] = DB_JIT,
+    statement_timeout: Optional[str] = DB_STATEMENT_TIMEOUT,
+    pgbouncer: bool = DB_PGBOUNCER,
+):
+    """AsyncEngine с настройками пула и asyncpg из окружения.
+
+    pgbouncer=True отключает кеши подготовленных выражений и даёт им
+    уникальные имена. jit и statement_timeout pgbouncer не пропускает
+    в параметрах подключения — их задают через ALTER ROLE ... SET.
+    """
+    connect_args = {}
+    server_settings = {}
+    if jit:
+        server_settings["jit"] = jit
+    if statement_timeout:
+        server_settings["statement_timeout"] = statement_timeout
+
+    if pgbouncer:
+        statement_cache_size = 0
+        connect_args["prepared_statement_name_func"] = _statement_name
+        if server_settings:
+            logging.warning(
+                "DB_PGBOUNCER: %s ignored, set them with ALTER ROLE",
+                ", ".join(server_settings),
+            )
+            server_settings = {}
+    connect_args["statement_cache_size"] = statement_cache_size
+    connect_args["prepared_statement_cache_size"] = statement_cache_size
+    if server_settings:
+        connect_args["server_settings"] = server_settings
+
+    if pool_size <= 0:
+        pool_args = {"poolclass": NullPool}
+    else:
+        pool_args = {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "pool_timeout": pool_timeout,
+        }
+    return create_async_engine(
+        url,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        connect_args=connect_args,
+        **pool_args,
+    )
 
 
-engine = create_async_engine(DATABASE_URL)
+engine = make_engine()
 
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+def after_commit(session, callback) -> None:
+    """Вызвать callback() после успешного коммита транзакции session.
+
+    Для побочных эффектов в памяти (индекс матчинга, кеши), которые не должны
+    опережать данные в базе. При откате callback отбрасывается.
+    """
+    session.info.setdefault("after_commit", []).append(callback)
+
+
+def after_rollback(session, callback) -> None:
+    """Вызвать callback() при откате транзакции session (при коммите — нет)."""
+    session.info.setdefault("after_rollback", []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session) -> None:
+    session.info.pop("after_rollback", None)
+    for callback in session.info.pop("after_commit", ()):
+        callback()
+
+
+@event.listens_for(Session, "after_rollback")
+def _run_after_rollback(session) -> None:
+    session.info.pop("after_commit", None)
+    for callback in session.info.pop("after_rollback", ()):
+        callback()
+
+
 class Base(DeclarativeBase):
     id: Mapped[int] = mapped_column(primary_key=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
@@ -70,7 +181,7 @@ class Sender(Base):
     __table_args__ = (UniqueConstraint("user_id"),)
 
 
-# TODO может быть наоброт порядок
+# порядок членов задаёт биты Request.baggage_mask: новые виды — только в конец
 class BaggageKind(enum.StrEnum):
     usual = "usual"
     liquid = "liquid"
@@ -83,11 +194,36 @@ class BaggageKind(enum.StrEnum):
 RU_LABELS = {
     BaggageKind.usual: "Обычный",
     BaggageKind.liquid: "Жидкость",
+    BaggageKind.expensive: "Ценный",
     BaggageKind.document: "Документ",
     BaggageKind.troublesome: "Проблемный",
-    BaggageKind.usual: "Обычный",
+    BaggageKind.other: "Другое",
 }
 
+BAGGAGE_BITS = {kind: 1 << i for i, kind in enumerate(BaggageKind)}
+# форма хранит русские названия (значения my_keyboards.BaggageKinds)
+_BAGGAGE_BY_NAME = {
+    **{label: kind for kind, label in RU_LABELS.items()},
+    **{kind.value: kind for kind in BaggageKind},
+}
+# названия для каждой маски заранее: карточки не разбирают поле по видам
+_BAGGAGE_LABELS = [
+    tuple(RU_LABELS[kind] for kind in BaggageKind if mask & BAGGAGE_BITS[kind])
+    for mask in range(1 << len(BaggageKind))
+]
+
+
+def baggage_mask(kinds) -> int:
+    """Маска видов багажа по значениям BaggageKind или русским названиям."""
+    mask = 0
+    for kind in kinds:
+        mask |= BAGGAGE_BITS[_BAGGAGE_BY_NAME[kind]]
+    return mask
+
+
+def baggage_labels(mask: int) -> Tuple[str, ...]:
+    return _BAGGAGE_LABELS[mask]
+
 
 class VolumeKind(enum.Enum):
     kilo = 1
@@ -103,6 +239,13 @@ class Status(enum.Enum):
     fulfilled = 5
 
 
+# daterange(NULL, NULL) — бесконечный период, поэтому у заявок курьеров period NULL
+PERIOD_EXPRESSION = (
+    "CASE WHEN date_from IS NOT NULL AND date_to IS NOT NULL "
+    "THEN daterange(date_from, date_to, '[]') END"
+)
+
+
 class Request(Base):
     __tablename__ = "requests"
     sender_id: Mapped[int] = mapped_column(ForeignKey("senders.id"), nullable=True)
@@ -121,9 +264,83 @@ class Request(Base):
     date: Mapped[date] = mapped_column(Date, nullable=True)
     date_to: Mapped[date] = mapped_column(Date, nullable=True)
     date_from: Mapped[date] = mapped_column(Date, nullable=True)
-    baggage_types: Mapped[list] = mapped_column(JSON, nullable=False)
+    period: Mapped[Optional[Range]] = mapped_column(
+        DATERANGE, Computed(PERIOD_EXPRESSION), nullable=True
+    )
+    # виды багажа битами BAGGAGE_BITS; курьер берёт заявку отправителя, если
+    # courier_mask & sender_mask = sender_mask
+    baggage_mask: Mapped[int] = mapped_column(nullable=False, server_default="0")
     comment: Mapped[str] = mapped_column()
     status: Mapped[str] = mapped_column(Enum(Status))
+    # у заявки отправителя: id заявок курьеров, о которых уже уведомили
+    notified_request_ids: Mapped[List[int]] = mapped_column(
+        ARRAY(BigInteger), nullable=False, server_default="{}"
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_requests_route_date",
+            "origin_id",
+            "destination_id",
+            "date",
+            postgresql_where=text("date IS NOT NULL"),
+        ),
+        Index(
+            "ix_requests_route_period",
+            "origin_id",
+            "destination_id",
+            "period",
+            postgresql_using="gist",
+            postgresql_where=text("period IS NOT NULL"),
+        ),
+    )
+
+
+class Outbox(Base):
+    """Исходящее сообщение, записанное в одной транзакции с изменением данных.
+
+    send_key идентифицирует логическое уведомление: повторная запись того же
+    ключа игнорируется. Строку отправляет OutboxDrainer (см. outbox.py).
+    """
+
+    __tablename__ = "outbox"
+    send_key: Mapped[str]
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str]
+    attempts: Mapped[int] = mapped_column(server_default="0")
+    # раньше этого момента строку не берут: аренда у отправителя или пауза
+    available_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint("send_key"),
+        Index(
+            "ix_outbox_pending",
+            "available_at",
+            postgresql_where=text("sent_at IS NULL"),
+        ),
+        # для удаления отправленных строк старше OUTBOX_RETENTION
+        Index(
+            "ix_outbox_sent",
+            "sent_at",
+            postgresql_where=text("sent_at IS NOT NULL"),
+        ),
+    )
+
+
+class FsmState(Base):
+    """Состояние и данные FSM aiogram (см. fsm_storage.py)."""
+
+    __tablename__ = "fsm_states"
+    # bot_id:chat_id:user_id:thread_id:destiny
+    key: Mapped[str]
+    state: Mapped[Optional[str]]
+    data: Mapped[dict] = mapped_column(JSONB, server_default="{}")
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, server_default=func.now(), index=True
+    )
+
+    __table_args__ = (UniqueConstraint("key"),)
 
 
 class Country(Base):
@@ -144,6 +361,12 @@ class City(Base):
     __table_args__ = (UniqueConstraint("name"),)
 
 
+# страницы выбора страны и города (см. my_keyboards.py): keyset и префиксы
+# по name COLLATE "C"
+Index("ix_countries_name_c", Country.name.collate("C"))
+Index("ix_cities_country_name", City.country_id, City.name.collate("C"))
+
+
 class UserCity(Base):
     __tablename__ = "user_cities"
     name: Mapped[str]
@@ -154,20 +377,59 @@ class UserCity(Base):
     __table_args__ = (UniqueConstraint("name"),)
 
 
-async def get_or_create(session, model, defaults=None, **kwargs):
+async def upsert(session, model, defaults=None, **kwargs):
+    """Атомарный get_or_create одним запросом.
+
+    kwargs — колонки уникального ограничения, defaults — значения только
+    для новой строки. ON CONFLICT DO UPDATE (а не DO NOTHING) нужен, чтобы
+    RETURNING вернул строку и при конфликте. Возвращает (instance, created).
+    Коммит за вызывающим (обычно DbSessionMiddleware в конце апдейта).
+    """
     if defaults is None:
         defaults = {}
 
-    try:
-        query = select(model).filter_by(**kwargs)
-        result = await session.execute(query)
-        instance = result.scalars().one()
-        return instance, False
-
-    except NoResultFound:
-        params = {**kwargs, **defaults}
-        query = insert(model).values(**params).returning(model)
-        result = await session.execute(query)
-        await session.commit()
-        instance = result.scalars().one()
-        return instance, True
+    query = _upsert_statement(model, tuple(kwargs), tuple(defaults))
+    result = await session.execute(query, {**kwargs, **defaults})
+    instance, created = result.one()
+    return instance, created
+
+
+async def upsert_many(session, model, rows, index_elements):
+    """upsert для многих строк одним запросом.
+
+    rows — словари с одинаковым набором ключей, index_elements — колонки
+    уникального ограничения; остальные колонки пишутся только в новые
+    строки, как defaults у upsert. Повторы ключа внутри пачки отбрасываются:
+    Postgres не даёт ON CONFLICT DO UPDATE задеть одну строку дважды.
+    Возвращает {кортеж значений index_elements: (instance, created)}.
+    Коммит за вызывающим.
+    """
+    unique_rows = {}
+    for row in rows:
+        unique_rows.setdefault(tuple(row[key] for key in index_elements), row)
+    if not unique_rows:
+        return {}
+    query = pg_insert(model).values(list(unique_rows.values()))
+    query = query.on_conflict_do_update(
+        index_elements=list(index_elements),
+        set_={key: query.excluded[key] for key in index_elements},
+    ).returning(model, literal_column("xmax = 0").label("created"))
+    result = await session.execute(query)
+    return {
+        tuple(getattr(instance, key) for key in index_elements): (instance, created)
+        for instance, created in result.all()
+    }
+
+
+@lru_cache(maxsize=None)
+def _upsert_statement(model, keys, default_keys):
+    # выражение строится один раз на набор колонок, значения — bindparam:
+    # ключ кеша компиляции SQLAlchemy и подготовленное выражение asyncpg
+    # тоже общие для всех вызовов
+    query = pg_insert(model).values(
+        {key: bindparam(key) for key in keys + default_keys}
+    )
+    return query.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={key: query.excluded[key] for key in keys},
+    ).returning(model, literal_column("xmax = 0").label("created"))
@@ -0,0 +1,29 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+
+from database import async_session_maker
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна AsyncSession на апдейт: хендлеры получают её аргументом session.
+
+    Соединение берётся из пула при первом запросе, коммит — один, после
+    хендлера; если хендлер упал, транзакция откатывается.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with async_session_maker() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
@@ -0,0 +1,314 @@
+"""FSM-хранилище aiogram в Postgres с LRU-кешем в памяти.
+
+Каждое изменение сразу пишется в таблицу fsm_states (write-through), поэтому
+незаконченные формы переживают перезапуск. Чтения обслуживает кеш
+последних FSM_CACHE_SIZE ключей. Диалоги, которые не менялись дольше
+FSM_TTL, считаются брошенными: из кеша и базы они удаляются периодической
+чисткой, а до неё просто не читаются.
+
+Кеш корректен, пока апдейты одного чата обрабатывает один процесс (polling,
+вебхук с одним экземпляром, режим sharded). Иначе FSM_CACHE_SIZE=0.
+
+FSMUnitOfWorkMiddleware пишет изменения апдейта в транзакции его сессии
+(DbSessionMiddleware): состояние формы и созданные хендлером строки
+коммитятся вместе, и после падения между ними форма не пройдёт шаг дважды.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from os import getenv
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from dotenv import load_dotenv
+from sqlalchemy import String, cast, delete, func, literal, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import FsmState, after_commit, async_session_maker
+
+load_dotenv()
+FSM_CACHE_SIZE = int(getenv("FSM_CACHE_SIZE", "10000"))
+FSM_TTL = float(getenv("FSM_TTL", str(24 * 3600)))
+FSM_SWEEP_INTERVAL = float(getenv("FSM_SWEEP_INTERVAL", "600"))
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.destiny}"
+
+
+def _jsonb(data: dict):
+    # без \uXXXX-экранирования: вдвое компактнее для кириллицы и принимается
+    # базой в кодировке SQL_ASCII (JSONB там отвергает \u-последовательности)
+    return cast(literal(json.dumps(data, ensure_ascii=False), String), JSONB)
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(
+        self,
+        maxsize: int = FSM_CACHE_SIZE,
+        ttl: float = FSM_TTL,
+        sweep_interval: float = FSM_SWEEP_INTERVAL,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # ключ -> (state, data, время последней записи по time.monotonic())
+        self._cache: "OrderedDict[str, Tuple[Optional[str], dict, float]]" = (
+            OrderedDict()
+        )
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.expired = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "expired": self.expired,
+        }
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def active_chats(self, limit: int) -> Dict[int, str]:
+        """chat_id -> имя из незаконченных форм, самые свежие первыми.
+
+        По ним при старте прогревается кеш пользователей: эти чаты, скорее
+        всего, напишут первыми.
+        """
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(FsmState.key, FsmState.data["name"].astext)
+                .filter(
+                    FsmState.state.is_not(None),
+                    FsmState.updated_at > func.now() - timedelta(seconds=self.ttl),
+                )
+                .order_by(FsmState.updated_at.desc())
+                .limit(limit)
+            )
+            rows = result.all()
+        chats = {}
+        for db_key, name in rows:
+            chat_id = int(db_key.split(":")[1])
+            chats.setdefault(chat_id, name or "")
+        return chats
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._get(key)
+        await self._write(key, state, data, {"state": state})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._get(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._get(key)
+        await self._write(key, state, data.copy(), {"data": _jsonb(data)})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._get(key)
+        return data.copy()
+
+    async def write(
+        self, key: StorageKey, state: StateType, data: Dict[str, Any], session=None
+    ):
+        """set_state и set_data одной записью.
+
+        С session запись идёт в её транзакции, коммит за вызывающим; кеш
+        обновляется после коммита.
+        """
+        state = state.state if isinstance(state, State) else state
+        await self._write(
+            key, state, data.copy(), {"state": state, "data": _jsonb(data)}, session
+        )
+
+    def _remember(self, key: str, state, data, written_at: float) -> None:
+        if self.maxsize <= 0:
+            return
+        self._cache[key] = (state, data, written_at)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _get(self, key: StorageKey) -> Tuple[Optional[str], dict]:
+        db_key = _key(key)
+        item = self._cache.get(db_key)
+        if item is not None:
+            state, data, written_at = item
+            if time.monotonic() - written_at < self.ttl:
+                self.hits += 1
+                self._cache.move_to_end(db_key)
+                return state, data
+            del self._cache[db_key]
+            self.expired += 1
+            return None, {}
+
+        self.misses += 1
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(
+                    FsmState.state,
+                    FsmState.data,
+                    func.extract("epoch", func.now() - FsmState.updated_at),
+                ).filter(FsmState.key == db_key)
+            )
+            row = result.first()
+        if row is None:
+            # отсутствие тоже кешируем: новый чат не ходит в базу на каждое чтение
+            self._remember(db_key, None, {}, time.monotonic())
+            return None, {}
+        state, data, age = row
+        if age >= self.ttl:
+            self.expired += 1
+            self._remember(db_key, None, {}, time.monotonic())
+            return None, {}
+        self._remember(db_key, state, data, time.monotonic() - float(age))
+        return state, data
+
+    async def _write(
+        self, key: StorageKey, state, data, changes: dict, session=None
+    ) -> None:
+        db_key = _key(key)
+        query = pg_insert(FsmState).values(key=db_key, state=state, data=_jsonb(data))
+        query = query.on_conflict_do_update(
+            index_elements=["key"], set_={**changes, "updated_at": func.now()}
+        )
+
+        def written() -> None:
+            self.writes += 1
+            self._remember(db_key, state, data, time.monotonic())
+
+        if session is not None:
+            await session.execute(query)
+            after_commit(session, written)
+            return
+        async with async_session_maker() as session:
+            await session.execute(query)
+            await session.commit()
+        written()
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                async with async_session_maker() as session:
+                    result = await session.execute(
+                        delete(FsmState).filter(
+                            FsmState.updated_at
+                            < func.now() - timedelta(seconds=self.ttl)
+                        )
+                    )
+                    await session.commit()
+                if result.rowcount:
+                    logging.info("fsm: %s idle conversations expired", result.rowcount)
+            except Exception:
+                logging.exception("fsm sweep failed")
+            deadline = time.monotonic() - self.ttl
+            for db_key in [k for k, v in self._cache.items() if v[2] < deadline]:
+                del self._cache[db_key]
+
+
+class UnitOfWorkFSMContext(FSMContext):
+    """FSMContext, который копит изменения апдейта в памяти.
+
+    Состояние берётся из raw_state (его уже прочитал FSMContextMiddleware),
+    данные загружаются при первом обращении. flush() записывает всё
+    изменённое одним вызовом хранилища.
+    """
+
+    def __init__(self, context: FSMContext, raw_state: Optional[str]):
+        super().__init__(storage=context.storage, key=context.key)
+        self._state = raw_state
+        self._data: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def get_state(self) -> Optional[str]:
+        return self._state
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self._data = data.copy()
+        self._data_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data.copy()
+
+    async def update_data(
+        self, data: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        self._data.update(kwargs)
+        self._data_dirty = True
+        return self._data.copy()
+
+    async def flush(self, session=None) -> None:
+        """Записывает изменения; session — транзакция апдейта (см. write)."""
+        if not self._state_dirty and not self._data_dirty:
+            return
+        if hasattr(self.storage, "write"):
+            if self._data is None:
+                # данные уже в кеше хранилища: state прочитан тем же ключом
+                self._data = await self.storage.get_data(key=self.key)
+            await self.storage.write(self.key, self._state, self._data, session)
+        else:
+            if self._state_dirty:
+                await self.storage.set_state(key=self.key, state=self._state)
+            if self._data_dirty:
+                await self.storage.set_data(key=self.key, data=self._data)
+        self._state_dirty = self._data_dirty = False
+
+
+class FSMUnitOfWorkMiddleware(BaseMiddleware):
+    """Подменяет state на UnitOfWorkFSMContext и сбрасывает его после хендлера.
+
+    Регистрируется на dp.update после DbSessionMiddleware: изменения FSM
+    пишутся в сессию апдейта до её коммита. Если хендлер упал, они
+    отбрасываются вместе с транзакцией.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+        uow = UnitOfWorkFSMContext(context, data.get("raw_state"))
+        data["state"] = uow
+        result = await handler(event, data)
+        await uow.flush(data.get("session"))
+        return result
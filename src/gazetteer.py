@@ -0,0 +1,305 @@
+"""Импорт справочника стран и городов из CSV/TSV.
+
+    python src/gazetteer.py cities500.txt --city 1 --country 8 \\
+        --country-info countryInfo.txt
+    python src/gazetteer.py cities.csv --delimiter , --header \\
+        --city name --country country
+
+Колонки задаются номером (с нуля) или, с --header, названием. Для выгрузок
+GeoNames страна в файле городов — ISO-код, названия берутся из
+countryInfo.txt (--country-info).
+
+Файл читается потоком пачками по GAZETTEER_BATCH строк. Пачка уходит через
+COPY (copy_records_to_table) во временную таблицу и сливается в
+countries/cities через INSERT ... ON CONFLICT DO NOTHING; следующая пачка
+читается, пока сливается текущая. В памяти не больше двух пачек, так что
+размер файла не важен. Каждая пачка — своя транзакция: прерванный импорт
+можно запустить заново, загруженные строки пропустятся.
+
+Названия городов уникальны во всей таблице (cities_name_key): из одноимённых
+городов разных стран остаётся первый. Запущенный бот подхватит новые города
+при обновлении CityIndex. Кеш клавиатур выбора сбрасывается сразу: пачка
+в своей транзакции шлёт NOTIFY gazetteer, GazetteerListener бота инвалидирует
+страны и города тех стран, куда что-то добавилось.
+"""
+import argparse
+import asyncio
+import csv
+import logging
+import sys
+import time
+from itertools import islice
+from os import getenv
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from database import DB_PGBOUNCER, engine
+
+load_dotenv()
+GAZETTEER_BATCH = int(getenv("GAZETTEER_BATCH", "50000"))
+GAZETTEER_CHANNEL = "gazetteer"
+# пауза перед повторным подключением слушателя растёт вдвое до этого предела
+GAZETTEER_RECONNECT_MAX = float(getenv("GAZETTEER_RECONNECT_MAX", "60"))
+
+# ON COMMIT DROP: таблица живёт одну транзакцию, это работает и через
+# pgbouncer в режиме transaction
+CREATE_STAGING = """
+CREATE TEMP TABLE gazetteer_staging (n bigint, country text, city text)
+ON COMMIT DROP
+"""
+
+MERGE_COUNTRIES = """
+INSERT INTO countries (name, created_at)
+SELECT DISTINCT country, now() FROM gazetteer_staging
+ON CONFLICT (name) DO NOTHING
+"""
+
+# из одноимённых городов пачки берётся первый по порядку в файле; возвращает
+# число новых городов и страны, в которые они добавлены
+MERGE_CITIES = """
+WITH inserted AS (
+    INSERT INTO cities (name, country_id, created_at)
+    SELECT DISTINCT ON (s.city) s.city, c.id, now()
+    FROM gazetteer_staging s
+    JOIN countries c ON c.name = s.country
+    ORDER BY s.city, s.n
+    ON CONFLICT (name) DO NOTHING
+    RETURNING country_id
+)
+SELECT count(*), coalesce(array_agg(DISTINCT country_id), '{}') FROM inserted
+"""
+
+# уходит подписчикам при коммите транзакции пачки
+NOTIFY = "SELECT pg_notify($1, $2)"
+
+
+def _column(spec: str, header: Optional[List[str]]) -> int:
+    if spec.isdigit():
+        return int(spec)
+    if header is None:
+        raise SystemExit(f"column {spec!r} by name needs --header")
+    try:
+        return header.index(spec)
+    except ValueError:
+        raise SystemExit(f"no column {spec!r} in header: {header}") from None
+
+
+def load_country_info(path: str) -> Dict[str, str]:
+    """ISO-код -> название страны из countryInfo.txt GeoNames."""
+    names = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if row and not row[0].startswith("#") and len(row) > 4:
+                names[row[0]] = row[4]
+    return names
+
+
+def read_rows(
+    f,
+    city: str,
+    country: str,
+    delimiter: str = "\t",
+    header: bool = False,
+    country_names: Optional[Dict[str, str]] = None,
+) -> Iterator[Tuple[int, str, str]]:
+    """Строки (номер, страна, город) без пустых значений."""
+    # в TSV кавычки — часть значения (alternatenames GeoNames), не экранирование
+    quoting = csv.QUOTE_NONE if delimiter == "\t" else csv.QUOTE_MINIMAL
+    reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
+    names = next(reader) if header else None
+    city_col, country_col = _column(city, names), _column(country, names)
+    width = max(city_col, country_col)
+    for n, row in enumerate(reader):
+        if len(row) <= width or row[0].startswith("#"):
+            continue
+        country_name = row[country_col].strip()
+        if country_names is not None:
+            country_name = country_names.get(country_name, "")
+        city_name = row[city_col].strip()
+        if country_name and city_name:
+            yield n, country_name, city_name
+
+
+def _rowcount(status: str) -> int:
+    # статус asyncpg: «INSERT 0 <строк>»
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def merge_batch(conn, batch) -> Tuple[int, int]:
+    """Загружает пачку в countries/cities, возвращает число новых строк."""
+    async with conn.transaction():
+        await conn.execute(CREATE_STAGING)
+        await conn.copy_records_to_table(
+            "gazetteer_staging", records=batch, columns=("n", "country", "city")
+        )
+        countries = _rowcount(await conn.execute(MERGE_COUNTRIES))
+        cities, country_ids = await conn.fetchrow(MERGE_CITIES)
+        if countries:
+            await conn.execute(NOTIFY, GAZETTEER_CHANNEL, "countries")
+        if cities:
+            payload = "cities:" + ",".join(map(str, sorted(country_ids)))
+            await conn.execute(NOTIFY, GAZETTEER_CHANNEL, payload)
+    return countries, cities
+
+
+class GazetteerListener:
+    """LISTEN gazetteer: сбрасывает кеш клавиатур после импорта справочника.
+
+    Держит отдельное соединение из пула. Через pgbouncer в режиме transaction
+    LISTEN не работает, там новые страны и города появятся после перезапуска.
+    Оборванное соединение переоткрывается с нарастающей паузой; уведомления
+    за время обрыва потеряны, поэтому после переподключения сбрасывается весь
+    кеш клавиатур.
+    """
+
+    def __init__(
+        self,
+        on_countries: Callable[[], None],
+        on_cities: Callable[[Optional[int]], None],
+        channel: str = GAZETTEER_CHANNEL,
+        reconnect_max: float = GAZETTEER_RECONNECT_MAX,
+    ):
+        self.on_countries = on_countries
+        self.on_cities = on_cities
+        self.channel = channel
+        self.reconnect_max = reconnect_max
+        self.events = 0
+        self.reconnects = 0
+        self._raw = None
+        self._reconnecting = None
+
+    async def start(self) -> None:
+        if DB_PGBOUNCER:
+            logging.info("DB_PGBOUNCER: gazetteer imports are picked up on restart")
+            return
+        await self._connect()
+
+    async def _connect(self) -> None:
+        raw = await engine.raw_connection()
+        try:
+            conn = raw.driver_connection
+            await conn.add_listener(self.channel, self._notified)
+        except BaseException:
+            raw.invalidate()
+            raise
+        conn.add_termination_listener(self._terminated)
+        self._raw = raw
+
+    async def stop(self) -> None:
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            await asyncio.gather(self._reconnecting, return_exceptions=True)
+            self._reconnecting = None
+        if self._raw is None:
+            return
+        conn = self._raw.driver_connection
+        conn.remove_termination_listener(self._terminated)
+        if not conn.is_closed():
+            await conn.remove_listener(self.channel, self._notified)
+        self._raw.close()
+        self._raw = None
+
+    def stats(self) -> dict:
+        return {"events": self.events, "reconnects": self.reconnects}
+
+    def _notified(self, connection, pid, channel, payload: str) -> None:
+        self.events += 1
+        kind, _, ids = payload.partition(":")
+        if kind == "countries":
+            self.on_countries()
+        elif kind == "cities":
+            for country_id in ids.split(","):
+                self.on_cities(int(country_id))
+
+    def _terminated(self, connection) -> None:
+        logging.warning("gazetteer listener connection lost, reconnecting")
+        if self._raw is not None:
+            self._raw.invalidate()
+            self._raw = None
+        if self._reconnecting is None:
+            self._reconnecting = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = 1.0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                break
+            except Exception:
+                logging.exception("gazetteer listener reconnect failed")
+                delay = min(delay * 2, self.reconnect_max)
+        self._reconnecting = None
+        self.reconnects += 1
+        # импорт мог пройти, пока соединения не было
+        self.on_countries()
+        self.on_cities(None)
+
+
+async def import_rows(rows: Iterator, batch_size: int = GAZETTEER_BATCH) -> dict:
+    loop = asyncio.get_running_loop()
+
+    def next_batch():
+        return list(islice(rows, batch_size))
+
+    stats = {"rows": 0, "countries": 0, "cities": 0}
+    started = time.perf_counter()
+    raw = await engine.raw_connection()
+    try:
+        conn = raw.driver_connection
+        batch = await loop.run_in_executor(None, next_batch)
+        while batch:
+            # следующая пачка читается, пока сервер сливает текущую
+            reading = loop.run_in_executor(None, next_batch)
+            countries, cities = await merge_batch(conn, batch)
+            stats["rows"] += len(batch)
+            stats["countries"] += countries
+            stats["cities"] += cities
+            elapsed = time.perf_counter() - started
+            print(
+                f"{stats['rows']:>12} rows  {stats['rows'] / elapsed:>10.0f} rows/s  "
+                f"+{stats['countries']} countries  +{stats['cities']} cities",
+                flush=True,
+            )
+            batch = await reading
+    finally:
+        raw.close()
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+async def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="CSV/TSV file, - for stdin")
+    parser.add_argument("--city", required=True, help="city name column")
+    parser.add_argument("--country", required=True, help="country column")
+    parser.add_argument("--delimiter", default="\t")
+    parser.add_argument("--header", action="store_true")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument(
+        "--country-info", help="GeoNames countryInfo.txt: country column is ISO code"
+    )
+    parser.add_argument("--batch", type=int, default=GAZETTEER_BATCH)
+    args = parser.parse_args(argv)
+
+    country_names = load_country_info(args.country_info) if args.country_info else None
+    if args.path == "-":
+        f = open(sys.stdin.fileno(), encoding=args.encoding, newline="", closefd=False)
+    else:
+        f = open(args.path, encoding=args.encoding, newline="")
+    with f:
+        rows = read_rows(
+            f, args.city, args.country, args.delimiter, args.header, country_names
+        )
+        stats = await import_rows(rows, args.batch)
+    await engine.dispose()
+    print(
+        f"imported {stats['rows']} rows in {stats['seconds']:.1f}s "
+        f"({stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s): "
+        f"+{stats['countries']} countries, +{stats['cities']} cities"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import lambda_stmt, select
+
+from database import Courier, Sender, User, after_rollback, upsert, upsert_many
+
+ROLE_FIELDS = {Courier: "courier_id", Sender: "sender_id"}
+
+
+@dataclass(frozen=True)
+class Identity:
+    user_id: int
+    name: str
+    courier_id: Optional[int] = None
+    sender_id: Optional[int] = None
+
+
+class IdentityCache:
+    """tg_id -> Identity с LRU-вытеснением и TTL.
+
+    Промахи по одному tg_id схлопываются: пока идёт загрузка из базы,
+    остальные корутины ждут тот же future.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[int, Tuple[float, Identity]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id: int) -> Optional[Identity]:
+        item = self._items.get(tg_id)
+        if item is None:
+            return None
+        expires_at, identity = item
+        if expires_at < time.monotonic():
+            del self._items[tg_id]
+            return None
+        self._items.move_to_end(tg_id)
+        return identity
+
+    def put(self, tg_id: int, identity: Identity) -> None:
+        self._items[tg_id] = (time.monotonic() + self.ttl, identity)
+        self._items.move_to_end(tg_id)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, tg_id: int) -> None:
+        self._items.pop(tg_id, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+    async def resolve(self, session, tg_id: int, name: str) -> Identity:
+        identity = self.get(tg_id)
+        if identity is not None:
+            self.hits += 1
+            return identity
+        self.misses += 1
+
+        inflight = self._inflight.get(tg_id)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[tg_id] = future
+        try:
+            identity = await self._load(session, tg_id, name)
+        except BaseException as e:
+            future.set_exception(e)
+            # исключение уже пробрасывается здесь, ожидающих может не быть
+            future.exception()
+            raise
+        else:
+            future.set_result(identity)
+            self.put(tg_id, identity)
+            # пользователь мог быть создан в этой транзакции
+            after_rollback(session, lambda: self.invalidate(tg_id))
+            return identity
+        finally:
+            del self._inflight[tg_id]
+
+    async def role_id(self, session, tg_id: int, name: str, model) -> int:
+        """id строки Courier/Sender пользователя, создаёт её при необходимости."""
+        identity = await self.resolve(session, tg_id, name)
+        field = ROLE_FIELDS[model]
+        role_id = getattr(identity, field)
+        if role_id is None:
+            role, _ = await upsert(session, model, user_id=identity.user_id)
+            role_id = role.id
+            # роль создана — обновляем запись вместо повторной загрузки
+            self.put(tg_id, replace(identity, **{field: role_id}))
+            after_rollback(session, lambda: self.invalidate(tg_id))
+        return role_id
+
+    async def warm(self, session, users: Dict[int, str]) -> int:
+        """Загружает в кеш пачку пользователей tg_id -> имя двумя запросами.
+
+        Отсутствующие пользователи создаются, как в resolve. Коммит за
+        вызывающим. Возвращает число загруженных записей.
+        """
+        users = {
+            tg_id: name for tg_id, name in users.items() if self.get(tg_id) is None
+        }
+        if not users:
+            return 0
+        rows = await upsert_many(
+            session,
+            User,
+            [{"tg_id": tg_id, "name": name} for tg_id, name in users.items()],
+            ["tg_id"],
+        )
+        user_ids = [user.id for user, _ in rows.values()]
+        result = await session.execute(
+            select(User.id, Courier.id, Sender.id)
+            .outerjoin(Courier, Courier.user_id == User.id)
+            .outerjoin(Sender, Sender.user_id == User.id)
+            .filter(User.id.in_(user_ids))
+        )
+        roles = {
+            user_id: (courier_id, sender_id)
+            for user_id, courier_id, sender_id in result
+        }
+        for (tg_id,), (user, _) in rows.items():
+            courier_id, sender_id = roles[user.id]
+            self.put(
+                tg_id,
+                Identity(
+                    user_id=user.id,
+                    name=user.name,
+                    courier_id=courier_id,
+                    sender_id=sender_id,
+                ),
+            )
+        tg_ids = list(rows)
+        after_rollback(session, lambda: [self.invalidate(tg_id) for (tg_id,) in tg_ids])
+        return len(rows)
+
+    async def _load(self, session, tg_id: int, name: str) -> Identity:
+        user, created = await upsert(
+            session, User, defaults={"name": name}, tg_id=tg_id
+        )
+        if created:
+            return Identity(user_id=user.id, name=user.name)
+        user_id = user.id
+        result = await session.execute(
+            lambda_stmt(
+                lambda: select(Courier.id, Sender.id)
+                .select_from(User)
+                .outerjoin(Courier, Courier.user_id == User.id)
+                .outerjoin(Sender, Sender.user_id == User.id)
+                .filter(User.id == user_id)
+            )
+        )
+        courier_id, sender_id = result.one()
+        return Identity(
+            user_id=user.id, name=user.name, courier_id=courier_id, sender_id=sender_id
+        )
+
+
+identities = IdentityCache()
@@ -0,0 +1,413 @@
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, timedelta
+from html import escape
+from os import getenv
+from typing import Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import Date, cast, lambda_stmt, or_, select
+from sqlalchemy.orm import joinedload
+
+from cities import city_hierarchy
+from database import (
+    BAGGAGE_BITS,
+    Courier,
+    Request,
+    Sender,
+    Status,
+    async_session_maker,
+    baggage_labels,
+)
+
+load_dotenv()
+# как часто индекс выбрасывает заявки с прошедшими датами
+MATCH_EVICT_INTERVAL = float(getenv("MATCH_EVICT_INTERVAL", "3600"))
+
+# маска курьера, который берёт любой багаж
+BAGGAGE_ANY = sum(BAGGAGE_BITS.values())
+# с экранированием (до 6 символов на символ) карточка всё равно меньше 4096
+CARD_COMMENT_LIMIT = 500
+
+
+@dataclass(frozen=True)
+class MatchEntry:
+    """Открытая заявка в том виде, в котором она нужна для уведомлений."""
+
+    request_id: int
+    origin_id: int
+    destination_id: int
+    tg_id: int
+    user_name: str
+    origin_name: str
+    destination_name: str
+    baggage_mask: int
+    comment: str
+    date: Optional[date] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+    @property
+    def is_courier(self) -> bool:
+        return self.date is not None
+
+    @property
+    def baggage_types(self) -> Tuple[str, ...]:
+        return baggage_labels(self.baggage_mask)
+
+
+def _comment(comment: str) -> str:
+    # карточки уходят с parse_mode=HTML, как и /reqs; длина комментария
+    # ограничена, чтобы карточка гарантированно влезала в сообщение
+    if len(comment) > CARD_COMMENT_LIMIT:
+        comment = comment[: CARD_COMMENT_LIMIT - 1] + "…"
+    return escape(comment)
+
+
+def courier_card(entry: MatchEntry) -> str:
+    return (
+        f"Курьер: {escape(entry.user_name)}\n"
+        f"Дата: {entry.date:%d.%m.%Y}\n"
+        f"Город отправления: {escape(entry.origin_name)}\n"
+        f"Город прибытия: {escape(entry.destination_name)}\n"
+        f"Типы багажа: {list(entry.baggage_types)}\n"
+        f"Комментарий: {_comment(entry.comment)}"
+    )
+
+
+def sender_card(entry: MatchEntry) -> str:
+    return (
+        f"Отправитель: {escape(entry.user_name)}\n"
+        f"Даты: с {entry.date_from:%d.%m.%Y} по {entry.date_to:%d.%m.%Y}\n"
+        f"Город отправления: {escape(entry.origin_name)}\n"
+        f"Город прибытия: {escape(entry.destination_name)}\n"
+        f"Типы багажа: {list(entry.baggage_types)}\n"
+        f"Комментарий: {_comment(entry.comment)}"
+    )
+
+
+def entry_from_request(r: Request) -> MatchEntry:
+    owner = r.courier if r.courier_id is not None else r.sender
+    return MatchEntry(
+        request_id=r.id,
+        origin_id=r.origin_id,
+        destination_id=r.destination_id,
+        tg_id=owner.user.tg_id,
+        user_name=owner.user.name,
+        origin_name=r.origin.name,
+        destination_name=r.destination.name,
+        baggage_mask=r.baggage_mask,
+        comment=r.comment,
+        date=r.date,
+        date_from=r.date_from,
+        date_to=r.date_to,
+    )
+
+
+class _Route:
+    """Заявки одного направления (origin, destination).
+
+    Курьеры лежат в отсортированном массиве (date, id), отправители —
+    в отсортированном массиве (date_from, id). Для поиска периодов,
+    содержащих дату, храним длину самого длинного периода: все подходящие
+    периоды начинаются в окне [day - max_span, day]. Длины периодов лежат
+    в мультимножестве spans, чтобы max_span уменьшался при удалении.
+    """
+
+    __slots__ = ("couriers", "senders", "spans", "max_span")
+
+    def __init__(self):
+        self.couriers: List[Tuple[date, int]] = []
+        self.senders: List[Tuple[date, int]] = []
+        self.spans: Counter = Counter()
+        self.max_span = timedelta(0)
+
+    def add_span(self, span: timedelta) -> None:
+        self.spans[span] += 1
+        self.max_span = max(self.max_span, span)
+
+    def discard_span(self, span: timedelta) -> None:
+        self.spans[span] -= 1
+        if not self.spans[span]:
+            del self.spans[span]
+            if span == self.max_span:
+                self.max_span = max(self.spans, default=timedelta(0))
+
+
+class MatchIndex:
+    def __init__(self, members: Callable[[int], FrozenSet[int]] = None):
+        # алиасы, совпадающие с данным (см. CityHierarchy.members); маршруты
+        # хранятся по id user_cities, так что смена привязок не требует
+        # перестраивать индекс
+        self.members = members or (lambda user_city_id: frozenset((user_city_id,)))
+        self._entries: Dict[int, MatchEntry] = {}
+        self._routes: Dict[Tuple[int, int], _Route] = {}
+        self._destinations: Dict[int, Set[int]] = {}
+        self._discarded_while_warming: set = set()
+        self._warming = False
+        self._task = None
+        self.ready = False
+        self.evicted = 0
+        # вызываются при add/discard; в режиме шардирования изменения
+        # так рассылаются индексам других процессов
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _publish(self, op: str, arg) -> None:
+        for listener in self.listeners:
+            listener(op, arg)
+
+    def add(self, entry: MatchEntry, publish: bool = True) -> None:
+        if publish:
+            self._publish("add", entry)
+        if entry.request_id in self._entries:
+            return
+        route = self._routes.get((entry.origin_id, entry.destination_id))
+        if route is None:
+            route = self._routes[(entry.origin_id, entry.destination_id)] = _Route()
+            self._destinations.setdefault(entry.origin_id, set()).add(
+                entry.destination_id
+            )
+        if entry.is_courier:
+            insort(route.couriers, (entry.date, entry.request_id))
+        else:
+            insort(route.senders, (entry.date_from, entry.request_id))
+            route.add_span(entry.date_to - entry.date_from)
+        self._entries[entry.request_id] = entry
+
+    def discard(self, request_id: int, publish: bool = True) -> None:
+        if publish:
+            self._publish("discard", request_id)
+        if self._warming:
+            self._discarded_while_warming.add(request_id)
+        entry = self._entries.pop(request_id, None)
+        if entry is not None:
+            self._remove(entry)
+
+    def _remove(self, entry: MatchEntry) -> None:
+        route_key = (entry.origin_id, entry.destination_id)
+        route = self._routes[route_key]
+        if entry.is_courier:
+            items, key = route.couriers, (entry.date, entry.request_id)
+        else:
+            items, key = route.senders, (entry.date_from, entry.request_id)
+            route.discard_span(entry.date_to - entry.date_from)
+        i = bisect_left(items, key)
+        if i < len(items) and items[i] == key:
+            del items[i]
+        if not route.couriers and not route.senders:
+            del self._routes[route_key]
+            destinations = self._destinations[entry.origin_id]
+            destinations.discard(entry.destination_id)
+            if not destinations:
+                del self._destinations[entry.origin_id]
+
+    def evict(self, today: date) -> int:
+        """Выбрасывает заявки, даты которых прошли; возвращает их число.
+
+        Каждый процесс вычищает свой индекс сам, изменения не рассылаются.
+        """
+        stale = []
+        for route in self._routes.values():
+            # курьеры с date < today — префикс массива; у отправителей с
+            # date_to < today и date_from < today, проверяем только их
+            hi = bisect_left(route.couriers, (today,))
+            stale.extend(i for _, i in route.couriers[:hi])
+            hi = bisect_left(route.senders, (today,))
+            stale.extend(
+                i for _, i in route.senders[:hi] if self._entries[i].date_to < today
+            )
+        for request_id in stale:
+            self._remove(self._entries.pop(request_id))
+        self.evicted += len(stale)
+        return len(stale)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "routes": len(self._routes),
+            "evicted": self.evicted,
+            "ready": int(self.ready),
+        }
+
+    def _routes_between(self, origin_id: int, destination_id: int) -> Iterator[_Route]:
+        origins = self.members(origin_id)
+        destinations = self.members(destination_id)
+        if len(origins) == 1 and len(destinations) == 1:
+            route = self._routes.get((origin_id, destination_id))
+            if route is not None:
+                yield route
+            return
+        # перебираем только направления, по которым есть заявки
+        for origin in origins:
+            for destination in self._destinations.get(origin, ()):
+                if destination in destinations:
+                    yield self._routes[(origin, destination)]
+
+    def couriers_between(
+        self,
+        origin_id: int,
+        destination_id: int,
+        date_from: date,
+        date_to: date,
+        baggage_mask: int = 0,
+    ) -> List[MatchEntry]:
+        """Курьеры, которые берут все виды багажа из baggage_mask."""
+        found = []
+        for route in self._routes_between(origin_id, destination_id):
+            lo = bisect_left(route.couriers, (date_from,))
+            hi = bisect_right(route.couriers, (date_to, float("inf")))
+            found.extend(route.couriers[lo:hi])
+        entries = (self._entries[i] for _, i in sorted(found))
+        return [e for e in entries if e.baggage_mask & baggage_mask == baggage_mask]
+
+    def senders_on(
+        self,
+        origin_id: int,
+        destination_id: int,
+        day: date,
+        baggage_mask: int = BAGGAGE_ANY,
+    ) -> List[MatchEntry]:
+        """Отправители, весь багаж которых входит в baggage_mask курьера."""
+        found = []
+        for route in self._routes_between(origin_id, destination_id):
+            lo = bisect_left(route.senders, (day - route.max_span,))
+            hi = bisect_right(route.senders, (day, float("inf")))
+            found.extend(route.senders[lo:hi])
+        entries = (self._entries[i] for _, i in sorted(found))
+        return [
+            e
+            for e in entries
+            if e.date_to >= day and baggage_mask & e.baggage_mask == e.baggage_mask
+        ]
+
+    async def warm(self) -> None:
+        """Загружает открытые заявки из базы.
+
+        Пока индекс не готов, поиск идёт через SQL (см. find_couriers/find_senders).
+        Заявки, добавленные или отменённые во время загрузки, учитываются.
+        """
+        self._warming = True
+        try:
+            today = date.today()
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    select(Request)
+                    .options(
+                        joinedload(Request.origin),
+                        joinedload(Request.destination),
+                        joinedload(Request.courier).joinedload(Courier.user),
+                        joinedload(Request.sender).joinedload(Sender.user),
+                    )
+                    .filter(
+                        Request.status == Status.new,
+                        or_(Request.date >= today, Request.date_to >= today),
+                    )
+                )
+                requests = result.scalars().all()
+            for r in requests:
+                if r.id not in self._discarded_while_warming:
+                    self.add(entry_from_request(r), publish=False)
+            self.ready = True
+            logging.info("match index warmed: %s open requests", len(self))
+        finally:
+            self._warming = False
+            self._discarded_while_warming.clear()
+
+    async def start(self, evict_interval: float = MATCH_EVICT_INTERVAL) -> None:
+        """Прогрев в фоне, затем периодическая чистка прошедших заявок."""
+        self._task = asyncio.create_task(self._run(evict_interval))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self, evict_interval: float) -> None:
+        try:
+            await self.warm()
+        except Exception:
+            logging.exception("match index warm failed, matching stays on SQL")
+            return
+        while True:
+            await asyncio.sleep(evict_interval)
+            evicted = self.evict(date.today())
+            if evicted:
+                logging.info("match index: evicted %s past requests", evicted)
+
+
+match_index = MatchIndex(city_hierarchy.members)
+
+
+async def find_couriers(
+    session,
+    origin_id: int,
+    destination_id: int,
+    date_from: date,
+    date_to: date,
+    baggage_mask: int = 0,
+) -> List[MatchEntry]:
+    if match_index.ready:
+        return match_index.couriers_between(
+            origin_id, destination_id, date_from, date_to, baggage_mask
+        )
+    origins = sorted(city_hierarchy.members(origin_id))
+    destinations = sorted(city_hierarchy.members(destination_id))
+    result = await session.execute(
+        lambda_stmt(
+            lambda: select(Request)
+            .options(
+                joinedload(Request.origin),
+                joinedload(Request.destination),
+                joinedload(Request.courier).joinedload(Courier.user),
+            )
+            .filter(
+                Request.origin_id.in_(origins),
+                Request.destination_id.in_(destinations),
+                Request.date.between(date_from, date_to),
+                Request.baggage_mask.op("&")(baggage_mask) == baggage_mask,
+            )
+        )
+    )
+    return [entry_from_request(r) for r in result.scalars().all()]
+
+
+async def find_senders(
+    session,
+    origin_id: int,
+    destination_id: int,
+    day: date,
+    baggage_mask: int = BAGGAGE_ANY,
+) -> List[MatchEntry]:
+    if match_index.ready:
+        return match_index.senders_on(origin_id, destination_id, day, baggage_mask)
+    origins = sorted(city_hierarchy.members(origin_id))
+    destinations = sorted(city_hierarchy.members(destination_id))
+    result = await session.execute(
+        lambda_stmt(
+            lambda: select(Request)
+            .options(
+                joinedload(Request.origin),
+                joinedload(Request.destination),
+                joinedload(Request.sender).joinedload(Sender.user),
+            )
+            .filter(
+                Request.origin_id.in_(origins),
+                Request.destination_id.in_(destinations),
+                # без cast параметр в lambda получает тип колонки (daterange)
+                Request.period.contains(cast(day, Date)),
+                Request.baggage_mask.op("&")(baggage_mask) == Request.baggage_mask,
+            )
+        )
+    )
+    return [entry_from_request(r) for r in result.scalars().all()]
@@ -0,0 +1,95 @@
+"""Буфер правок и удалений сообщений на один апдейт.
+
+Шаги формы удаляют ввод пользователя и прошлую подсказку и правят итоговое
+сообщение. Хендлеры складывают эти операции в MessageOps, а
+MessageOpsMiddleware отправляет их после хендлера: удаления одного чата —
+одним deleteMessages (до 100 id), из нескольких правок одного сообщения
+уходит последняя, правки удаляемых сообщений отбрасываются. Все вызовы идут
+параллельно через asyncio.gather.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.methods import DeleteMessage, DeleteMessages, EditMessageText
+
+# лимит deleteMessages
+DELETE_BATCH = 100
+
+ops_stats = {"requested": 0, "sent": 0, "superseded": 0, "failed": 0}
+
+
+class MessageOps:
+    def __init__(self):
+        self._deletes: Dict[int, Dict[int, None]] = {}
+        self._edits: Dict[Tuple[int, int], EditMessageText] = {}
+
+    def delete(self, chat_id: int, message_id: int) -> None:
+        ops_stats["requested"] += 1
+        self._deletes.setdefault(chat_id, {})[message_id] = None
+
+    def edit_text(self, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        ops_stats["requested"] += 1
+        if (chat_id, message_id) in self._edits:
+            ops_stats["superseded"] += 1
+        self._edits[chat_id, message_id] = EditMessageText(
+            chat_id=chat_id, message_id=message_id, text=text, **kwargs
+        )
+
+    def methods(self):
+        """Вызовы Bot API, которые заменяют накопленные операции."""
+        methods = []
+        for chat_id, ids in self._deletes.items():
+            ids = list(ids)
+            for i in range(0, len(ids), DELETE_BATCH):
+                chunk = ids[i : i + DELETE_BATCH]
+                if len(chunk) == 1:
+                    methods.append(DeleteMessage(chat_id=chat_id, message_id=chunk[0]))
+                else:
+                    methods.append(DeleteMessages(chat_id=chat_id, message_ids=chunk))
+        for (chat_id, message_id), method in self._edits.items():
+            if message_id in self._deletes.get(chat_id, ()):
+                ops_stats["superseded"] += 1
+                continue
+            methods.append(method)
+        return methods
+
+    async def flush(self, bot) -> None:
+        methods = self.methods()
+        self._deletes.clear()
+        self._edits.clear()
+        if not methods:
+            return
+        ops_stats["sent"] += len(methods)
+        results = await asyncio.gather(
+            *(bot(method) for method in methods), return_exceptions=True
+        )
+        for method, result in zip(methods, results):
+            # сообщение уже удалено или не изменилось — форма от этого не ломается
+            if isinstance(result, Exception):
+                ops_stats["failed"] += 1
+                logging.warning("%s failed: %s", type(method).__name__, result)
+
+
+def message_ops_stats() -> dict:
+    return {**ops_stats, "saved": ops_stats["requested"] - ops_stats["sent"]}
+
+
+class MessageOpsMiddleware(BaseMiddleware):
+    """Передаёт хендлерам MessageOps аргументом ops и отправляет его после них.
+
+    Регистрируется на dp.update перед DbSessionMiddleware: операции уходят
+    после коммита и только если хендлер завершился без ошибки.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        ops = data["ops"] = MessageOps()
+        result = await handler(event, data)
+        await ops.flush(data["bot"])
+        return result
@@ -0,0 +1,223 @@
+"""Метрики обработки апдейтов в формате Prometheus.
+
+UpdateMetricsMiddleware (самый внешний outer на dp.update) заводит на апдейт
+счётчики SQL-запросов и вызовов Bot API в contextvar; события SQLAlchemy и
+middleware сессии бота пишут в них. Так в счёт попадают и коммиты, правки
+сообщений и запись FSM, которые другие outer-middleware делают после
+хендлера. По завершении апдейта значения попадают в гистограммы с меткой
+хендлера. /metrics отдаёт всё в текстовом формате Prometheus.
+"""
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from os import getenv
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+# пустое значение — HTTP-эндпоинт не поднимается
+METRICS_PORT = getenv("METRICS_PORT")
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=TIME_BUCKETS, label="handler"):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self._series: Dict[str, list] = {}
+
+    def observe(self, label_value: str, value: float) -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            # [счётчики по бакетам..., +Inf, sum]
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_value, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield (
+                    f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}}'
+                    f" {cumulative}"
+                )
+            yield f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-1]}'
+            yield f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}'
+
+
+update_seconds = Histogram(
+    "bot_update_duration_seconds", "Wall time of update handling"
+)
+update_sql_statements = Histogram(
+    "bot_update_sql_statements", "SQL statements per update", COUNT_BUCKETS
+)
+update_sql_seconds = Histogram("bot_update_sql_seconds", "Total SQL time per update")
+update_api_calls = Histogram(
+    "bot_update_api_calls", "Bot API calls per update", COUNT_BUCKETS
+)
+update_api_seconds = Histogram(
+    "bot_update_api_seconds", "Total Bot API time per update"
+)
+api_call_seconds = Histogram(
+    "bot_api_call_duration_seconds", "Latency of a Bot API call", label="method"
+)
+HISTOGRAMS = [
+    update_seconds,
+    update_sql_statements,
+    update_sql_seconds,
+    update_api_calls,
+    update_api_seconds,
+    api_call_seconds,
+]
+
+# (префикс, функция без аргументов -> dict) — stats() кешей и очереди уведомлений,
+# вложенные словари разворачиваются в gauge вида <префикс>_<ключ>_<ключ>
+collectors: list = []
+
+_current: ContextVar[Optional[dict]] = ContextVar("update_metrics", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats["sql"] += 1
+        stats["sql_seconds"] += elapsed
+
+
+def _handle_error(context) -> None:
+    # упавший запрос after_cursor_execute не получает: снимаем его отметку,
+    # иначе стек на соединении растёт, а следующие запросы берут чужое время
+    started = (
+        context.connection.info.get("query_started") if context.connection else None
+    )
+    if started and context.statement is not None:
+        started.pop()
+
+
+def instrument_engine(engine) -> None:
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine.sync_engine, "handle_error", _handle_error)
+
+
+async def _api_middleware(make_request, bot, method):
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        elapsed = time.perf_counter() - started
+        api_call_seconds.observe(type(method).__name__, elapsed)
+        stats = _current.get()
+        if stats is not None:
+            stats["api"] += 1
+            stats["api_seconds"] += elapsed
+
+
+def instrument_bot(bot) -> None:
+    bot.session.middleware(_api_middleware)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Регистрируется как outer на dp.update (учёт) и как inner (имя хендлера)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = _current.get()
+        if stats is not None:
+            # inner-вызов: хендлер уже выбран фильтрами
+            stats["handler"] = data["handler"].callback.__name__
+            return await handler(event, data)
+
+        stats = {
+            "handler": "unhandled",
+            "sql": 0,
+            "sql_seconds": 0.0,
+            "api": 0,
+            "api_seconds": 0.0,
+        }
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            name = stats["handler"]
+            update_seconds.observe(name, elapsed)
+            update_sql_statements.observe(name, stats["sql"])
+            update_sql_seconds.observe(name, stats["sql_seconds"])
+            update_api_calls.observe(name, stats["api"])
+            update_api_seconds.observe(name, stats["api_seconds"])
+
+
+def instrument_dispatcher(dp) -> None:
+    """Вызывать до регистрации остальных outer-middleware dp.update."""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+
+
+def instrument_router(router) -> None:
+    middleware = UpdateMetricsMiddleware()
+    for observer in (router.message, router.callback_query):
+        observer.middleware(middleware)
+
+
+def _flatten(prefix: str, stats: dict):
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif value is not None:
+            yield name, value
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for prefix, collect in collectors:
+        for name, value in _flatten(prefix, collect()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain")
+
+
+async def start_metrics_server(host: Optional[str] = None, port=None):
+    # значения по умолчанию читаются при вызове: воркеры шардов сдвигают порт
+    host = host or METRICS_HOST
+    port = port or METRICS_PORT
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, int(port)).start()
+    logging.info("metrics on http://%s:%s/metrics", host, port)
+    return runner
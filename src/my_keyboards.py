@@ -1,12 +1,24 @@
+from collections import OrderedDict
 from enum import Enum
+from os import getenv
 
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types.inline_keyboard_button import InlineKeyboardButton
 from aiogram.types.inline_keyboard_markup import InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy import select
+from dotenv import load_dotenv
+from sqlalchemy import func, select, text
 
-from database import City, Country, async_session_maker
+from callback_codec import CompactCallbackData
+from database import City, Country
+
+load_dotenv()
+# кнопок на странице выбора страны/города; у Telegram лимит — 100 на сообщение
+PICKER_PAGE_SIZE = int(getenv("PICKER_PAGE_SIZE", "24"))
+PICKER_COLUMNS = 2
+PICKER_BUCKET_COLUMNS = 6
+PICKER_MAX_BUCKETS = 90
+KEYBOARD_CACHE_SIZE = int(getenv("KEYBOARD_CACHE_SIZE", "1024"))
 
 
 class DirectionEnum(str, Enum):
@@ -19,7 +31,7 @@ class RoleModelEnum(str, Enum):
     courier = "Courier"
 
 
-class RoleCallback(CallbackData, prefix="role"):
+class RoleCallback(CompactCallbackData, prefix="r", legacy="role"):
     model: RoleModelEnum
 
 
@@ -27,8 +39,17 @@ class GeneralCallback(CallbackData, prefix="general"):
     text: str
 
 
-class CancelReqCallback(CallbackData, prefix="cancel_req"):
+class CancelReqCallback(CompactCallbackData, prefix="x", legacy="cancel_req"):
     id: int
+    # якорь страницы /reqs, которую нужно перерисовать после отмены
+    before: int = 0
+
+
+class ReqsPageCallback(CallbackData, prefix="reqs"):
+    # keyset-курсоры по Request.id: страница заявок с id < before
+    # (0 — первая страница) или, при листании назад, с id > after
+    before: int = 0
+    after: int = 0
 
 
 sender_button = InlineKeyboardButton(
@@ -42,16 +63,74 @@ courier_button = InlineKeyboardButton(
 role_markup = InlineKeyboardMarkup(inline_keyboard=[[sender_button, courier_button]])
 
 
-class CountryCallback(CallbackData, prefix="country"):
+# id, а не название: длинные и нелатинские названия не влезали в 64 байта
+class CountryCallback(CompactCallbackData, prefix="co"):
     direction: DirectionEnum
-    name: str
+    id: int
 
 
-class CityCallback(CallbackData, prefix="city"):
+class CityCallback(CompactCallbackData, prefix="ci", legacy="city"):
     direction: DirectionEnum
     id: int
 
 
+class PickerCallback(CompactCallbackData, prefix="pk"):
+    """Страница выбора страны (country_id=0) или города страны.
+
+    prefix — выбранная буква; after/before — keyset-курсоры: id последней
+    строки предыдущей страницы или первой строки следующей.
+    """
+
+    direction: DirectionEnum
+    country_id: int = 0
+    prefix: str = ""
+    after: int = 0
+    before: int = 0
+
+
+CITY_PROMPTS = {
+    DirectionEnum.from_: "Отправить из:\n(введите название города)",
+    DirectionEnum.to: "Отправить в:\n(введите название города)",
+}
+
+
+def city_prompt_markup(direction):
+    """Кнопка под запросом города: выбрать из справочника вместо ввода."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="Выбрать из списка",
+                    callback_data=PickerCallback(direction=direction).pack(),
+                )
+            ]
+        ]
+    )
+
+
+class CitySuggestionCallback(CompactCallbackData, prefix="cs"):
+    # строка user_cities или, если её ещё нет, город справочника;
+    # оба 0 — оставить введённое название как новый город
+    user_city_id: int = 0
+    city_id: int = 0
+
+
+def city_suggestions_markup(text, suggestions):
+    builder = InlineKeyboardBuilder()
+    for entry in suggestions:
+        builder.button(
+            text=entry.name,
+            callback_data=CitySuggestionCallback(
+                user_city_id=entry.user_city_id or 0, city_id=entry.city_id or 0
+            ),
+        )
+    builder.button(
+        text=f"Оставить «{text[:40]}»", callback_data=CitySuggestionCallback()
+    )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
 class BaggageKinds(Enum):
     usual = "Обычный"
     liquid = "Жидкость"
@@ -62,55 +141,244 @@ class BaggageKinds(Enum):
     finish = "Готово"
 
 
-class BaggageKindCallback(CallbackData, prefix="baggage_kind"):
+class BaggageKindCallback(CompactCallbackData, prefix="b", legacy="baggage_kind"):
     kind: BaggageKinds
 
 
-async def country_keyboard(direction):
+# страницы выбора страны и города кешируются до вставки новых стран/городов;
+# в кеше не больше KEYBOARD_CACHE_SIZE страниц, вытесняются давно не нужные
+_markup_cache = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+# вызываются при инвалидации; в режиме шардирования рассылают её другим процессам
+invalidation_listeners = []
+
+
+def invalidate_countries(publish=True):
+    if publish:
+        for listener in invalidation_listeners:
+            listener("invalidate_countries", None)
+    cache_stats["invalidations"] += 1
+    for key in [key for key in _markup_cache if key[0] == "country"]:
+        del _markup_cache[key]
+
+
+def invalidate_cities(country_id=None, publish=True):
+    if publish:
+        for listener in invalidation_listeners:
+            listener("invalidate_cities", country_id)
+    cache_stats["invalidations"] += 1
+    for key in [key for key in _markup_cache if key[0] == "city"]:
+        if country_id is None or key[2] == country_id:
+            del _markup_cache[key]
+
+
+def keyboard_cache_stats():
+    return {**cache_stats, "size": len(_markup_cache)}
+
+
+def _cached(key):
+    markup = _markup_cache.get(key)
+    if markup is None:
+        cache_stats["misses"] += 1
+        return None
+    cache_stats["hits"] += 1
+    _markup_cache.move_to_end(key)
+    return markup
+
+
+def _cache(key, markup):
+    _markup_cache[key] = markup
+    if len(_markup_cache) > KEYBOARD_CACHE_SIZE:
+        _markup_cache.popitem(last=False)
+        cache_stats["evictions"] += 1
+    return markup
+
+
+def _prefix_range(column, prefix):
+    # в побайтовом порядке строки с префиксом лежат в [prefix, следующий за ним)
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return column >= prefix, column < upper
+
+
+# первые буквы названий одним запросом: рекурсивный CTE прыгает по индексу
+# (country_id, name COLLATE "C") от буквы к следующей за ней (loose index
+# scan) — по одному чтению индекса на букву, без обхода всех строк. Внешний
+# LIMIT останавливает рекурсию
+_LETTERS = """
+WITH RECURSIVE letters(letter) AS (
+    (
+        SELECT left(t.name COLLATE "C", 1) FROM {table} t
+        WHERE {scope}
+        ORDER BY t.name COLLATE "C"
+        LIMIT 1
+    )
+    UNION ALL
+    SELECT (
+        SELECT left(t.name COLLATE "C", 1) FROM {table} t
+        WHERE {scope} AND t.name COLLATE "C" >= chr(ascii(l.letter) + 1)
+        ORDER BY t.name COLLATE "C"
+        LIMIT 1
+    )
+    FROM letters l
+    WHERE l.letter IS NOT NULL
+)
+SELECT letter FROM letters WHERE letter IS NOT NULL LIMIT :limit
+"""
+LETTERS_COUNTRIES = text(_LETTERS.format(table="countries", scope="TRUE"))
+LETTERS_CITIES = text(_LETTERS.format(table="cities", scope="t.country_id = :scope"))
+
+
+async def _letters(session, scope):
+    """Первые буквы названий стран или городов страны scope."""
+    if scope is None:
+        query, params = LETTERS_COUNTRIES, {}
+    else:
+        query, params = LETTERS_CITIES, {"scope": scope}
+    result = await session.execute(query, {**params, "limit": PICKER_MAX_BUCKETS})
+    return result.scalars().all()
+
+
+async def _exceeds_page(session, model, scope) -> bool:
+    """Не влезает ли список целиком на одну страницу: читает до PAGE_SIZE+1 id."""
+    query = select(model.id).limit(PICKER_PAGE_SIZE + 1)
+    if scope is not None:
+        query = query.filter(model.country_id == scope)
+    count = select(func.count()).select_from(query.subquery())
+    return (await session.execute(count)).scalar() > PICKER_PAGE_SIZE
+
+
+async def _page(session, model, scope, prefix, after, before):
+    """Страница (id, name) по name COLLATE "C" после/до строки с данным id.
+
+    Возвращает (строки, есть_предыдущая, есть_следующая).
+    """
+    name = model.name.collate("C")
+    query = select(model.id, model.name).limit(PICKER_PAGE_SIZE + 1)
+    if scope is not None:
+        query = query.filter(model.country_id == scope)
+    if prefix:
+        query = query.filter(*_prefix_range(name, prefix))
+    if before:
+        anchor = select(model.name).filter(model.id == before).scalar_subquery()
+        query = query.filter(name < anchor).order_by(name.desc())
+    else:
+        if after:
+            anchor = select(model.name).filter(model.id == after).scalar_subquery()
+            query = query.filter(name > anchor)
+        query = query.order_by(name)
+    rows = (await session.execute(query)).all()
+    has_more = len(rows) > PICKER_PAGE_SIZE
+    rows = rows[:PICKER_PAGE_SIZE]
+    if before:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, bool(after), has_more
+
+
+def _buckets_markup(letters, direction, country_id, absent):
     builder = InlineKeyboardBuilder()
-    async with async_session_maker() as session:
-        query = select(Country.__table__.columns)
-        result = await session.execute(query)
-        countries = result.mappings().all()
-
-    for country in countries:
+    for letter in letters:
         builder.button(
-            text=country.name,
-            callback_data=CountryCallback(
-                direction=f"country_{direction}", name=country.name
-            ).pack(),
+            text=letter,
+            callback_data=PickerCallback(
+                direction=direction, country_id=country_id, prefix=letter
+            ),
         )
-    builder.button(
-        text="Нет в списке",
-        callback_data=GeneralCallback(text=f"absent_country_{direction}").pack(),
-    )
-
+    builder.adjust(PICKER_BUCKET_COLUMNS)
+    builder.row(absent)
     return builder.as_markup()
 
 
-async def city_keyboard(callback_data):
+def _page_markup(rows, has_prev, has_next, prefix, item, pager, absent):
     builder = InlineKeyboardBuilder()
-    async with async_session_maker() as session:
-        query = select(City.__table__.columns).filter_by(country_id=callback_data.id)
-        result = await session.execute(query)
-        cities = result.mappings().all()
-
-    for city in cities:
-        builder.button(
-            text=city.name,
-            callback_data=CityCallback(
-                direction=callback_data.direction, id=city.id
-            ).pack(),
+    for id, name in rows:
+        builder.button(text=name, callback_data=item(id))
+    builder.adjust(PICKER_COLUMNS)
+    nav = []
+    if has_prev:
+        nav.append(
+            InlineKeyboardButton(text="«", callback_data=pager(before=rows[0].id))
         )
-    builder.button(
+    if prefix:
+        # назад к буквам
+        nav.append(InlineKeyboardButton(text="А–Я", callback_data=pager(prefix="")))
+    if has_next:
+        nav.append(
+            InlineKeyboardButton(text="»", callback_data=pager(after=rows[-1].id))
+        )
+    if nav:
+        builder.row(*nav)
+    builder.row(absent)
+    return builder.as_markup()
+
+
+async def _picker(
+    session, model, scope, direction, prefix, after, before, item, absent
+):
+    """Страница выбора: буквы, если без префикса всё не влезает, иначе список."""
+    country_id = scope or 0
+
+    def pager(**kwargs):
+        values = {"prefix": prefix, **kwargs}
+        return PickerCallback(
+            direction=direction, country_id=country_id, **values
+        ).pack()
+
+    if not prefix and not after and not before:
+        if await _exceeds_page(session, model, scope):
+            letters = await _letters(session, scope)
+            return _buckets_markup(letters, direction, country_id, absent)
+    rows, has_prev, has_next = await _page(session, model, scope, prefix, after, before)
+    return _page_markup(rows, has_prev, has_next, prefix, item, pager, absent)
+
+
+async def country_keyboard(session, direction, prefix="", after=0, before=0):
+    key = ("country", direction, prefix, after, before)
+    markup = _cached(key)
+    if markup is not None:
+        return markup
+    absent = InlineKeyboardButton(
         text="Нет в списке",
-        callback_data=CityCallback(direction=callback_data.direction, id=0).pack(),
+        callback_data=GeneralCallback(text=f"absent_country_{direction}").pack(),
     )
+    markup = await _picker(
+        session,
+        Country,
+        None,
+        direction,
+        prefix,
+        after,
+        before,
+        lambda id: CountryCallback(direction=direction, id=id).pack(),
+        absent,
+    )
+    return _cache(key, markup)
 
-    return builder.as_markup()
+
+async def city_keyboard(session, direction, country_id, prefix="", after=0, before=0):
+    key = ("city", direction, country_id, prefix, after, before)
+    markup = _cached(key)
+    if markup is not None:
+        return markup
+    absent = InlineKeyboardButton(
+        text="Нет в списке",
+        callback_data=CityCallback(direction=direction, id=0).pack(),
+    )
+    markup = await _picker(
+        session,
+        City,
+        country_id,
+        direction,
+        prefix,
+        after,
+        before,
+        lambda id: CityCallback(direction=direction, id=id).pack(),
+        absent,
+    )
+    return _cache(key, markup)
 
 
-async def baggage_type_keyboard():
+def _baggage_type_markup():
     builder = InlineKeyboardBuilder()
 
     for kind in BaggageKinds:
@@ -123,7 +391,7 @@ async def baggage_type_keyboard():
     return builder.as_markup()
 
 
-async def final_keyboard():
+def _final_markup():
     builder = InlineKeyboardBuilder()
 
     builder.button(
@@ -136,17 +404,31 @@ async def final_keyboard():
     return builder.as_markup()
 
 
-def cancel_req_inline_kb(id):
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text=f"Отменить {id}",
-                    callback_data=CancelReqCallback(
-                        id=id
-                    ).pack(),  # Убедитесь, что метод pack() корректно работает
-                )
-            ]
-        ]
-    )
-    return keyboard
+baggage_type_markup = _baggage_type_markup()
+final_markup = _final_markup()
+
+
+def reqs_page_markup(ids, before, has_prev, has_next):
+    builder = InlineKeyboardBuilder()
+    for n, id in enumerate(ids, 1):
+        builder.button(
+            text=f"Отменить {n}",
+            callback_data=CancelReqCallback(id=id, before=before),
+        )
+    builder.adjust(3)
+    pager = []
+    if has_prev:
+        pager.append(
+            InlineKeyboardButton(
+                text="« Назад", callback_data=ReqsPageCallback(after=ids[0]).pack()
+            )
+        )
+    if has_next:
+        pager.append(
+            InlineKeyboardButton(
+                text="Вперёд »", callback_data=ReqsPageCallback(before=ids[-1]).pack()
+            )
+        )
+    if pager:
+        builder.row(*pager)
+    return builder.as_markup()
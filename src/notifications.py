@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+
+
+class Notification(NamedTuple):
+    chat_id: int
+    text: str
+    enqueued_at: float
+    # вызывается с True, если Telegram принял сообщение или чат недоступен
+    # (бот заблокирован, чата нет — повтор не поможет), и с False, если
+    # сообщение не ушло и его стоит отправить позже
+    on_done: Optional[Callable[[bool], None]] = None
+    # сколько раз Telegram уже ответил flood control
+    attempt: int = 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    """Очередь исходящих уведомлений о совпадениях.
+
+    Хендлеры только кладут сообщение в очередь, отправкой занимаются воркеры.
+    Ограничения Telegram: ~30 сообщений в секунду на бота и 1 в секунду на чат.
+
+    У каждого чата своя FIFO-очередь, а в куче _ready лежат чаты с
+    непустой очередью и временем, когда им можно писать. Воркер берёт из кучи
+    только чат, которому уже пора, отправляет одно сообщение и возвращает чат
+    в кучу со сдвигом chat_interval. Пауза одного чата не занимает воркер, а
+    сообщения внутри чата уходят по порядку: чат в работе есть не больше чем
+    у одного воркера.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        workers: int = 4,
+        maxsize: int = 10_000,
+        rate: float = 30,
+        chat_interval: float = 1.0,
+        max_retries: int = 5,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._chats: Dict[int, Deque[Notification]] = {}
+        self._chat_next_at: Dict[int, float] = {}
+        self._ready: List[Tuple[float, int, int]] = []
+        self._in_flight: Set[int] = set()
+        self._seq = itertools.count()
+        self._pending = 0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.forbidden = 0
+        self.dropped = 0
+        self.retried = 0
+        self.send_latency: Deque[float] = deque(maxlen=1000)
+        self.delivery_latency: Deque[float] = deque(maxlen=1000)
+
+    def enqueue(self, chat_id: int, text: str, on_done=None) -> bool:
+        if self._pending >= self.maxsize:
+            self.dropped += 1
+            logging.warning(
+                "notification queue is full, dropped message to %s", chat_id
+            )
+            return False
+        notification = Notification(chat_id, text, time.monotonic(), on_done)
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+        queue.append(notification)
+        self._pending += 1
+        self._idle.clear()
+        if len(queue) == 1 and chat_id not in self._in_flight:
+            self._schedule(chat_id, self._chat_next_at.get(chat_id, 0))
+        return True
+
+    async def join(self) -> None:
+        """Ждёт, пока не останется неотправленных сообщений."""
+        await self._idle.wait()
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(
+                "notification queue not drained, %s messages lost", self._pending
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        def quantiles(values):
+            if len(values) < 2:
+                return {"p50": None, "p99": None}
+            q = statistics.quantiles(values, n=100)
+            return {"p50": q[49], "p99": q[98]}
+
+        return {
+            "queue_depth": self._pending,
+            "chats_waiting": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "forbidden": self.forbidden,
+            "dropped": self.dropped,
+            "retried": self.retried,
+            "send_latency": quantiles(self.send_latency),
+            "delivery_latency": quantiles(self.delivery_latency),
+        }
+
+    def _schedule(self, chat_id: int, at: float) -> None:
+        heapq.heappush(self._ready, (at, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _next_chat(self) -> int:
+        while True:
+            now = time.monotonic()
+            if self._ready and self._ready[0][0] <= now:
+                return heapq.heappop(self._ready)[2]
+            timeout = self._ready[0][0] - now if self._ready else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._next_chat()
+            self._in_flight.add(chat_id)
+            queue = self._chats[chat_id]
+            notification = queue.popleft()
+            done, retry_at = False, None
+            try:
+                done, retry_at = await self._send(notification)
+            except Exception:
+                self.failed += 1
+                logging.exception("notification to %s failed", chat_id)
+            finally:
+                self._in_flight.discard(chat_id)
+                if retry_at is not None:
+                    # flood control: сообщение возвращается в голову очереди чата
+                    queue.appendleft(
+                        notification._replace(attempt=notification.attempt + 1)
+                    )
+                    self._schedule(chat_id, retry_at)
+                else:
+                    self._finish(chat_id, queue, notification, done)
+
+    def _finish(self, chat_id, queue, notification, done: bool) -> None:
+        next_at = time.monotonic() + self.chat_interval
+        if queue:
+            self._schedule(chat_id, next_at)
+        else:
+            del self._chats[chat_id]
+            self._chat_next_at[chat_id] = next_at
+        self._pending -= 1
+        if not self._pending:
+            self._idle.set()
+        if len(self._chat_next_at) > 10 * self.maxsize:
+            now = time.monotonic()
+            self._chat_next_at = {
+                chat: at for chat, at in self._chat_next_at.items() if at > now
+            }
+        if notification.on_done is not None:
+            notification.on_done(done)
+
+    async def _send(self, notification: Notification) -> Tuple[bool, Optional[float]]:
+        """Одна попытка отправки: (доставлено, когда повторить)."""
+        await self.bucket.acquire()
+        started = time.monotonic()
+        try:
+            await self.bot.send_message(notification.chat_id, notification.text)
+        except TelegramRetryAfter as e:
+            if notification.attempt >= self.max_retries:
+                self.failed += 1
+                logging.warning(
+                    "notification to %s: flood control, retries exhausted",
+                    notification.chat_id,
+                )
+                return False, None
+            self.retried += 1
+            return False, time.monotonic() + e.retry_after
+        except (TelegramForbiddenError, TelegramNotFound) as e:
+            # бот заблокирован или чата нет: повтор не поможет
+            self.forbidden += 1
+            logging.info("notification to %s forbidden: %s", notification.chat_id, e)
+            return True, None
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message:
+                self.forbidden += 1
+                logging.info(
+                    "notification to %s forbidden: %s", notification.chat_id, e
+                )
+                return True, None
+            self.failed += 1
+            logging.warning("notification to %s rejected: %s", notification.chat_id, e)
+            return False, None
+        except TelegramAPIError as e:
+            self.failed += 1
+            logging.warning("notification to %s failed: %s", notification.chat_id, e)
+            return False, None
+        now = time.monotonic()
+        self.sent += 1
+        self.send_latency.append(now - started)
+        self.delivery_latency.append(now - notification.enqueued_at)
+        return True, None
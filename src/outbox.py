@@ -0,0 +1,288 @@
+"""Transactional outbox для уведомлений.
+
+Хендлеры и Rematcher пишут сообщения в таблицу outbox той же транзакцией,
+что и заявку (add_messages), а OutboxDrainer забирает их пачками и отдаёт
+NotificationDispatcher. Строки берутся через FOR UPDATE SKIP LOCKED и сразу
+получают аренду (available_at = now() + lease), поэтому несколько
+экземпляров бота разбирают очередь параллельно, не пересекаясь. Разборщик не
+ждёт отправки пачки: новые строки забираются, пока в работе меньше
+OUTBOX_IN_FLIGHT сообщений, а каждая отправленная строка помечается sent_at
+по своему завершению (пометки, накопившиеся за один UPDATE, уходят следующим).
+Если процесс упал до пометки, аренда истечёт и сообщение уйдёт ещё раз —
+доставка «хотя бы один раз».
+
+Раз в OUTBOX_PURGE_INTERVAL разборщик удаляет отправленные строки старше
+OUTBOX_RETENTION и исчерпавшие попытки строки, которые пролежали
+OUTBOX_DEAD_RETENTION (время на разбор причин), — иначе очередь растёт без
+конца, а выборка CLAIM по ix_outbox_pending обходит мёртвые строки.
+"""
+import asyncio
+import logging
+from os import getenv
+from typing import Iterable, List, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import BigInteger, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import Outbox, async_session_maker
+
+load_dotenv()
+OUTBOX_BATCH = int(getenv("OUTBOX_BATCH", "100"))
+OUTBOX_INTERVAL = float(getenv("OUTBOX_INTERVAL", "1"))
+# должна покрывать отправку OUTBOX_IN_FLIGHT сообщений с учётом лимитов Telegram
+OUTBOX_LEASE = int(getenv("OUTBOX_LEASE", "120"))
+# 1000 сообщений при 30 в секунду — около 35 секунд
+OUTBOX_IN_FLIGHT = int(getenv("OUTBOX_IN_FLIGHT", "1000"))
+OUTBOX_MAX_ATTEMPTS = int(getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_RETENTION = int(getenv("OUTBOX_RETENTION", str(7 * 24 * 3600)))
+OUTBOX_DEAD_RETENTION = int(getenv("OUTBOX_DEAD_RETENTION", str(30 * 24 * 3600)))
+OUTBOX_PURGE_INTERVAL = float(getenv("OUTBOX_PURGE_INTERVAL", "3600"))
+# строк за один DELETE: короткие транзакции не мешают CLAIM и MARK_SENT
+OUTBOX_PURGE_BATCH = 10_000
+
+CLAIM = text(
+    """
+    UPDATE outbox
+    SET available_at = now() + make_interval(secs => :lease),
+        attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE sent_at IS NULL
+          AND available_at <= now()
+          AND attempts < :max_attempts
+        ORDER BY available_at
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, text
+    """
+)
+
+# отправленные — по ix_outbox_sent, мёртвые (sent_at IS NULL) — по ix_outbox_pending
+PURGE = text(
+    """
+    DELETE FROM outbox
+    WHERE id IN (
+        (
+            SELECT id FROM outbox
+            WHERE sent_at < now() - make_interval(secs => :retention)
+            LIMIT :batch
+        )
+        UNION ALL
+        (
+            SELECT id FROM outbox
+            WHERE sent_at IS NULL
+              AND available_at < now() - make_interval(secs => :dead_retention)
+              AND attempts >= :max_attempts
+            LIMIT :batch
+        )
+    )
+    """
+)
+
+MARK_SENT = text("UPDATE outbox SET sent_at = now() WHERE id = ANY(:ids)").bindparams(
+    bindparam("ids", type_=ARRAY(BigInteger))
+)
+
+
+async def add_messages(session, messages: Iterable[Tuple[str, int, str]]) -> None:
+    """Записывает (send_key, chat_id, text) в outbox; коммит за вызывающим."""
+    rows = [
+        {"send_key": key, "chat_id": chat_id, "text": message}
+        for key, chat_id, message in messages
+    ]
+    if rows:
+        await session.execute(
+            pg_insert(Outbox)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["send_key"])
+        )
+
+
+class OutboxDrainer:
+    def __init__(
+        self,
+        notifier,
+        batch: int = OUTBOX_BATCH,
+        interval: float = OUTBOX_INTERVAL,
+        lease: int = OUTBOX_LEASE,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        max_in_flight: int = OUTBOX_IN_FLIGHT,
+        retention: int = OUTBOX_RETENTION,
+        dead_retention: int = OUTBOX_DEAD_RETENTION,
+        purge_interval: float = OUTBOX_PURGE_INTERVAL,
+    ):
+        self.notifier = notifier
+        self.batch = batch
+        self.interval = interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_in_flight = max_in_flight
+        self.retention = retention
+        self.dead_retention = dead_retention
+        self.purge_interval = purge_interval
+        self.sent = 0
+        self.retried = 0
+        self.purged = 0
+        self._in_flight: Set[int] = set()
+        self._to_mark: List[int] = []
+        self._marking = False
+        self._mark_wakeup = asyncio.Event()
+        self._settled = asyncio.Event()
+        self._settled.set()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self._marker = None
+        self._purger = None
+        # вызываются из wake(), если разборщик не запущен в этом процессе:
+        # в режиме шардирования так будится разборщик воркера 0
+        self.listeners = []
+
+    def wake(self) -> None:
+        """Вызывается после коммита с новыми сообщениями, чтобы не ждать интервал."""
+        if self._task is None:
+            for listener in self.listeners:
+                listener("wake", None)
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        self._stopping = False
+        self._marker = asyncio.create_task(self._mark())
+        self._purger = asyncio.create_task(self._purge_periodically())
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Дожидается отправки и пометки взятых строк."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("outbox not flushed, leased rows will be resent")
+        self._marker.cancel()
+        self._purger.cancel()
+        await asyncio.gather(self._marker, self._purger, return_exceptions=True)
+        self._task = self._marker = self._purger = None
+
+    async def flush(self) -> None:
+        """Ждёт, пока все взятые строки не отправятся и не будут помечены."""
+        await self._settled.wait()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "purged": self.purged,
+            "in_flight": len(self._in_flight),
+        }
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                if await self.drain() >= self.batch:
+                    continue
+            except Exception:
+                logging.exception("outbox drain failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self) -> int:
+        """Забирает строки в пределах max_in_flight, не дожидаясь отправки."""
+        limit = min(self.batch, self.max_in_flight - len(self._in_flight))
+        if limit <= 0:
+            return 0
+        async with async_session_maker() as session:
+            result = await session.execute(
+                CLAIM,
+                {
+                    "lease": self.lease,
+                    "max_attempts": self.max_attempts,
+                    "batch": limit,
+                },
+            )
+            rows = result.all()
+            await session.commit()
+        for row_id, chat_id, message in rows:
+            self._in_flight.add(row_id)
+            self._settled.clear()
+            on_done = self._on_done(row_id)
+            if not self.notifier.enqueue(chat_id, message, on_done):
+                on_done(False)
+        return len(rows)
+
+    async def purge(self) -> int:
+        """Удаляет отжившие строки пачками по OUTBOX_PURGE_BATCH."""
+        params = {
+            "retention": self.retention,
+            "dead_retention": self.dead_retention,
+            "max_attempts": self.max_attempts,
+            "batch": OUTBOX_PURGE_BATCH,
+        }
+        total = 0
+        while True:
+            async with async_session_maker() as session:
+                result = await session.execute(PURGE, params)
+                await session.commit()
+            total += result.rowcount
+            self.purged += result.rowcount
+            if result.rowcount < OUTBOX_PURGE_BATCH:
+                return total
+
+    async def _purge_periodically(self) -> None:
+        while True:
+            try:
+                purged = await self.purge()
+                if purged:
+                    logging.info("outbox: %s old rows purged", purged)
+            except Exception:
+                logging.exception("outbox purge failed")
+            await asyncio.sleep(self.purge_interval)
+
+    def _on_done(self, row_id: int):
+        def done(sent: bool) -> None:
+            self._in_flight.discard(row_id)
+            if sent:
+                self._to_mark.append(row_id)
+                self._mark_wakeup.set()
+            else:
+                # неотправленная строка остаётся арендованной и вернётся
+                # после OUTBOX_LEASE
+                self.retried += 1
+                self._check_settled()
+
+        return done
+
+    def _check_settled(self) -> None:
+        if not self._in_flight and not self._to_mark and not self._marking:
+            self._settled.set()
+
+    async def _mark(self) -> None:
+        while True:
+            await self._mark_wakeup.wait()
+            self._mark_wakeup.clear()
+            if not self._to_mark:
+                continue
+            ids, self._to_mark = self._to_mark, []
+            self._marking = True
+            try:
+                async with async_session_maker() as session:
+                    await session.execute(MARK_SENT, {"ids": ids})
+                    await session.commit()
+                self.sent += len(ids)
+            except Exception:
+                logging.exception("outbox mark sent failed")
+                self._to_mark[:0] = ids
+                await asyncio.sleep(self.interval)
+                self._mark_wakeup.set()
+            finally:
+                self._marking = False
+                self._check_settled()
@@ -0,0 +1,334 @@
+"""Периодический досмотр пар отправитель-курьер.
+
+При создании заявки совпадения ищутся один раз; всё, что появилось позже
+или не дошло из-за перезапуска, подбирает Rematcher. Раз в REMATCH_INTERVAL
+он одним запросом соединяет открытые заявки отправителей с курьерами того же
+направления, берущими весь багаж отправителя, и дописывает найденные id
+курьеров в notified_request_ids.
+Дописывание и есть «захват» пары: повторно её не вернёт ни этот запрос,
+ни claim_pairs при создании заявки, в том числе из другого процесса.
+Между полными проходами (REMATCH_FULL_INTERVAL) соединяются только заявки
+новее последней досмотренной, а не все открытые друг с другом.
+
+Если алиасы сравниваются по городу или стране (MATCH_GRANULARITY, см.
+CityHierarchy), ключи привязанных алиасов передаются в запрос массивом из
+памяти: справочники городов и стран в нём не участвуют.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from os import getenv
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import BigInteger, String, bindparam, func, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import joinedload
+
+from database import Courier, Request, Sender, async_session_maker
+from matching import courier_card, entry_from_request, sender_card
+from outbox import add_messages
+
+load_dotenv()
+REMATCH_INTERVAL = float(getenv("REMATCH_INTERVAL", "60"))
+REMATCH_BATCH = int(getenv("REMATCH_BATCH", "500"))
+# полный проход по всем открытым заявкам; между ними — только по новым
+REMATCH_FULL_INTERVAL = float(getenv("REMATCH_FULL_INTERVAL", "3600"))
+# на сколько id назад от досмотренной заявки начинается следующий проход:
+# заявка с меньшим id могла закоммититься уже после чтения max(id).
+# Повторный просмотр дёшев — уже захваченные пары запрос не вернёт
+REMATCH_OVERLAP = int(getenv("REMATCH_OVERLAP", "1000"))
+CARDS_PER_MESSAGE = 10
+# лимит сообщения Telegram; карточки добавляются, пока текст в него влезает
+MESSAGE_LIMIT = 4096
+
+# пара захватывается, только если ни один из id не был дописан конкурентно:
+# условие в WHERE перепроверяется после блокировки строки
+_CLAIM_UPDATE = """
+    UPDATE requests s
+    SET notified_request_ids = s.notified_request_ids || pairs.ids
+    FROM (
+        SELECT sender_request_id, array_agg(courier_request_id) AS ids
+        FROM candidates
+        GROUP BY sender_request_id
+    ) pairs
+    WHERE s.id = pairs.sender_request_id
+      AND NOT s.notified_request_ids && pairs.ids
+    RETURNING s.id, pairs.ids
+"""
+
+# пары, в которых хотя бы одна заявка новее :since: новые отправители с
+# открытыми курьерами и новые курьеры с открытыми отправителями. Соединяются
+# только новые заявки, а не все открытые между собой; при :since = 0 это
+# полный проход. Ждёт CTE open_requests и fresh и колонки ключей направления
+_CANDIDATES = """
+    candidates AS (
+        SELECT sender_request_id, courier_request_id
+        FROM (
+            SELECT s.id AS sender_request_id, c.id::bigint AS courier_request_id
+            FROM fresh s
+            JOIN open_requests c {on}
+            WHERE {where}
+            UNION
+            SELECT s.id, c.id::bigint
+            FROM open_requests s
+            JOIN fresh c {on}
+            WHERE {where}
+        ) p
+        ORDER BY courier_request_id
+        LIMIT :batch
+    )
+"""
+
+
+def _candidates(origin: str, destination: str) -> str:
+    return _CANDIDATES.format(
+        on=f"""
+              ON c.{origin} = s.{origin}
+             AND c.{destination} = s.{destination}
+             AND s.period @> c.date
+             AND c.baggage_mask & s.baggage_mask = s.baggage_mask""",
+        where="""s.period IS NOT NULL
+              AND c.date IS NOT NULL
+              AND NOT c.id = ANY(s.notified_request_ids)""",
+    )
+
+
+# NOT MATERIALIZED: подзапросы встраиваются, и соединение с новыми заявками
+# идёт по индексу ix_requests_route_date
+CLAIM_NEW_PAIRS = text(
+    """
+    WITH open_requests AS NOT MATERIALIZED (
+        SELECT * FROM requests
+        WHERE status = 'new'
+          AND (date >= current_date OR date_to >= current_date)
+    ),
+    fresh AS NOT MATERIALIZED (
+        SELECT * FROM open_requests WHERE id > :since
+    ),"""
+    + _candidates("origin_id", "destination_id")
+    + _CLAIM_UPDATE
+)
+
+# то же по ключам направлений: алиас из :aliases сравнивается по ключу из
+# :keys, остальные — по своему id
+CLAIM_NEW_PAIRS_BY_ROUTE = text(
+    """
+    WITH route AS (
+        SELECT * FROM unnest(:aliases, :keys) AS r(user_city_id, key)
+    ),
+    open_requests AS (
+        SELECT r.id, r.date, r.period, r.baggage_mask, r.notified_request_ids,
+               coalesce(o.key, 'a' || r.origin_id) AS origin_key,
+               coalesce(d.key, 'a' || r.destination_id) AS destination_key
+        FROM requests r
+        LEFT JOIN route o ON o.user_city_id = r.origin_id
+        LEFT JOIN route d ON d.user_city_id = r.destination_id
+        WHERE r.status = 'new'
+          AND (r.date >= current_date OR r.date_to >= current_date)
+    ),
+    fresh AS (
+        SELECT * FROM open_requests WHERE id > :since
+    ),"""
+    + _candidates("origin_key", "destination_key")
+    + _CLAIM_UPDATE
+).bindparams(
+    bindparam("aliases", type_=ARRAY(BigInteger)),
+    bindparam("keys", type_=ARRAY(String)),
+)
+
+CLAIM_PAIRS = text(
+    """
+    UPDATE requests s
+    SET notified_request_ids = s.notified_request_ids || pairs.ids
+    FROM (
+        SELECT sender_request_id, array_agg(courier_request_id) AS ids
+        FROM unnest(:senders, :couriers) AS p(sender_request_id, courier_request_id)
+        GROUP BY sender_request_id
+    ) pairs
+    WHERE s.id = pairs.sender_request_id
+      AND NOT s.notified_request_ids && pairs.ids
+    RETURNING s.id, pairs.ids
+    """
+).bindparams(
+    bindparam("senders", type_=ARRAY(BigInteger)),
+    bindparam("couriers", type_=ARRAY(BigInteger)),
+)
+
+
+def _pairs(rows) -> List[Tuple[int, int]]:
+    return [(sender_id, courier_id) for sender_id, ids in rows for courier_id in ids]
+
+
+async def claim_pairs(
+    session, pairs: Iterable[Tuple[int, int]]
+) -> Set[Tuple[int, int]]:
+    """Отмечает пары (заявка отправителя, заявка курьера) уведомлёнными.
+
+    Возвращает только те пары, которые отметил этот вызов; коммит за вызывающим.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return set()
+    senders, couriers = zip(*pairs)
+    result = await session.execute(
+        CLAIM_PAIRS, {"senders": list(senders), "couriers": list(couriers)}
+    )
+    return set(_pairs(result.all()))
+
+
+def _pack_cards(header: str, entries) -> Iterator[Tuple[list, str]]:
+    """Делит карточки на сообщения не длиннее MESSAGE_LIMIT символов."""
+    cards, parts, size = [], [], len(header)
+    for entry in entries:
+        card = courier_card(entry)
+        extra = len(card) + (2 if parts else 0)
+        if cards and (len(cards) == CARDS_PER_MESSAGE or size + extra > MESSAGE_LIMIT):
+            yield cards, header + "\n\n".join(parts)
+            cards, parts, size = [], [], len(header)
+            extra = len(card)
+        cards.append(entry)
+        parts.append(card)
+        size += extra
+    if cards:
+        yield cards, header + "\n\n".join(parts)
+
+
+def match_messages(pairs, entries):
+    """Сообщения outbox (send_key, chat_id, text) для пар (отправитель, курьер).
+
+    Отправителю — одно сообщение на заявку со всеми новыми курьерами
+    (по CARDS_PER_MESSAGE, в пределах MESSAGE_LIMIT), курьеру — карточка каждого отправителя.
+    """
+    by_sender = defaultdict(list)
+    messages = []
+    for sender_id, courier_id in pairs:
+        sender, courier = entries.get(sender_id), entries.get(courier_id)
+        if sender is None or courier is None:
+            continue
+        by_sender[sender].append(courier)
+        messages.append(
+            (
+                f"match:{sender_id}:{courier_id}:courier",
+                courier.tg_id,
+                sender_card(sender),
+            )
+        )
+    for sender, couriers in by_sender.items():
+        header = "" if len(couriers) == 1 else "Новые курьеры по вашей заявке:\n\n"
+        for cards, message in _pack_cards(header, couriers):
+            ids = "-".join(str(c.request_id) for c in cards)
+            messages.append(
+                (f"match:{sender.request_id}:{ids}:sender", sender.tg_id, message)
+            )
+    return messages
+
+
+class Rematcher:
+    def __init__(
+        self,
+        outbox,
+        interval: float = REMATCH_INTERVAL,
+        batch=REMATCH_BATCH,
+        route_keys: Callable[[], Dict[int, str]] = dict,
+        full_interval: float = REMATCH_FULL_INTERVAL,
+        overlap: int = REMATCH_OVERLAP,
+    ):
+        # OutboxDrainer: будится после коммита с новыми сообщениями
+        self.outbox = outbox
+        # ключи привязанных алиасов (см. CityHierarchy.route_keys)
+        self.route_keys = route_keys
+        self.interval = interval
+        self.batch = batch
+        self.full_interval = full_interval
+        self.overlap = overlap
+        self.matched = 0
+        self.full_sweeps = 0
+        # следующий проход смотрит заявки с id больше этого; заявки старше
+        # REMATCH_OVERLAP, закоммиченные позже (или с изменившейся привязкой
+        # алиасов), подберёт полный проход
+        self._since = 0
+        self._next_full = 0.0
+        self._task = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "matched": self.matched,
+            "full_sweeps": self.full_sweeps,
+            "since": self._since,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # полная пачка — возможно, есть ещё пары, не ждём интервал
+                while await self.tick() >= self.batch:
+                    pass
+            except Exception:
+                logging.exception("rematch tick failed")
+            await asyncio.sleep(self.interval)
+
+    async def tick(self) -> int:
+        started = time.monotonic()
+        full = started >= self._next_full
+        since = 0 if full else self._since
+        # захват пар и сообщения о них коммитятся вместе
+        async with async_session_maker() as session:
+            top = await session.scalar(select(func.max(Request.id))) or 0
+            params = {"batch": self.batch, "since": since}
+            keys = self.route_keys()
+            if keys:
+                result = await session.execute(
+                    CLAIM_NEW_PAIRS_BY_ROUTE,
+                    {**params, "aliases": list(keys), "keys": list(keys.values())},
+                )
+            else:
+                result = await session.execute(CLAIM_NEW_PAIRS, params)
+            pairs = _pairs(result.all())
+            if not pairs:
+                await session.commit()
+                self._passed(full, started, top)
+                return 0
+            ids = {request_id for pair in pairs for request_id in pair}
+            result = await session.execute(
+                select(Request)
+                .options(
+                    joinedload(Request.origin),
+                    joinedload(Request.destination),
+                    joinedload(Request.courier).joinedload(Courier.user),
+                    joinedload(Request.sender).joinedload(Sender.user),
+                )
+                .filter(Request.id.in_(ids))
+            )
+            entries = {
+                r.id: entry_from_request(r) for r in result.unique().scalars().all()
+            }
+            await add_messages(session, match_messages(pairs, entries))
+            await session.commit()
+        if len(pairs) < self.batch:
+            self._passed(full, started, top)
+        self.outbox.wake()
+        self.matched += len(pairs)
+        logging.info("rematch: %s new pairs", len(pairs))
+        return len(pairs)
+
+    def _passed(self, full: bool, started: float, top: int) -> None:
+        """Проход закончен и закоммичен: следующий — с заявок новее top."""
+        self._since = max(self._since, top - self.overlap)
+        if full:
+            self.full_sweeps += 1
+            self._next_full = started + self.full_interval
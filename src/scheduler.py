@@ -0,0 +1,132 @@
+"""Отложенные действия на хешированном колесе таймеров.
+
+Хендлеры не ждут сами («удалить подсказку через 10 секунд»), а ставят
+действие в Scheduler и сразу возвращаются. Колесо — SCHEDULER_SLOTS ячеек по
+SCHEDULER_TICK секунд: постановка и отмена стоят O(1), за тик разбирается
+одна ячейка. Задержки длиннее оборота колеса ждут нужного числа оборотов.
+
+Удаления сообщений, наступившие в один тик, отправляются через MessageOps,
+то есть одним deleteMessages на чат. Очередь живёт в памяти: при остановке
+оставшиеся действия выполняются сразу, а не теряются.
+"""
+import asyncio
+import logging
+import time
+from os import getenv
+from typing import Callable, List
+
+from dotenv import load_dotenv
+
+from message_ops import MessageOps
+
+load_dotenv()
+SCHEDULER_TICK = float(getenv("SCHEDULER_TICK", "1"))
+SCHEDULER_SLOTS = int(getenv("SCHEDULER_SLOTS", "512"))
+
+
+class Timer:
+    __slots__ = ("rounds", "callback", "args", "cancelled")
+
+    def __init__(self, rounds: int, callback: Callable, args: tuple):
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, bot, tick: float = SCHEDULER_TICK, slots: int = SCHEDULER_SLOTS):
+        self.bot = bot
+        self.tick = tick
+        self._slots: List[List[Timer]] = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._ops = MessageOps()
+        self._task = None
+        self.pending = 0
+        self.fired = 0
+        self.cancelled = 0
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        """Вызвать callback(*args) через delay секунд с точностью до тика.
+
+        callback синхронный и быстрый: он выполняется в цикле колеса.
+        """
+        ticks = max(1, -int(-delay // self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        timer = Timer((ticks - 1) // len(self._slots), callback, args)
+        self._slots[slot].append(timer)
+        self.pending += 1
+        return timer
+
+    def delete_later(self, chat_id: int, message_id: int, delay: float) -> Timer:
+        return self.call_later(delay, self._delete, chat_id, message_id)
+
+    def _delete(self, chat_id: int, message_id: int) -> None:
+        self._ops.delete(chat_id, message_id)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "fired": self.fired,
+            "cancelled": self.cancelled,
+        }
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for slot in self._slots:
+            self._fire(slot, force=True)
+            slot.clear()
+        await self._flush()
+
+    async def _run(self) -> None:
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            # после задержки цикла событий догоняем пропущенные тики
+            while next_tick <= time.monotonic():
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                # колбэк может поставить таймер в эту же ячейку — разбираем копию
+                slot, self._slots[self._cursor] = self._slots[self._cursor], []
+                self._slots[self._cursor].extend(self._fire(slot))
+                next_tick += self.tick
+            await self._flush()
+
+    def _fire(self, slot: List[Timer], force: bool = False) -> List[Timer]:
+        """Выполняет наступившие таймеры ячейки, возвращает оставшиеся."""
+        waiting = []
+        for timer in slot:
+            if timer.cancelled:
+                self.pending -= 1
+                self.cancelled += 1
+            elif timer.rounds and not force:
+                timer.rounds -= 1
+                waiting.append(timer)
+            else:
+                self.pending -= 1
+                self.fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logging.exception("scheduled callback failed")
+        return waiting
+
+    async def _flush(self) -> None:
+        ops, self._ops = self._ops, MessageOps()
+        try:
+            await ops.flush(self.bot)
+        except Exception:
+            logging.exception("scheduled deletes failed")
@@ -0,0 +1,221 @@
+"""Режим шардирования: супервизор + N процессов-воркеров.
+
+Супервизор получает апдейты через getUpdates и раскладывает их по воркерам
+по chat_id % N, поэтому апдейты одного чата всегда обрабатывает один и тот же
+процесс в порядке поступления. Каждый воркер импортирует bot заново (spawn),
+то есть у него свой пул соединений, свой Dispatcher с form_router и свои кеши.
+Изменения индекса матчинга и инвалидация клавиатур рассылаются остальным
+воркерам через супервизор.
+
+Воркеры запускаются через spawn, а spawn в каждом дочернем процессе заново
+выполняет главный модуль родителя (как __mp_main__). Поэтому главный модуль
+режима — этот, а не bot: иначе синглтоны bot и регистрация коллекторов
+метрик выполнялись бы в воркере дважды. python src/bot.py с BOT_MODE=sharded
+передаёт управление сюда (exec). Рассылка уведомлений (NotificationDispatcher,
+OutboxDrainer, Rematcher) работает только в воркере 0: лимит Telegram общий
+на бота, а N копий слали бы в N раз быстрее. Остальные воркеры после коммита
+с сообщениями будят его разборщик через тот же канал.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from os import getenv
+
+from aiogram import Bot
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from dotenv import load_dotenv
+
+load_dotenv()
+SHARD_WORKERS = int(getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+SHARD_REPORT_INTERVAL = float(getenv("SHARD_REPORT_INTERVAL", "60"))
+
+
+def chat_id_of(update: Update) -> int:
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = event.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    return user.id if user is not None else 0
+
+
+def worker_main(index, inbox, events, processed) -> None:
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    # останавливает супервизор, сигнал от терминала воркеру не нужен
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker(index, inbox, events, processed))
+
+
+async def _worker(index, inbox, events, processed) -> None:
+    import bot as app
+    import metrics
+    import my_keyboards
+    from matching import match_index
+
+    if metrics.METRICS_PORT:
+        # у каждого воркера свой /metrics: METRICS_PORT + номер воркера
+        metrics.METRICS_PORT = str(int(metrics.METRICS_PORT) + index)
+
+    def publish(kind):
+        return lambda op, arg: events.put((index, kind, op, arg))
+
+    match_index.listeners.append(publish("match_index"))
+    my_keyboards.invalidation_listeners.append(publish("keyboards"))
+    app.run_background = index == 0
+    if index:
+        app.outbox_drainer.listeners.append(publish("outbox"))
+
+    dp = app.build_dispatcher()
+    await dp.emit_startup(bot=app.bot, dispatcher=dp)
+
+    tails = {}
+
+    async def handle(chat_id, raw, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            result = await dp.feed_raw_update(app.bot, raw)
+            if isinstance(result, TelegramMethod):
+                await dp.silent_call_request(app.bot, result)
+        except Exception:
+            logging.exception("update %s failed", raw.get("update_id"))
+        processed[index] += 1
+
+    def forget(chat_id, task):
+        if tails.get(chat_id) is task:
+            del tails[chat_id]
+
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await loop.run_in_executor(None, inbox.get)
+        if message is None:
+            break
+        kind, *payload = message
+        if kind == "update":
+            chat_id, raw = payload
+            task = asyncio.create_task(handle(chat_id, raw, tails.get(chat_id)))
+            tails[chat_id] = task
+            task.add_done_callback(lambda t, c=chat_id: forget(c, t))
+        elif kind == "match_index":
+            op, arg = payload
+            getattr(match_index, op)(arg, publish=False)
+        elif kind == "keyboards":
+            op, arg = payload
+            if op == "invalidate_countries":
+                my_keyboards.invalidate_countries(publish=False)
+            else:
+                my_keyboards.invalidate_cities(arg, publish=False)
+        elif kind == "outbox":
+            if app.run_background:
+                app.outbox_drainer.wake()
+
+    if tails:
+        await asyncio.wait(list(tails.values()))
+    await dp.emit_shutdown(bot=app.bot, dispatcher=dp)
+    await app.bot.session.close()
+
+
+def _relay(events, inboxes) -> None:
+    while True:
+        message = events.get()
+        if message is None:
+            return
+        source, kind, op, arg = message
+        for index, inbox in enumerate(inboxes):
+            if index != source:
+                inbox.put((kind, op, arg))
+
+
+def _report(processed, stop) -> None:
+    previous = list(processed)
+    while not stop.wait(SHARD_REPORT_INTERVAL):
+        current = list(processed)
+        rates = [
+            (now - before) / SHARD_REPORT_INTERVAL
+            for now, before in zip(current, previous)
+        ]
+        previous = current
+        logging.info(
+            "shard throughput, updates/s: %s, total processed: %s",
+            " ".join(f"w{i}={rate:.1f}" for i, rate in enumerate(rates)),
+            sum(current),
+        )
+
+
+async def _poll(bot: Bot, inboxes, stop) -> None:
+    offset = None
+    try:
+        while not stop.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30)
+            except Exception:
+                logging.exception("getUpdates failed")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                chat_id = chat_id_of(update)
+                raw = update.model_dump(mode="json", exclude_unset=True)
+                inboxes[chat_id % len(inboxes)].put(("update", chat_id, raw))
+    finally:
+        await bot.session.close()
+
+
+def run_sharded(token: str, workers: int = SHARD_WORKERS) -> None:
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(workers)]
+    events = ctx.Queue()
+    processed = ctx.Array("Q", workers, lock=False)
+    processes = [
+        ctx.Process(
+            target=worker_main,
+            args=(index, inboxes[index], events, processed),
+            name=f"shard-{index}",
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    stop = threading.Event()
+    relay = threading.Thread(target=_relay, args=(events, inboxes), daemon=True)
+    relay.start()
+    threading.Thread(target=_report, args=(processed, stop), daemon=True).start()
+
+    # SIGTERM завершает супервизор так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    bot = Bot(token=token)
+    started = time.monotonic()
+    try:
+        asyncio.run(_poll(bot, inboxes, stop))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        stop.set()
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in processes:
+            process.join()
+        events.put(None)
+        relay.join()
+        elapsed = time.monotonic() - started
+        logging.info(
+            "shards stopped: %s",
+            " ".join(
+                f"w{i}={count} ({count / elapsed:.1f}/s)"
+                for i, count in enumerate(processed)
+            ),
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    run_sharded(getenv("BOT_TOKEN"))
@@ -0,0 +1,43 @@
+import logging
+from os import getenv
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+# публичный адрес, на который Telegram шлёт апдейты; без него вебхук
+# не регистрируется (удобно для локальной проверки через curl)
+WEBHOOK_BASE_URL = getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+# в фоне: Telegram получает 200 сразу, но ответ хендлера уже не может
+# уйти в теле ответа на вебхук
+WEBHOOK_BACKGROUND = getenv("WEBHOOK_BACKGROUND", "0") == "1"
+WEBAPP_HOST = getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(getenv("WEBAPP_PORT", "8080"))
+
+
+async def set_webhook(bot: Bot) -> None:
+    if not WEBHOOK_BASE_URL:
+        logging.warning("WEBHOOK_BASE_URL is not set, webhook is not registered")
+        return
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET
+    )
+
+
+def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    dp.startup.register(set_webhook)
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=WEBHOOK_BACKGROUND,
+    ).register(app, path=WEBHOOK_PATH)
+    # startup/shutdown диспетчера привязываются к жизненному циклу aiohttp,
+    # run_app по SIGINT/SIGTERM дожидается завершения запросов и on_shutdown
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+# модули создают engine при импорте; без базы хватает любого адреса, а
+# тесты с фикстурой in_transaction пропускаются
+DB_AVAILABLE = bool(os.environ.get("DATABASE_URL"))
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/courier")
+
+
+@pytest.fixture
+def db():
+    """Пропускает тест, если базы нет."""
+    if not DB_AVAILABLE:
+        pytest.skip("DATABASE_URL is not set")
+
+
+@pytest.fixture
+def in_transaction(db):
+    """Запускает async body(session) в транзакции, которая откатывается."""
+
+    def run(body):
+        async def main():
+            from database import async_session_maker, engine
+
+            try:
+                async with async_session_maker() as session:
+                    try:
+                        return await body(session)
+                    finally:
+                        await session.rollback()
+            finally:
+                # соединения пула привязаны к циклу событий этого теста
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,107 @@
+import importlib.util
+import json
+import os
+from itertools import combinations
+
+import pytest
+from sqlalchemy import text
+
+from database import BAGGAGE_BITS, RU_LABELS, BaggageKind, baggage_labels, baggage_mask
+
+_path = os.path.join(
+    os.path.dirname(__file__),
+    os.pardir,
+    "alembic",
+    "versions",
+    "d2b8e6f1a3c4_requests_baggage_mask.py",
+)
+_spec = importlib.util.spec_from_file_location("baggage_mask_migration", _path)
+migration = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(migration)
+
+
+def _migrated_mask(stored: str) -> int:
+    # то же, что UPDATE в upgrade(): bit_or по needle, найденным strpos
+    mask = 0
+    for bit, needle in migration._needles():
+        if needle in stored:
+            mask |= bit
+    return mask
+
+
+def test_kinds_match_model():
+    # миграция зафиксировала биты и названия; модель не должна их сдвигать
+    assert [(bit, key, label) for bit, key, label in migration.KINDS] == [
+        (BAGGAGE_BITS[kind], kind.value, RU_LABELS[kind]) for kind in BaggageKind
+    ]
+
+
+def test_needles_cover_both_escapings():
+    needles = migration._needles()
+    for bit, key, label in migration.KINDS:
+        for name in (key, label):
+            assert (bit, json.dumps(name)) in needles
+            assert (bit, json.dumps(name, ensure_ascii=False)) in needles
+
+
+def test_needles_do_not_overlap():
+    needles = migration._needles()
+    for (bit_a, a), (bit_b, b) in combinations(needles, 2):
+        if bit_a != bit_b:
+            assert a not in b and b not in a
+    # значения подставляются в SQL строковыми литералами
+    assert not any("'" in needle for _, needle in needles)
+
+
+@pytest.mark.parametrize(
+    "stored, expected",
+    [
+        ("[]", 0),
+        (json.dumps(["Обычный", "Жидкость"]), 0b11),
+        (json.dumps(["Обычный", "Жидкость"], ensure_ascii=False), 0b11),
+        (json.dumps(["usual", "document"]), 0b1001),
+        (json.dumps(["Другое", "other"], ensure_ascii=False), 0b100000),
+        (json.dumps(["Проблемный", "Ценный"]), 0b10100),
+    ],
+)
+def test_upgrade_mapping(stored, expected):
+    assert _migrated_mask(stored) == expected
+
+
+@pytest.mark.parametrize("mask", range(1 << len(BaggageKind)))
+def test_downgrade_round_trip(mask):
+    # downgrade пишет русские названия через ", " в порядке битов
+    labels = [json.dumps(label) for bit, _, label in migration.KINDS if mask & bit]
+    stored = "[" + ", ".join(labels) + "]"
+    assert baggage_mask(json.loads(stored)) == mask
+    assert _migrated_mask(stored) == mask
+
+
+def test_upgrade_sql(in_transaction):
+    async def body(session):
+        query = text(
+            f"""
+            SELECT coalesce(
+                (
+                    SELECT bit_or(k.bit)
+                    FROM (VALUES {migration._values(migration._needles())})
+                        AS k(bit, needle)
+                    WHERE strpos(:stored, k.needle) > 0
+                ),
+                0
+            )
+            """
+        )
+        stored = json.dumps(["Ценный", "usual"], ensure_ascii=False)
+        return await session.scalar(query, {"stored": stored})
+
+    assert in_transaction(body) == 0b101
+
+
+def test_mask_and_labels():
+    mask = baggage_mask(["Обычный", "document", BaggageKind.liquid])
+    assert mask == 0b1011
+    assert baggage_labels(mask) == ("Обычный", "Жидкость", "Документ")
+    assert baggage_labels(0) == ()
+    with pytest.raises(KeyError):
+        baggage_mask(["Готово"])
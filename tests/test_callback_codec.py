@@ -0,0 +1,121 @@
+import asyncio
+import base64
+
+import pytest
+from aiogram.filters.callback_data import MAX_CALLBACK_LENGTH
+from aiogram.types import CallbackQuery, User
+
+from my_keyboards import (
+    BaggageKindCallback,
+    BaggageKinds,
+    CancelReqCallback,
+    CityCallback,
+    CitySuggestionCallback,
+    CountryCallback,
+    DirectionEnum,
+    PickerCallback,
+    RoleCallback,
+    RoleModelEnum,
+)
+
+
+def _raw(cls, payload: bytes) -> str:
+    return cls.__head__ + base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+@pytest.mark.parametrize(
+    "callback",
+    [
+        RoleCallback(model=RoleModelEnum.courier),
+        CancelReqCallback(id=123, before=456),
+        CancelReqCallback(id=2**40, before=0),
+        CountryCallback(direction=DirectionEnum.to, id=7),
+        CityCallback(direction=DirectionEnum.from_, id=0),
+        PickerCallback(direction=DirectionEnum.from_, country_id=7, prefix="Ж"),
+        PickerCallback(direction=DirectionEnum.to, after=-1, before=99999),
+        CitySuggestionCallback(user_city_id=5),
+        BaggageKindCallback(kind=BaggageKinds.finish),
+    ],
+)
+def test_round_trip(callback):
+    packed = callback.pack()
+    assert len(packed.encode()) <= MAX_CALLBACK_LENGTH
+    assert type(callback).unpack(packed) == callback
+
+
+def test_compact_is_shorter_than_text():
+    assert CancelReqCallback(id=123, before=456).pack() == "x:9gGQBw"
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("role:Courier", RoleCallback(model=RoleModelEnum.courier)),
+        ("cancel_req:123:456", CancelReqCallback(id=123, before=456)),
+        # кнопка отправлена до появления поля before
+        ("cancel_req:123", CancelReqCallback(id=123)),
+        ("city:from:5", CityCallback(direction=DirectionEnum.from_, id=5)),
+        ("baggage_kind:Жидкость", BaggageKindCallback(kind=BaggageKinds.liquid)),
+    ],
+)
+def test_legacy(value, expected):
+    assert type(expected).unpack(value) == expected
+
+
+@pytest.mark.parametrize(
+    "cls, value",
+    [
+        (CancelReqCallback, "cancel_req"),
+        (CancelReqCallback, "cancel_req:1:2:3"),
+        (CityCallback, "city:from"),
+        (CountryCallback, "city:from:5"),
+        (RoleCallback, "general:start_button"),
+    ],
+)
+def test_bad_legacy(cls, value):
+    with pytest.raises(ValueError):
+        cls.unpack(value)
+
+
+@pytest.mark.parametrize(
+    "cls, value",
+    [
+        (CancelReqCallback, "x:"),
+        # varint обрывается
+        (CancelReqCallback, _raw(CancelReqCallback, b"\x80")),
+        # лишние байты после последнего поля
+        (RoleCallback, _raw(RoleCallback, b"\x00\x00")),
+        (RoleCallback, "r:!!"),
+    ],
+)
+def test_malformed(cls, value):
+    with pytest.raises(ValueError):
+        cls.unpack(value)
+
+
+@pytest.mark.parametrize("index", [-1, 2, 100])
+def test_enum_index_out_of_range(index):
+    zigzag = index * 2 if index >= 0 else -index * 2 - 1
+    with pytest.raises(ValueError):
+        RoleCallback.unpack(_raw(RoleCallback, bytes([zigzag])))
+
+
+def test_too_long():
+    with pytest.raises(ValueError):
+        PickerCallback(direction=DirectionEnum.to, prefix="я" * 40).pack()
+
+
+def _query(data):
+    user = User(id=1, is_bot=False, first_name="Test")
+    return CallbackQuery(id="1", from_user=user, chat_instance="test", data=data)
+
+
+def test_filter():
+    callback_filter = CityCallback.filter()
+    packed = CityCallback(direction=DirectionEnum.to, id=3).pack()
+    assert asyncio.run(callback_filter(_query(packed))) == {
+        "callback_data": CityCallback(direction=DirectionEnum.to, id=3)
+    }
+    assert asyncio.run(callback_filter(_query("city:to:3")))
+    assert not asyncio.run(callback_filter(_query("co:AAY")))
+    assert not asyncio.run(callback_filter(_query("general:start_button")))
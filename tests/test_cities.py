@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+
+from cities import CityEntry, CityHierarchy, CityIndex, normalize, trigrams
+from database import City, Country, User
+
+
+@pytest.mark.parametrize(
+    "name, key",
+    [
+        ("Москва", "moskva"),
+        ("  МОСКВА ", "moskva"),
+        ("Moskva", "moskva"),
+        ("Санкт-Петербург", "sankt peterburg"),
+        ("Ростов-на-Дону", "rostov na donu"),
+        ("Щёлково", "shchelkovo"),
+        ("Нур_Султан", "nur sultan"),
+        ("Объячево", "obiachevo"),
+        ("São Paulo", "são paulo"),
+        ("--", ""),
+    ],
+)
+def test_normalize(name, key):
+    assert normalize(name) == key
+
+
+def test_trigrams():
+    assert trigrams("ab") == {"  a", " ab", "ab "}
+
+
+def _entry(name, user_city_id=None, city_id=None):
+    return CityEntry(normalize(name), name, user_city_id, city_id)
+
+
+@pytest.fixture
+def index():
+    index = CityIndex(limit=5)
+    for i, name in enumerate(
+        ["Москва", "Мосальск", "Казань", "Калуга", "Санкт-Петербург", "Moscow"], 1
+    ):
+        index.add(_entry(name, city_id=i))
+    return index
+
+
+def test_lookup(index):
+    assert index.lookup("москва").city_id == 1
+    # тот же ключ латиницей
+    assert index.lookup("Moskva").city_id == 1
+    assert index.lookup("санкт петербург").city_id == 5
+    assert index.lookup("Тверь") is None
+    assert index.stats() == {"size": 6, "hits": 3, "misses": 1}
+
+
+def test_alias_replaces_gazetteer_entry(index):
+    index.add(_entry("Москва", user_city_id=10, city_id=1))
+    # вторая строка user_cities с тем же ключом не вытесняет первую
+    index.add(_entry("MOSKVA", user_city_id=11, city_id=1))
+    assert index.lookup("Москва").user_city_id == 10
+    assert index.get(10).user_city_id == 10
+    assert index.get(11).user_city_id == 10
+    assert index.get_city(1).user_city_id == 10
+    # справочная запись после алиаса ничего не меняет
+    index.add(_entry("Москва", city_id=1))
+    assert index.lookup("Москва").user_city_id == 10
+    assert len(index) == 6
+
+
+def test_suggest_prefix_first(index):
+    names = [entry.name for entry in index.suggest("Мос")]
+    # продолжения введённого, короче — выше; Moscow тоже начинается с «mos»
+    assert sorted(names[:2]) == ["Moscow", "Москва"]
+    assert names[2] == "Мосальск"
+
+
+def test_suggest_typo(index):
+    assert [entry.name for entry in index.suggest("Масква")][0] == "Москва"
+    assert [entry.name for entry in index.suggest("Казнь")][0] == "Казань"
+
+
+def test_suggest_threshold_and_limit(index):
+    assert index.suggest("Владивосток") == []
+    assert index.suggest("") == []
+    assert len(index.suggest("Ка", limit=1)) == 1
+
+
+def test_suggest_after_add(index):
+    index.suggest("Ка")
+    # новые названия попадают в поиск по префиксу после уже отсортированных
+    index.add(_entry("Камышин", user_city_id=20))
+    assert "Камышин" in [entry.name for entry in index.suggest("Кам")]
+
+
+def test_create_forgotten_on_rollback(in_transaction):
+    index = CityIndex()
+
+    async def body(session):
+        user = User(tg_id=-424243, name="test")
+        session.add(user)
+        await session.flush()
+        entry = await index.create(session, "Тестоград Отката", user.id)
+        assert index.lookup("тестоград отката") == entry
+        assert index.get(entry.user_city_id) == entry
+        return entry
+
+    entry = in_transaction(body)
+    # строка откатилась: название остаётся, ссылки на user_cities нет
+    assert index.get(entry.user_city_id) is None
+    assert index.lookup("Тестоград Отката").user_city_id is None
+
+
+def test_hierarchy_granularity_checked():
+    with pytest.raises(ValueError):
+        CityHierarchy(granularity="street")
+
+
+def test_hierarchy_alias():
+    hierarchy = CityHierarchy(granularity="alias")
+
+    async def link():
+        # при alias база не нужна
+        await hierarchy.link(None, 1, 100)
+        await hierarchy.link(None, 2, 100)
+
+    asyncio.run(link())
+    assert hierarchy.members(1) == {1}
+    assert hierarchy.route_keys() == {}
+
+
+def test_hierarchy_city():
+    hierarchy = CityHierarchy(granularity="city")
+
+    async def link():
+        for user_city_id, city_id in [(1, 100), (2, 100), (3, 200), (3, 100)]:
+            await hierarchy.link(None, user_city_id, city_id)
+
+    asyncio.run(link())
+    # алиас 3 перепривязан к городу 100 и ушёл из группы 200
+    assert hierarchy.members(1) == hierarchy.members(3) == {1, 2, 3}
+    assert hierarchy.members(4) == {4}
+    assert hierarchy.route_keys() == {1: "c100", 2: "c100", 3: "c100"}
+    assert hierarchy.stats() == {"aliases": 3, "keys": 2}
+
+
+def test_hierarchy_country(in_transaction):
+    hierarchy = CityHierarchy(granularity="country")
+
+    async def body(session):
+        country = Country(name="Тестландия")
+        session.add(country)
+        await session.flush()
+        cities = [City(name=f"Тестоград {i}", country_id=country.id) for i in (1, 2)]
+        session.add_all(cities)
+        await session.flush()
+        await hierarchy.link(session, 1, cities[0].id)
+        await hierarchy.link(session, 2, cities[1].id)
+        return country.id
+
+    country_id = in_transaction(body)
+    assert hierarchy.members(1) == {1, 2}
+    assert hierarchy.route_keys() == {1: f"k{country_id}", 2: f"k{country_id}"}
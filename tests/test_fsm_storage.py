@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import delete
+
+from database import FsmState, async_session_maker, engine
+from fsm_storage import PostgresStorage, _key
+
+# отрицательный bot_id не встречается у настоящих ботов
+BOT_ID = -1
+
+
+def _storage_key(chat_id):
+    return StorageKey(bot_id=BOT_ID, chat_id=chat_id, user_id=chat_id)
+
+
+@pytest.fixture
+def run(db):
+    """Запускает async body(); строки тестового бота удаляются после."""
+
+    def run(body):
+        async def main():
+            try:
+                return await body()
+            finally:
+                async with async_session_maker() as session:
+                    await session.execute(
+                        delete(FsmState).filter(FsmState.key.like(f"{BOT_ID}:%"))
+                    )
+                    await session.commit()
+                await engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_write_through(run):
+    key = _storage_key(1)
+
+    async def body():
+        storage = PostgresStorage()
+        await storage.set_state(key, "Form:city")
+        await storage.set_data(key, {"name": "Иван", "prompt_id": 5})
+        cached = (await storage.get_state(key), await storage.get_data(key))
+        # новое хранилище — как после перезапуска: читает из базы
+        restarted = PostgresStorage()
+        stored = (await restarted.get_state(key), await restarted.get_data(key))
+        return cached, stored, storage.stats(), restarted.stats()
+
+    cached, stored, stats, restarted = run(body)
+    assert cached == stored == ("Form:city", {"name": "Иван", "prompt_id": 5})
+    assert (stats["writes"], stats["misses"]) == (2, 1)
+    assert (restarted["misses"], restarted["hits"]) == (1, 1)
+
+
+def test_missing_key_cached(run):
+    async def body():
+        storage = PostgresStorage()
+        for _ in range(3):
+            assert await storage.get_state(_storage_key(2)) is None
+        return storage.stats()
+
+    stats = run(body)
+    assert (stats["misses"], stats["hits"]) == (1, 2)
+
+
+def test_data_is_copied(run):
+    key = _storage_key(3)
+
+    async def body():
+        storage = PostgresStorage()
+        data = {"a": 1}
+        await storage.set_data(key, data)
+        data["a"] = 2
+        (await storage.get_data(key))["a"] = 3
+        return await storage.get_data(key)
+
+    assert run(body) == {"a": 1}
+
+
+def test_ttl(run):
+    key = _storage_key(4)
+
+    async def body():
+        storage = PostgresStorage(ttl=60)
+        await storage.set_state(key, "Form:city")
+        db_key = _key(key)
+        state, data, _ = storage._cache[db_key]
+        storage._cache[db_key] = (state, data, time.monotonic() - 61)
+        expired = await storage.get_state(key)
+        # в базе строка свежая, но короткий TTL делает её брошенной
+        short = PostgresStorage(ttl=0)
+        return expired, await short.get_state(key), storage.expired, short.expired
+
+    assert run(body) == (None, None, 1, 1)
+
+
+def test_lru(run):
+    async def body():
+        storage = PostgresStorage(maxsize=2)
+        for chat_id in (5, 6, 7):
+            await storage.set_state(_storage_key(chat_id), "Form:city")
+        return [_key(_storage_key(chat_id)) in storage._cache for chat_id in (5, 6, 7)]
+
+    assert run(body) == [False, True, True]
+
+
+def test_write_in_session(run):
+    key = _storage_key(8)
+
+    async def body():
+        storage = PostgresStorage()
+        async with async_session_maker() as session:
+            await storage.write(key, "Form:date", {"x": 1}, session)
+            # до коммита кеш не обновляется
+            assert _key(key) not in storage._cache
+            await session.rollback()
+        after_rollback = await PostgresStorage().get_state(key)
+        async with async_session_maker() as session:
+            await storage.write(key, "Form:date", {"x": 1}, session)
+            await session.commit()
+        return after_rollback, storage._cache[_key(key)][:2], storage.writes
+
+    assert run(body) == (None, ("Form:date", {"x": 1}), 1)
+
+
+def test_active_chats(run):
+    async def body():
+        storage = PostgresStorage()
+        await storage.set_data(_storage_key(9), {"name": "Пётр"})
+        await storage.set_state(_storage_key(9), "Form:city")
+        await storage.set_state(_storage_key(10), "Form:date")
+        # законченная форма: state сброшен
+        await storage.set_data(_storage_key(11), {"name": "done"})
+        chats = await storage.active_chats(limit=1000)
+        return {chat_id: chats.get(chat_id) for chat_id in (9, 10, 11)}
+
+    assert run(body) == {9: "Пётр", 10: "", 11: None}
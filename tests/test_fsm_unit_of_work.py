@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from fsm_storage import FSMUnitOfWorkMiddleware, UnitOfWorkFSMContext
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+
+class Form(StatesGroup):
+    city = State()
+    date = State()
+
+
+class RecordingStorage(MemoryStorage):
+    """MemoryStorage с write, как у PostgresStorage; считает вызовы."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def set_state(self, key, state=None):
+        self.calls.append("set_state")
+        await super().set_state(key, state)
+
+    async def set_data(self, key, data):
+        self.calls.append("set_data")
+        await super().set_data(key, data)
+
+    async def get_data(self, key):
+        self.calls.append("get_data")
+        return await super().get_data(key)
+
+    async def write(self, key, state, data, session=None):
+        self.calls.append(("write", session))
+        await super().set_state(key, state)
+        await super().set_data(key, data)
+
+
+def _context(storage, raw_state=None):
+    return UnitOfWorkFSMContext(FSMContext(storage, KEY), raw_state)
+
+
+def test_buffered_until_flush():
+    storage = RecordingStorage()
+
+    async def main():
+        await storage.set_data(KEY, {"name": "Иван"})
+        storage.calls.clear()
+        context = _context(storage, Form.city.state)
+        await context.set_state(Form.date)
+        data = await context.update_data(prompt_id=7)
+        await context.update_data({"city": 3})
+        before = await storage.get_state(KEY)
+        state = await context.get_state()
+        await context.flush("session")
+        return data, before, state
+
+    data, before, state = asyncio.run(main())
+    assert data == {"name": "Иван", "prompt_id": 7}
+    assert (before, state) == (None, Form.date.state)
+    # данные прочитаны один раз, записано всё одним вызовом
+    assert storage.calls == ["get_data", ("write", "session")]
+    assert storage.storage[KEY].state == Form.date.state
+    assert storage.storage[KEY].data == {"name": "Иван", "prompt_id": 7, "city": 3}
+
+
+def test_flush_state_only_loads_data():
+    storage = RecordingStorage()
+
+    async def main():
+        await storage.set_data(KEY, {"name": "Иван"})
+        storage.calls.clear()
+        context = _context(storage)
+        await context.set_state(Form.city)
+        await context.flush()
+        await context.flush()
+
+    asyncio.run(main())
+    # write пишет и данные, поэтому они подгружаются перед ним; второй
+    # flush без изменений ничего не делает
+    assert storage.calls == ["get_data", ("write", None)]
+    assert storage.storage[KEY].data == {"name": "Иван"}
+
+
+def test_no_changes_no_writes():
+    storage = RecordingStorage()
+
+    async def main():
+        context = _context(storage, Form.city.state)
+        await context.get_state()
+        await context.get_data()
+        await context.flush()
+
+    asyncio.run(main())
+    assert storage.calls == ["get_data"]
+
+
+def test_storage_without_write():
+    storage = MemoryStorage()
+
+    async def main():
+        context = _context(storage)
+        await context.set_data({"a": 1})
+        returned = await context.get_data()
+        returned["a"] = 2
+        await context.set_state(Form.city)
+        await context.flush()
+        return await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert asyncio.run(main()) == (Form.city.state, {"a": 1})
+
+
+def _middleware(handler, storage):
+    data = {
+        "state": FSMContext(storage, KEY),
+        "raw_state": None,
+        "session": "session",
+    }
+    return asyncio.run(FSMUnitOfWorkMiddleware()(handler, None, data))
+
+
+def test_middleware_flushes_into_session():
+    storage = RecordingStorage()
+
+    async def handler(event, data):
+        assert isinstance(data["state"], UnitOfWorkFSMContext)
+        await data["state"].set_state(Form.city)
+        assert storage.calls == []
+        return "ok"
+
+    assert _middleware(handler, storage) == "ok"
+    assert storage.calls == ["get_data", ("write", "session")]
+
+
+def test_middleware_drops_changes_on_error():
+    storage = RecordingStorage()
+
+    async def handler(event, data):
+        await data["state"].set_state(Form.city)
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        _middleware(handler, storage)
+    assert storage.calls == []
+
+
+def test_middleware_without_state():
+    async def handler(event, data):
+        return data
+
+    assert asyncio.run(FSMUnitOfWorkMiddleware()(handler, None, {})) == {}
@@ -0,0 +1,113 @@
+import time
+
+from database import Courier, User, upsert, upsert_many
+from identity import Identity, IdentityCache
+
+TG_ID = -434343
+
+
+def test_lru_eviction():
+    cache = IdentityCache(maxsize=2)
+    for tg_id in (1, 2):
+        cache.put(tg_id, Identity(user_id=tg_id, name=""))
+    cache.get(1)
+    cache.put(3, Identity(user_id=3, name=""))
+    # вытесняется давно не читанная запись
+    assert cache.get(2) is None
+    assert cache.get(1).user_id == 1 and cache.get(3).user_id == 3
+
+
+def test_ttl():
+    cache = IdentityCache(ttl=60)
+    cache.put(1, Identity(user_id=1, name=""))
+    cache._items[1] = (time.monotonic() - 1, cache._items[1][1])
+    assert cache.get(1) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_upsert_created(in_transaction):
+    async def body(session):
+        first, created = await upsert(
+            session, User, defaults={"name": "first"}, tg_id=TG_ID
+        )
+        second, created_again = await upsert(
+            session, User, defaults={"name": "second"}, tg_id=TG_ID
+        )
+        return first.id, created, second.id, created_again, second.name
+
+    first_id, created, second_id, created_again, name = in_transaction(body)
+    assert (created, created_again) == (True, False)
+    # defaults не перезаписывают существующую строку
+    assert first_id == second_id and name == "first"
+
+
+def test_upsert_many(in_transaction):
+    async def body(session):
+        existing, _ = await upsert(session, User, defaults={"name": "old"}, tg_id=TG_ID)
+        rows = await upsert_many(
+            session,
+            User,
+            [
+                {"tg_id": TG_ID, "name": "new"},
+                {"tg_id": TG_ID - 1, "name": "a"},
+                # повтор ключа в пачке
+                {"tg_id": TG_ID - 1, "name": "b"},
+            ],
+            ["tg_id"],
+        )
+        empty = await upsert_many(session, User, [], ["tg_id"])
+        rows = {
+            key: (user.id, user.name, created) for key, (user, created) in rows.items()
+        }
+        return existing.id, rows, empty
+
+    existing_id, rows, empty = in_transaction(body)
+    assert set(rows) == {(TG_ID,), (TG_ID - 1,)}
+    assert rows[(TG_ID,)] == (existing_id, "old", False)
+    assert rows[(TG_ID - 1,)][1:] == ("a", True)
+    assert empty == {}
+
+
+def test_resolve_and_role_id(in_transaction):
+    cache = IdentityCache()
+
+    async def body(session):
+        identity = await cache.resolve(session, TG_ID, "test")
+        again = await cache.resolve(session, TG_ID, "test")
+        courier_id = await cache.role_id(session, TG_ID, "test", Courier)
+        cached = cache.get(TG_ID)
+        return identity, again, courier_id, cached
+
+    identity, again, courier_id, cached = in_transaction(body)
+    assert identity is again and identity.courier_id is None
+    assert cached.courier_id == courier_id and cached.sender_id is None
+    # role_id берёт пользователя из кеша
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    # пользователь откатился вместе с транзакцией — кеш забыл его
+    assert cache.get(TG_ID) is None
+
+
+def test_warm(in_transaction):
+    cache = IdentityCache()
+
+    async def body(session):
+        user, _ = await upsert(session, User, defaults={"name": "old"}, tg_id=TG_ID)
+        session.add(Courier(user_id=user.id))
+        await session.flush()
+        cache.put(TG_ID - 2, Identity(user_id=0, name="cached"))
+        loaded = await cache.warm(
+            session, {TG_ID: "new", TG_ID - 1: "fresh", TG_ID - 2: "skip"}
+        )
+        warmed = {tg_id: cache.get(tg_id) for tg_id in (TG_ID, TG_ID - 1, TG_ID - 2)}
+        return user.id, loaded, warmed, await cache.warm(session, {TG_ID: "new"})
+
+    user_id, loaded, warmed, loaded_again = in_transaction(body)
+    # уже закешированный пользователь не загружается заново
+    assert (loaded, loaded_again) == (2, 0)
+    identity = warmed[TG_ID]
+    assert (identity.user_id, identity.name) == (user_id, "old")
+    assert identity.courier_id is not None and identity.sender_id is None
+    fresh = warmed[TG_ID - 1]
+    assert fresh.name == "fresh" and fresh.courier_id is None
+    assert warmed[TG_ID - 2].name == "cached"
+    assert cache.get(TG_ID) is None and cache.get(TG_ID - 1) is None
@@ -0,0 +1,177 @@
+import pytest
+from aiogram.types import InlineKeyboardButton
+
+import my_keyboards
+from database import City, Country
+from my_keyboards import (
+    PICKER_PAGE_SIZE,
+    CityCallback,
+    DirectionEnum,
+    PickerCallback,
+    _buckets_markup,
+    _cache,
+    _cached,
+    _page_markup,
+    city_keyboard,
+    city_prompt_markup,
+    invalidate_cities,
+    invalidate_countries,
+)
+
+ABSENT = InlineKeyboardButton(text="Нет в списке", callback_data="absent")
+
+
+@pytest.fixture(autouse=True)
+def markup_cache():
+    my_keyboards._markup_cache.clear()
+    yield my_keyboards._markup_cache
+    my_keyboards._markup_cache.clear()
+
+
+class Row(tuple):
+    @property
+    def id(self):
+        return self[0]
+
+
+def _texts(markup):
+    return [[button.text for button in row] for row in markup.inline_keyboard]
+
+
+def _callbacks(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+def test_city_prompt_markup():
+    [[button]] = city_prompt_markup(DirectionEnum.to).inline_keyboard
+    assert PickerCallback.unpack(button.callback_data) == PickerCallback(
+        direction=DirectionEnum.to
+    )
+
+
+def test_buckets_markup():
+    markup = _buckets_markup(list("АБВГДЕЖ"), DirectionEnum.from_, 7, ABSENT)
+    assert _texts(markup) == [list("АБВГДЕ"), ["Ж"], ["Нет в списке"]]
+    assert PickerCallback.unpack(markup.inline_keyboard[1][0].callback_data) == (
+        PickerCallback(direction=DirectionEnum.from_, country_id=7, prefix="Ж")
+    )
+
+
+def test_page_markup_navigation():
+    rows = [Row((i, f"Город {i}")) for i in (4, 5, 6)]
+
+    def pager(**kwargs):
+        return repr(sorted(kwargs.items()))
+
+    markup = _page_markup(rows, True, True, "Г", str, pager, ABSENT)
+    assert _texts(markup) == [
+        ["Город 4", "Город 5"],
+        ["Город 6"],
+        ["«", "А–Я", "»"],
+        ["Нет в списке"],
+    ]
+    assert _callbacks(markup)[3:6] == [
+        repr([("before", 4)]),
+        repr([("prefix", "")]),
+        repr([("after", 6)]),
+    ]
+    # одна страница без префикса: навигации нет
+    markup = _page_markup(rows[:1], False, False, "", str, pager, ABSENT)
+    assert _texts(markup) == [["Город 4"], ["Нет в списке"]]
+
+
+def test_invalidation(markup_cache):
+    _cache(("country", DirectionEnum.to, "", 0, 0), "countries")
+    _cache(("city", DirectionEnum.to, 1, "", 0, 0), "cities of 1")
+    _cache(("city", DirectionEnum.to, 2, "", 0, 0), "cities of 2")
+    invalidate_cities(1, publish=False)
+    assert [key[0:3:2] for key in markup_cache] == [("country", ""), ("city", 2)]
+    invalidate_countries(publish=False)
+    assert len(markup_cache) == 1
+    invalidate_cities(publish=False)
+    assert not markup_cache
+
+
+def test_invalidation_published(monkeypatch):
+    events = []
+    monkeypatch.setattr(
+        my_keyboards,
+        "invalidation_listeners",
+        [lambda op, arg: events.append((op, arg))],
+    )
+    invalidate_cities(3)
+    invalidate_countries()
+    invalidate_cities(4, publish=False)
+    assert events == [("invalidate_cities", 3), ("invalidate_countries", None)]
+
+
+def test_cache_eviction(monkeypatch, markup_cache):
+    monkeypatch.setattr(my_keyboards, "KEYBOARD_CACHE_SIZE", 2)
+    for i in range(3):
+        _cache(("city", i), i)
+    assert _cached(("city", 0)) is None
+    assert _cached(("city", 1)) == 1
+    _cache(("city", 3), 3)
+    # прочитанная страница пережила вытеснение
+    assert list(markup_cache) == [("city", 1), ("city", 3)]
+
+
+async def _country(session, names):
+    country = Country(name="Тестландия")
+    session.add(country)
+    await session.flush()
+    session.add_all(City(name=name, country_id=country.id) for name in names)
+    await session.flush()
+    return country.id
+
+
+def _city_ids(markup):
+    ids = []
+    for data in _callbacks(markup):
+        try:
+            ids.append(CityCallback.unpack(data).id)
+        except ValueError:
+            pass
+    return ids
+
+
+def test_city_keyboard_single_page(in_transaction):
+    async def body(session):
+        country_id = await _country(session, ["Бтест", "Атест"])
+        first = await city_keyboard(session, DirectionEnum.to, country_id)
+        again = await city_keyboard(session, DirectionEnum.to, country_id)
+        return first, again
+
+    first, again = in_transaction(body)
+    assert again is first
+    assert _texts(first) == [["Атест", "Бтест"], ["Нет в списке"]]
+    # «Нет в списке» — CityCallback с id=0
+    assert _city_ids(first)[-1] == 0
+
+
+def test_city_keyboard_buckets_and_pages(in_transaction):
+    # латиница: left(name, 1) в базе SQL_ASCII режет кириллицу по байту
+    names = [f"{letter}test{i:02}" for letter in "AB" for i in range(PICKER_PAGE_SIZE)]
+
+    async def body(session):
+        country_id = await _country(session, names)
+        direction = DirectionEnum.from_
+        buckets = await city_keyboard(session, direction, country_id)
+        letter_a = await city_keyboard(session, direction, country_id, prefix="A")
+        letter_b = await city_keyboard(session, direction, country_id, prefix="B")
+        # весь список по страницам: после последнего «A…» и обратно
+        after = _city_ids(letter_a)[-2]
+        second = await city_keyboard(session, direction, country_id, after=after)
+        before = _city_ids(second)[0]
+        back = await city_keyboard(session, direction, country_id, before=before)
+        return buckets, letter_a, letter_b, second, back
+
+    buckets, letter_a, letter_b, second, back = in_transaction(body)
+    assert _texts(buckets) == [["A", "B"], ["Нет в списке"]]
+    assert _texts(letter_a)[0] == ["Atest00", "Atest01"]
+    assert _texts(letter_a)[-2:] == [["А–Я"], ["Нет в списке"]]
+    assert len(_city_ids(letter_b)) == PICKER_PAGE_SIZE + 1
+    assert _texts(second)[0] == ["Btest00", "Btest01"]
+    assert _texts(second)[-2] == ["«"]
+    assert _texts(back)[0] == ["Atest00", "Atest01"]
+    assert _texts(back)[-2] == ["»"]
@@ -0,0 +1,178 @@
+import random
+from datetime import date, timedelta
+
+from matching import BAGGAGE_ANY, MatchEntry, MatchIndex
+
+DAY = date(2030, 3, 10)
+
+
+def _courier(request_id, day, origin=1, destination=2, mask=BAGGAGE_ANY):
+    return MatchEntry(
+        request_id=request_id,
+        origin_id=origin,
+        destination_id=destination,
+        tg_id=request_id,
+        user_name="",
+        origin_name="",
+        destination_name="",
+        baggage_mask=mask,
+        comment="",
+        date=day,
+    )
+
+
+def _sender(request_id, date_from, date_to, origin=1, destination=2, mask=1):
+    return MatchEntry(
+        request_id=request_id,
+        origin_id=origin,
+        destination_id=destination,
+        tg_id=request_id,
+        user_name="",
+        origin_name="",
+        destination_name="",
+        baggage_mask=mask,
+        comment="",
+        date_from=date_from,
+        date_to=date_to,
+    )
+
+
+def _ids(entries):
+    return [entry.request_id for entry in entries]
+
+
+def test_couriers_between_inclusive():
+    index = MatchIndex()
+    for i, offset in enumerate([-1, 0, 3, 5, 6], 1):
+        index.add(_courier(i, DAY + timedelta(days=offset)))
+    index.add(_courier(10, DAY, destination=3))
+    found = index.couriers_between(1, 2, DAY, DAY + timedelta(days=5))
+    assert _ids(found) == [2, 3, 4]
+
+
+def test_senders_on_containing_period():
+    index = MatchIndex()
+    # длинный период, начавшийся задолго до дня, тоже подходит
+    index.add(_sender(1, DAY - timedelta(days=40), DAY + timedelta(days=1)))
+    index.add(_sender(2, DAY, DAY))
+    index.add(_sender(3, DAY - timedelta(days=5), DAY - timedelta(days=1)))
+    index.add(_sender(4, DAY + timedelta(days=1), DAY + timedelta(days=9)))
+    assert _ids(index.senders_on(1, 2, DAY)) == [1, 2]
+
+
+def test_max_span_shrinks_on_discard():
+    index = MatchIndex()
+    index.add(_sender(1, DAY - timedelta(days=40), DAY))
+    index.add(_sender(2, DAY - timedelta(days=2), DAY))
+    route = index._routes[(1, 2)]
+    assert route.max_span == timedelta(days=40)
+    index.discard(1)
+    assert route.max_span == timedelta(days=2)
+    index.discard(1)
+    assert _ids(index.senders_on(1, 2, DAY)) == [2]
+
+
+def test_baggage_compatibility():
+    index = MatchIndex()
+    index.add(_courier(1, DAY, mask=0b011))
+    index.add(_courier(2, DAY, mask=0b001))
+    index.add(_sender(3, DAY, DAY, mask=0b011))
+    index.add(_sender(4, DAY, DAY, mask=0b100))
+    # курьер должен брать весь багаж отправителя
+    assert _ids(index.couriers_between(1, 2, DAY, DAY, 0b011)) == [1]
+    assert _ids(index.couriers_between(1, 2, DAY, DAY)) == [1, 2]
+    assert _ids(index.senders_on(1, 2, DAY, 0b011)) == [3]
+    assert _ids(index.senders_on(1, 2, DAY)) == [3, 4]
+
+
+def test_evict():
+    index = MatchIndex()
+    index.add(_courier(1, DAY - timedelta(days=1)))
+    index.add(_courier(2, DAY))
+    index.add(_sender(3, DAY - timedelta(days=9), DAY - timedelta(days=1)))
+    index.add(_sender(4, DAY - timedelta(days=9), DAY))
+    index.add(_courier(5, DAY - timedelta(days=1), origin=7))
+    assert index.evict(DAY) == 3
+    assert sorted(index._entries) == [2, 4]
+    # опустевшее направление удалено целиком
+    assert (7, 2) not in index._routes and 7 not in index._destinations
+    assert index.stats() == {"entries": 2, "routes": 1, "evicted": 3, "ready": 0}
+    assert index.evict(DAY) == 0
+
+
+def test_members():
+    groups = [frozenset((1, 11)), frozenset((2, 12))]
+
+    def members(user_city_id):
+        for group in groups:
+            if user_city_id in group:
+                return group
+        return frozenset((user_city_id,))
+
+    index = MatchIndex(members)
+    index.add(_courier(1, DAY, origin=11, destination=2))
+    index.add(_courier(2, DAY, origin=1, destination=12))
+    index.add(_courier(3, DAY, origin=1, destination=3))
+    assert _ids(index.couriers_between(1, 2, DAY, DAY)) == [1, 2]
+    assert _ids(index.couriers_between(11, 12, DAY, DAY)) == [1, 2]
+    assert _ids(index.couriers_between(3, 2, DAY, DAY)) == []
+
+
+def test_listeners():
+    index = MatchIndex()
+    events = []
+    index.listeners.append(lambda op, arg: events.append((op, arg)))
+    entry = _courier(1, DAY)
+    index.add(entry)
+    index.add(entry)
+    index.discard(1)
+    index.add(_courier(2, DAY), publish=False)
+    assert events == [("add", entry), ("add", entry), ("discard", 1)]
+    assert len(index) == 1
+
+
+def test_matches_brute_force():
+    rnd = random.Random(1)
+    index = MatchIndex()
+    entries = {}
+    for i in range(1, 400):
+        origin, destination = rnd.randint(1, 3), rnd.randint(1, 3)
+        start = DAY + timedelta(days=rnd.randint(-30, 30))
+        mask = rnd.randint(1, BAGGAGE_ANY)
+        if rnd.random() < 0.5:
+            entry = _courier(i, start, origin, destination, mask)
+        else:
+            end = start + timedelta(days=rnd.choice([0, 1, 5, 45]))
+            entry = _sender(i, start, end, origin, destination, mask)
+        entries[i] = entry
+        index.add(entry)
+    for i in rnd.sample(sorted(entries), 100):
+        index.discard(i)
+        del entries[i]
+
+    for _ in range(50):
+        day = DAY + timedelta(days=rnd.randint(-35, 35))
+        until = day + timedelta(days=rnd.randint(0, 10))
+        mask = rnd.randint(0, BAGGAGE_ANY)
+        origin, destination = rnd.randint(1, 3), rnd.randint(1, 3)
+        route = [
+            e
+            for _, e in sorted(entries.items())
+            if (e.origin_id, e.destination_id) == (origin, destination)
+        ]
+        couriers = [
+            e
+            for e in route
+            if e.is_courier and day <= e.date <= until and e.baggage_mask & mask == mask
+        ]
+        senders = [
+            e
+            for e in route
+            if not e.is_courier
+            and e.date_from <= day <= e.date_to
+            and mask & e.baggage_mask == e.baggage_mask
+        ]
+        found = index.couriers_between(origin, destination, day, until, mask)
+        assert sorted(_ids(found)) == _ids(couriers)
+        found = index.senders_on(origin, destination, day, mask)
+        assert sorted(_ids(found)) == _ids(senders)
@@ -0,0 +1,183 @@
+import asyncio
+import time
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.methods import SendMessage
+
+from notifications import NotificationDispatcher, TokenBucket
+
+
+class FakeBot:
+    """Записывает отправленное; errors — исключения на очередные вызовы."""
+
+    def __init__(self, errors=None, delay=0):
+        self.errors = errors or {}
+        self.delay = delay
+        self.sent = []
+        self.calls = 0
+
+    async def send_message(self, chat_id, text):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        error = self.errors.get(self.calls)
+        if error is not None:
+            raise error
+        self.sent.append((chat_id, text, time.monotonic()))
+
+
+def _method(chat_id=1):
+    return SendMessage(chat_id=chat_id, text="")
+
+
+def _run(bot, enqueue, **kwargs):
+    async def main():
+        dispatcher = NotificationDispatcher(bot, **kwargs)
+        await dispatcher.start()
+        enqueue(dispatcher)
+        await dispatcher.stop(timeout=5)
+        return dispatcher
+
+    return asyncio.run(main())
+
+
+def test_token_bucket_rate():
+    async def main():
+        bucket = TokenBucket(rate=100, capacity=5)
+        started = time.monotonic()
+        for _ in range(15):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 5 токенов сразу, остальные 10 — по одному в 10 мс
+    elapsed = asyncio.run(main())
+    assert 0.08 <= elapsed < 0.5
+
+
+def test_chat_order_and_interval():
+    bot = FakeBot()
+    done = []
+
+    def enqueue(dispatcher):
+        for i in range(3):
+            dispatcher.enqueue(1, f"a{i}", done.append)
+        dispatcher.enqueue(2, "b0", done.append)
+
+    dispatcher = _run(bot, enqueue, chat_interval=0.05, rate=1000)
+    assert [text for chat_id, text, _ in bot.sent if chat_id == 1] == [
+        "a0",
+        "a1",
+        "a2",
+    ]
+    at = [sent_at for chat_id, _, sent_at in bot.sent if chat_id == 1]
+    assert all(b - a >= 0.045 for a, b in zip(at, at[1:]))
+    # пауза первого чата не задерживает второй
+    assert [text for _, text, _ in bot.sent].index("b0") < 2
+    assert done == [True] * 4
+    stats = dispatcher.stats()
+    assert (stats["sent"], stats["queue_depth"], stats["chats_waiting"]) == (4, 0, 0)
+
+
+def test_chat_interval_survives_empty_queue():
+    bot = FakeBot()
+
+    async def main():
+        dispatcher = NotificationDispatcher(bot, chat_interval=0.1, rate=1000)
+        await dispatcher.start()
+        dispatcher.enqueue(1, "first")
+        await dispatcher.join()
+        # очередь чата опустела, но следующее сообщение ждёт интервал
+        dispatcher.enqueue(1, "second")
+        await dispatcher.stop(timeout=5)
+
+    asyncio.run(main())
+    (_, _, first), (_, _, second) = bot.sent
+    assert second - first >= 0.09
+
+
+def test_flood_control_retries_in_order():
+    bot = FakeBot({1: TelegramRetryAfter(_method(), "flood", retry_after=0)})
+    done = []
+
+    def enqueue(dispatcher):
+        dispatcher.enqueue(1, "a", done.append)
+        dispatcher.enqueue(1, "b", done.append)
+
+    dispatcher = _run(bot, enqueue, chat_interval=0, rate=1000)
+    # сообщение вернулось в голову очереди чата и ушло раньше следующего
+    assert [text for _, text, _ in bot.sent] == ["a", "b"]
+    assert done == [True, True]
+    assert (dispatcher.retried, dispatcher.failed) == (1, 0)
+
+
+def test_flood_control_retries_exhausted():
+    error = TelegramRetryAfter(_method(), "flood", retry_after=0)
+    bot = FakeBot({i: error for i in range(1, 4)})
+    done = []
+
+    dispatcher = _run(
+        bot,
+        lambda d: d.enqueue(1, "a", done.append),
+        chat_interval=0,
+        rate=1000,
+        max_retries=2,
+    )
+    assert bot.sent == [] and bot.calls == 3
+    assert done == [False]
+    assert (dispatcher.retried, dispatcher.failed) == (2, 1)
+
+
+def test_forbidden_and_rejected():
+    bot = FakeBot(
+        {
+            1: TelegramForbiddenError(_method(1), "bot was blocked by the user"),
+            2: TelegramBadRequest(_method(2), "Bad Request: chat not found"),
+            3: TelegramBadRequest(_method(3), "Bad Request: message is too long"),
+        }
+    )
+    done = {}
+
+    def enqueue(dispatcher):
+        for chat_id in (1, 2, 3, 4):
+            dispatcher.enqueue(
+                chat_id, "x", lambda ok, chat_id=chat_id: done.update({chat_id: ok})
+            )
+
+    dispatcher = _run(bot, enqueue, workers=1, chat_interval=0, rate=1000)
+    # недоступный чат считается обработанным, отклонённое — нет
+    assert done == {1: True, 2: True, 3: False, 4: True}
+    stats = dispatcher.stats()
+    assert (stats["sent"], stats["forbidden"], stats["failed"]) == (1, 2, 1)
+
+
+def test_queue_full():
+    bot = FakeBot()
+    accepted = []
+
+    def enqueue(dispatcher):
+        accepted.extend(dispatcher.enqueue(i, "x") for i in range(3))
+
+    dispatcher = _run(bot, enqueue, maxsize=2, rate=1000)
+    assert accepted == [True, True, False]
+    assert dispatcher.dropped == 1 and len(bot.sent) == 2
+
+
+def test_workers_run_chats_concurrently():
+    bot = FakeBot(delay=0.1)
+
+    async def main():
+        dispatcher = NotificationDispatcher(bot, workers=4, rate=1000)
+        await dispatcher.start()
+        started = time.monotonic()
+        for chat_id in range(4):
+            dispatcher.enqueue(chat_id, "x")
+        await dispatcher.join()
+        elapsed = time.monotonic() - started
+        await dispatcher.stop()
+        return elapsed
+
+    assert asyncio.run(main()) < 0.3
@@ -0,0 +1,110 @@
+from sqlalchemy import text
+
+from outbox import CLAIM, PURGE, OutboxDrainer, add_messages
+
+PARAMS = {"lease": 60, "max_attempts": 3, "batch": 10}
+
+
+async def _empty_outbox(session):
+    # строки других тестов и запусков бота не должны попасть в выборку;
+    # удаление откатится вместе с транзакцией теста
+    await session.execute(text("DELETE FROM outbox"))
+
+
+def test_add_messages_dedupe(in_transaction):
+    async def body(session):
+        await _empty_outbox(session)
+        await add_messages(session, [("k1", 1, "a"), ("k2", 2, "b")])
+        await add_messages(session, [("k1", 1, "again"), ("k3", 3, "c")])
+        await add_messages(session, [])
+        result = await session.execute(
+            text("SELECT send_key, text FROM outbox ORDER BY send_key")
+        )
+        return result.all()
+
+    assert in_transaction(body) == [("k1", "a"), ("k2", "b"), ("k3", "c")]
+
+
+def test_claim_leases_rows(in_transaction):
+    async def body(session):
+        await _empty_outbox(session)
+        await add_messages(session, [(f"k{i}", i, f"m{i}") for i in range(3)])
+        first = (await session.execute(CLAIM, {**PARAMS, "batch": 2})).all()
+        second = (await session.execute(CLAIM, PARAMS)).all()
+        # арендованные строки не выдаются повторно до истечения аренды
+        third = (await session.execute(CLAIM, PARAMS)).all()
+        await session.execute(text("UPDATE outbox SET available_at = now()"))
+        again = (await session.execute(CLAIM, PARAMS)).all()
+        attempts = await session.scalar(text("SELECT max(attempts) FROM outbox"))
+        return first, second, third, again, attempts
+
+    first, second, third, again, attempts = in_transaction(body)
+    assert len(first) == 2 and len(second) == 1 and third == []
+    assert sorted(chat_id for _, chat_id, _ in first + second) == [0, 1, 2]
+    assert len(again) == 3 and attempts == 2
+
+
+def test_claim_skips_exhausted(in_transaction):
+    async def body(session):
+        await _empty_outbox(session)
+        await add_messages(session, [("dead", 1, "x"), ("live", 2, "y")])
+        await session.execute(
+            text("UPDATE outbox SET attempts = :n WHERE send_key = 'dead'"),
+            {"n": PARAMS["max_attempts"]},
+        )
+        return (await session.execute(CLAIM, PARAMS)).all()
+
+    assert [chat_id for _, chat_id, _ in in_transaction(body)] == [2]
+
+
+def test_purge(in_transaction):
+    async def body(session):
+        await _empty_outbox(session)
+        await add_messages(
+            session,
+            [(key, 1, "x") for key in ("old", "recent", "dead", "young_dead", "tried")],
+        )
+        await session.execute(
+            text(
+                """
+                UPDATE outbox SET
+                    sent_at = CASE send_key
+                        WHEN 'old' THEN now() - interval '2 hours'
+                        WHEN 'recent' THEN now()
+                    END,
+                    available_at = CASE send_key
+                        WHEN 'young_dead' THEN now()
+                        ELSE now() - interval '3 hours'
+                    END,
+                    attempts = CASE send_key WHEN 'tried' THEN 1 ELSE 3 END
+                """
+            )
+        )
+        params = {
+            "retention": 3600,
+            "dead_retention": 7200,
+            "max_attempts": 3,
+            "batch": 10,
+        }
+        deleted = (await session.execute(PURGE, params)).rowcount
+        result = await session.execute(
+            text("SELECT send_key FROM outbox ORDER BY send_key")
+        )
+        return deleted, result.scalars().all()
+
+    deleted, left = in_transaction(body)
+    assert deleted == 2
+    assert left == ["recent", "tried", "young_dead"]
+
+
+def test_on_done():
+    drainer = OutboxDrainer(notifier=None)
+    drainer._in_flight.update((1, 2))
+    drainer._settled.clear()
+    drainer._on_done(1)(True)
+    # отправленная строка ждёт пометки sent_at
+    assert drainer._to_mark == [1] and not drainer._settled.is_set()
+    drainer._to_mark.clear()
+    drainer._on_done(2)(False)
+    assert drainer.retried == 1 and drainer._settled.is_set()
+    assert drainer.stats()["in_flight"] == 0
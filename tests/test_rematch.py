@@ -0,0 +1,154 @@
+from datetime import date
+
+import pytest
+
+from database import Courier, Request, Sender, Status, User, UserCity
+from matching import CARD_COMMENT_LIMIT, MatchEntry, courier_card
+from rematch import (
+    CARDS_PER_MESSAGE,
+    MESSAGE_LIMIT,
+    _pack_cards,
+    claim_pairs,
+    match_messages,
+)
+
+HEADER = "Новые курьеры по вашей заявке:\n\n"
+
+
+def _entry(request_id, comment="", courier=True, name="Курьер"):
+    dates = {"date": date(2030, 1, 2)}
+    if not courier:
+        dates = {"date_from": date(2030, 1, 1), "date_to": date(2030, 1, 5)}
+    return MatchEntry(
+        request_id=request_id,
+        origin_id=1,
+        destination_id=2,
+        tg_id=1000 + request_id,
+        user_name=name,
+        origin_name="Москва",
+        destination_name="Казань",
+        baggage_mask=1,
+        comment=comment,
+        **dates,
+    )
+
+
+def _packed(entries, header=HEADER):
+    return list(_pack_cards(header, entries))
+
+
+def test_single_message():
+    entries = [_entry(i) for i in range(3)]
+    [(cards, text)] = _packed(entries)
+    assert cards == entries
+    assert text == HEADER + "\n\n".join(courier_card(e) for e in entries)
+
+
+def test_split_by_count():
+    entries = [_entry(i) for i in range(CARDS_PER_MESSAGE * 2 + 1)]
+    packed = _packed(entries)
+    assert [len(cards) for cards, _ in packed] == [CARDS_PER_MESSAGE] * 2 + [1]
+    assert [e for cards, _ in packed for e in cards] == entries
+
+
+def test_split_by_length():
+    # после экранирования каждая карточка около 3 КБ: по одной на сообщение
+    entries = [_entry(i, comment="<" * CARD_COMMENT_LIMIT) for i in range(4)]
+    packed = _packed(entries)
+    assert len(packed) == 4
+    for cards, text in packed:
+        assert len(text) <= MESSAGE_LIMIT
+        assert text.startswith(HEADER)
+        assert text.endswith(courier_card(cards[-1]))
+
+
+@pytest.mark.parametrize("comment_size", [0, 100, 300, CARD_COMMENT_LIMIT])
+def test_messages_fit_limit(comment_size):
+    entries = [_entry(i, comment="&" * comment_size) for i in range(25)]
+    packed = _packed(entries)
+    assert [e for cards, _ in packed for e in cards] == entries
+    for cards, text in packed:
+        assert 0 < len(cards) <= CARDS_PER_MESSAGE
+        assert len(text) <= MESSAGE_LIMIT
+
+
+def test_empty():
+    assert _packed([]) == []
+
+
+def test_match_messages():
+    sender = _entry(1, courier=False, name="Отправитель")
+    couriers = [_entry(i) for i in range(2, 2 + CARDS_PER_MESSAGE + 1)]
+    entries = {e.request_id: e for e in [sender, *couriers]}
+    # заявка, которую уже закрыли, пропускается
+    pairs = [(1, c.request_id) for c in couriers] + [(1, 999)]
+    messages = match_messages(pairs, entries)
+
+    to_couriers = [m for m in messages if m[0].endswith(":courier")]
+    assert [(key, chat_id) for key, chat_id, _ in to_couriers] == [
+        (f"match:1:{c.request_id}:courier", c.tg_id) for c in couriers
+    ]
+
+    to_sender = [m for m in messages if m[0].endswith(":sender")]
+    assert [chat_id for _, chat_id, _ in to_sender] == [sender.tg_id] * 2
+    ids = "-".join(str(c.request_id) for c in couriers[:CARDS_PER_MESSAGE])
+    assert to_sender[0][0] == f"match:1:{ids}:sender"
+    assert to_sender[1][0] == f"match:1:{couriers[-1].request_id}:sender"
+    assert all(text.startswith(HEADER) for _, _, text in to_sender)
+
+
+def test_single_courier_without_header():
+    sender = _entry(1, courier=False)
+    courier = _entry(2)
+    messages = match_messages([(1, 2)], {1: sender, 2: courier})
+    assert ("match:1:2:sender", sender.tg_id, courier_card(courier)) in messages
+
+
+async def _requests(session, count):
+    user = User(tg_id=-424242, name="test")
+    session.add(user)
+    await session.flush()
+    sender, courier = Sender(user_id=user.id), Courier(user_id=user.id)
+    origin = UserCity(name="test-origin", created_by_id=user.id)
+    destination = UserCity(name="test-destination", created_by_id=user.id)
+    session.add_all([sender, courier, origin, destination])
+    await session.flush()
+    route = {"origin_id": origin.id, "destination_id": destination.id}
+    requests = [
+        Request(
+            sender_id=sender.id,
+            date_from=date(2030, 1, 1),
+            date_to=date(2030, 1, 5),
+            comment="",
+            status=Status.new,
+            **route,
+        )
+    ]
+    for _ in range(count):
+        requests.append(
+            Request(
+                courier_id=courier.id,
+                date=date(2030, 1, 2),
+                comment="",
+                status=Status.new,
+                **route,
+            )
+        )
+    session.add_all(requests)
+    await session.flush()
+    return [r.id for r in requests]
+
+
+def test_claim_pairs_once(in_transaction):
+    async def body(session):
+        sender_id, first, second = await _requests(session, 2)
+        claimed = [
+            await claim_pairs(session, [(sender_id, first)]),
+            await claim_pairs(session, [(sender_id, first)]),
+            await claim_pairs(session, [(sender_id, second), (sender_id, second)]),
+            await claim_pairs(session, []),
+        ]
+        return (sender_id, first, second), claimed
+
+    (sender_id, first, second), claimed = in_transaction(body)
+    assert claimed == [{(sender_id, first)}, set(), {(sender_id, second)}, set()]